@@ -0,0 +1,381 @@
+"""Time the screening hot paths on synthetic package lists.
+
+A module that contains functions that generate package lists of a
+given size that look like the real PyPI list, time the screens, the
+top package scan and the snapshot functions on them, and compare the
+timings to a stored baseline so that slowdowns are caught before an
+upgrade.
+
+Run every benchmark and compare it to the stored baseline with:
+
+    python benchmarks.py
+
+and store the timings as the new baseline with:
+
+    python benchmarks.py --save_baseline
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import constants
+from filters import (
+    distance_calculations,
+    homophone_attack_screen,
+    order_attack_screen,
+    whitelist,
+)
+import indexes
+from snapshots import diff_snapshots, open_snapshot, write_snapshot
+from utils import create_suspicious_package_dict, keyboard_typo_screen
+
+BENCHMARK_BASELINE = constants.BENCHMARK_BASELINE
+BENCHMARK_NOISE_FLOOR = constants.BENCHMARK_NOISE_FLOOR
+BENCHMARK_SIZES = constants.BENCHMARK_SIZES
+BENCHMARK_TARGETS = constants.BENCHMARK_TARGETS
+BENCHMARK_TOLERANCE = constants.BENCHMARK_TOLERANCE
+MAX_DISTANCE = constants.MAX_DISTANCE
+
+# Words that start or end many real package names
+NAME_PREFIXES = ["py", "python-", "django-", "flask-", "pytest-", "sphinx-", "ckan-"]
+NAME_SUFFIXES = ["-utils", "-client", "-api", "-sdk", "-tools", "-plugin", "lib"]
+
+
+def load_name_words(path="top_packages_may_2020.json"):
+    """Collect the words that top package names are made of.
+
+    Args:
+        path (str): stored top packages json
+
+    Returns:
+        list: distinct words of at least two letters, sorted
+    """
+    with open(path, "r") as f:
+        rows = json.load(f)["rows"]
+    words = set()
+    for row in rows:
+        for word in indexes.name_token_bag(row["project"]):
+            if len(word) > 1:
+                words.add(word)
+    return sorted(words)
+
+
+def synthetic_package_names(count, seed=0, words=None):
+    """Generate distinct package names that look like PyPI's.
+
+    Names join one to three words taken from top package names with the
+    separators and affixes PyPI names commonly use, and a small share
+    are one-letter misspellings of other names, so the screens find
+    about as many matches as they do on the real list. The same count
+    and seed always give the same names.
+
+    Args:
+        count (int): number of names to generate
+        seed (int): seed of the random generator
+        words (list): words to build names from, by default load_name_words()
+
+    Returns:
+        list: distinct package names in the order they were generated
+    """
+    if words is None:
+        words = load_name_words()
+    generator = random.Random(seed)  # nosec
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    package_names = []
+    seen = set()
+    while len(package_names) < count:
+        if package_names and generator.random() < 0.02:
+            # Misspell an earlier name by replacing one letter
+            package = generator.choice(package_names)
+            position = generator.randrange(len(package))
+            package = (
+                package[:position] + generator.choice(letters) + package[position + 1 :]
+            )
+        else:
+            separator = generator.choice(["-", "-", "_", "", "."])
+            parts = generator.sample(words, generator.choice([1, 2, 2, 2, 3]))
+            package = separator.join(parts)
+            if generator.random() < 0.1:
+                package = generator.choice(NAME_PREFIXES) + package
+            if generator.random() < 0.1:
+                package += generator.choice(NAME_SUFFIXES)
+            if generator.random() < 0.05:
+                package += str(generator.randrange(100))
+        if package not in seen:
+            seen.add(package)
+            package_names.append(package)
+    return package_names
+
+
+def best_time(function, repeat, setup=None):
+    """Time a function, keeping the fastest of several runs.
+
+    Args:
+        function (function): function to time, called without arguments
+        repeat (int): number of times to run it
+        setup (function): function run untimed before each run
+
+    Returns:
+        float: seconds taken by the fastest run
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark_corpus(package_names, targets, max_distance=MAX_DISTANCE, repeat=3):
+    """Time every benchmark on one package list.
+
+    The screens are timed without indexes, as a scan of one target,
+    except the keyboard screen, which always probes a canonical name
+    index built beforehand. create_suspicious_package_dict is timed
+    with a cold name index cache, so each run includes building the
+    indexes it uses.
+
+    Args:
+        package_names (list): package names to screen against
+        targets (list): package names to look for typosquatters of
+        max_distance (int): maximum edit distance to check for typosquatting
+        repeat (int): number of runs of each benchmark
+
+    Returns:
+        dict: (key) benchmark name and (value) seconds taken by its fastest run
+    """
+    squat_candidates = {
+        package: package_names[position + 1 : position + 11]
+        for position, package in enumerate(package_names[:10000])
+    }
+    changed_names = package_names[len(package_names) // 100 :] + [
+        package + "-new" for package in package_names[: len(package_names) // 100]
+    ]
+
+    # Names of one word cannot be reordered, so time a name of several
+    order_target = next(
+        (target for target in targets if len(indexes.name_token_bag(target)) > 1),
+        targets[0],
+    )
+
+    canonical_index = indexes.build_canonical_index(package_names)
+    timings = {
+        "distance_calculations": best_time(
+            lambda: distance_calculations(targets[0], package_names, max_distance),
+            repeat,
+        ),
+        "homophone_attack_screen": best_time(
+            lambda: homophone_attack_screen(targets[0], package_names), repeat
+        ),
+        "order_attack_screen": best_time(
+            lambda: order_attack_screen(order_target, package_names), repeat
+        ),
+        "keyboard_typo_screen": best_time(
+            lambda: keyboard_typo_screen(targets[0], canonical_index), repeat
+        ),
+        "whitelist": best_time(lambda: whitelist(squat_candidates), repeat),
+        "create_suspicious_package_dict": best_time(
+            lambda: create_suspicious_package_dict(
+                package_names, targets, max_distance
+            ),
+            repeat,
+            setup=indexes.NAME_INDEX_CACHE.clear,
+        ),
+    }
+
+    with tempfile.TemporaryDirectory() as folder:
+        old_path = os.path.join(folder, "old.snap")
+        new_path = os.path.join(folder, "new.snap")
+        timings["write_snapshot"] = best_time(
+            lambda: write_snapshot(package_names, old_path), repeat
+        )
+        write_snapshot(changed_names, new_path)
+        timings["open_snapshot"] = best_time(lambda: open_snapshot(old_path), repeat)
+        timings["diff_snapshots"] = best_time(
+            lambda: sum(
+                1
+                for _ in diff_snapshots(
+                    open_snapshot(old_path), open_snapshot(new_path)
+                )
+            ),
+            repeat,
+        )
+    return timings
+
+
+def run_benchmarks(
+    sizes=BENCHMARK_SIZES,
+    number_targets=BENCHMARK_TARGETS,
+    max_distance=MAX_DISTANCE,
+    repeat=3,
+):
+    """Time every benchmark on synthetic package lists of several sizes.
+
+    The targets are the most downloaded packages in the stored top
+    packages json, and are added to each package list.
+
+    Args:
+        sizes (list): numbers of package names to generate
+        number_targets (int): number of top packages to screen
+        max_distance (int): maximum edit distance to check for typosquatting
+        repeat (int): number of runs of each benchmark
+
+    Returns:
+        dict: machine details and the timings of each size
+    """
+    with open("top_packages_may_2020.json", "r") as f:
+        rows = json.load(f)["rows"]
+    targets = [row["project"] for row in rows[:number_targets]]
+    words = load_name_words()
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "max_distance": max_distance,
+        "targets": number_targets,
+        "timings": {},
+    }
+    for size in sizes:
+        package_names = synthetic_package_names(size, words=words)
+        package_names = package_names[: size - len(targets)] + targets
+        print("Timing benchmarks on " + str(size) + " package names.", file=sys.stderr)
+        results["timings"][str(size)] = benchmark_corpus(
+            package_names, targets, max_distance, repeat
+        )
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=BENCHMARK_TOLERANCE):
+    """Compare benchmark timings to the timings of a baseline run.
+
+    A timing only regresses if it also grew by more than
+    BENCHMARK_NOISE_FLOOR seconds, since the shortest benchmarks vary
+    by more than the tolerance from run to run.
+
+    Args:
+        results (dict): timings made by run_benchmarks
+        baseline (dict): earlier timings made by run_benchmarks
+        tolerance (float): share a timing may grow by before it is a regression
+
+    Returns:
+        list: one dict per benchmark run in both, with the size, the
+        benchmark name, both timings, their ratio and whether it regressed
+    """
+    comparison = []
+    for size, timings in results["timings"].items():
+        baseline_timings = baseline["timings"].get(size, {})
+        for name, seconds in timings.items():
+            if name not in baseline_timings:
+                continue
+            ratio = seconds / max(baseline_timings[name], 1e-9)
+            comparison.append(
+                {
+                    "size": int(size),
+                    "benchmark": name,
+                    "baseline": baseline_timings[name],
+                    "current": seconds,
+                    "ratio": ratio,
+                    "regressed": ratio > 1 + tolerance
+                    and seconds - baseline_timings[name] > BENCHMARK_NOISE_FLOOR,
+                }
+            )
+    return comparison
+
+
+def print_comparison(comparison):
+    """Print a table of benchmark timings against the baseline.
+
+    Args:
+        comparison (list): rows made by compare_to_baseline
+    """
+    row_format = "{:>9}  {:<32}{:>10}{:>10}{:>8}  {}"
+    print(row_format.format("Size", "Benchmark", "Baseline", "Current", "Ratio", ""))
+    for row in comparison:
+        print(
+            row_format.format(
+                row["size"],
+                row["benchmark"],
+                "{:.3f}s".format(row["baseline"]),
+                "{:.3f}s".format(row["current"]),
+                "{:.2f}".format(row["ratio"]),
+                "REGRESSED" if row["regressed"] else "",
+            )
+        )
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes",
+        help="Numbers of synthetic package names to time the benchmarks on",
+        default=BENCHMARK_SIZES,
+        nargs="+",
+        type=int,
+    )
+    parser.add_argument(
+        "--targets",
+        help="Number of top packages to screen",
+        default=BENCHMARK_TARGETS,
+        type=int,
+    )
+    parser.add_argument(
+        "-e",
+        "--edit_distance",
+        help="Maximum edit distance to check for typosquatting",
+        default=MAX_DISTANCE,
+        type=int,
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Runs of each benchmark; the fastest is kept",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--baseline", help="Stored baseline timings", default=BENCHMARK_BASELINE
+    )
+    parser.add_argument(
+        "--save_baseline",
+        help="Store these timings as the new baseline instead of comparing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Share a timing may grow by before it counts as a regression",
+        default=BENCHMARK_TOLERANCE,
+        type=float,
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    cli_args = parse_args()
+    results = run_benchmarks(
+        cli_args.sizes, cli_args.targets, cli_args.edit_distance, cli_args.repeat
+    )
+
+    if cli_args.save_baseline or not os.path.exists(cli_args.baseline):
+        with open(cli_args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Stored benchmark timings as the baseline in " + cli_args.baseline)
+        sys.exit(0)
+
+    with open(cli_args.baseline, "r") as f:
+        baseline = json.load(f)
+    comparison = compare_to_baseline(results, baseline, cli_args.tolerance)
+    print_comparison(comparison)
+    # Fail so that scripts running the benchmarks notice regressions
+    if any(row["regressed"] for row in comparison):
+        sys.exit(1)
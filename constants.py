@@ -12,3 +12,115 @@ MAX_DISTANCE = 1
 
 # Minimum length of package name to be included for analysis
 MIN_LEN_PACKAGE_NAME = 5
+
+# Minimum number of packages to check before building a name index pays off
+MIN_TARGETS_FOR_INDEX = 10
+
+# Largest edit distance answered with a deletion index rather than a q-gram index
+DELETION_INDEX_MAX_DISTANCE = 1
+
+# Number of characters in each q-gram of a q-gram index
+QGRAM_SIZE = 2
+
+# Number of leading characters of each name stored in a deletion index
+DELETION_PREFIX_LEN = 7
+
+# Number of bytes to read at a time when streaming downloads
+CHUNK_SIZE = 64 * 1024
+
+# Folder in which downloaded pages are cached
+CACHE_FOLDER = "cache"
+
+# Seconds a cached download is used before checking PyPI for changes
+CACHE_MAX_AGE = 60 * 60
+
+# Package metadata fields compared between a package and a potential squatter
+METADATA_FIELDS = [
+    "author_email",
+    "author",
+    "package_url",
+    "description",
+    "home_page",
+    "summary",
+]
+
+# Metadata values that PyPI fills in for missing fields, treated as blank
+METADATA_BLANK_VALUES = ["", "UNKNOWN", "None"]
+
+# Seconds cached package metadata is used before downloading it again
+METADATA_CACHE_TTL = 60 * 60 * 24
+
+# Maximum bytes of package metadata kept in the on-disk cache
+METADATA_CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+# Number of packages whose metadata is also kept in memory
+METADATA_LRU_SIZE = 4096
+
+# Fewest potential typosquatters sharing an author email that are reported
+METADATA_CLUSTER_MIN_SIZE = 3
+
+# Table of a SQLite metadata dump that holds one row per release
+METADATA_DUMP_TABLE = "distribution_metadata"
+
+# Number of package metadata downloads to run at the same time
+METADATA_WORKERS = 16
+
+# Seconds to wait for PyPI to respond to a package metadata request
+METADATA_TIMEOUT = 10
+
+# PyPI XML-RPC endpoint that serves the changelog of package events
+PYPI_XMLRPC_URL = "https://pypi.org/pypi"
+
+# Number of shards of top packages given to each worker process
+SHARDS_PER_WORKER = 4
+
+# Most delta snapshots read in a row before a full snapshot is stored again
+SNAPSHOT_MAX_DELTA_DEPTH = 30
+
+# Screens that create_suspicious_package_dict runs on every package
+SCREENS = ["misspelling", "order", "homophone"]
+
+# Screens that can be chosen instead of SCREENS
+SCREEN_CHOICES = ["misspelling", "order", "homophone", "keyboard"]
+
+# Most package names whose keyboard typo variants are kept in memory
+KEYBOARD_VARIANT_CACHE_SIZE = 100000
+
+# Most package list changes patched into cached top-mods results
+RESULTS_CACHE_MAX_CHANGES = 50000
+
+# Localhost port on which the serve operation answers queries
+SERVE_PORT = 8765
+
+# Seconds between background refreshes of the serve operation's indexes
+SERVE_REFRESH_INTERVAL = 60 * 60
+
+# Rows written to the SQLite store in each transaction
+STORE_BATCH_SIZE = 10000
+
+# Seconds between polls of PyPI in watch mode
+WATCH_POLL_INTERVAL = 5 * 60
+
+# Seconds to wait after the first failed poll; doubles with each failure
+WATCH_RETRY_DELAY = 30
+
+# Longest wait between failed polls in watch mode
+WATCH_MAX_BACKOFF = 60 * 60
+
+# Ways of finding names within an edit distance; "auto" picks an index itself
+DISTANCE_BACKENDS = ["auto", "deletion", "qgram", "bk-tree", "numpy", "brute-force"]
+
+# Numbers of synthetic package names the benchmarks are timed on
+BENCHMARK_SIZES = [100000, 500000, 1000000]
+
+# Number of top packages screened by the benchmarks
+BENCHMARK_TARGETS = 10
+
+# Share a benchmark timing may grow by before it counts as a regression
+BENCHMARK_TOLERANCE = 0.25
+
+# Seconds a benchmark timing must grow by to count as a regression
+BENCHMARK_NOISE_FLOOR = 0.01
+
+# File the baseline benchmark timings are stored in
+BENCHMARK_BASELINE = "benchmark_baseline.json"
@@ -4,10 +4,16 @@ A module that contains all functions that filter data related to typosquatting
 data.
 """
 
+import fnmatch
+import os
+import re
+
 import jellyfish
 import Levenshtein
 
 import constants
+from indexes import canonical_name, name_token_bag, search_name_index
+from metrics import count_cache
 
 MAX_DISTANCE = constants.MAX_DISTANCE
 MIN_LEN_PACKAGE_NAME = constants.MIN_LEN_PACKAGE_NAME
@@ -26,17 +32,31 @@ def filter_by_package_name_len(package_list, min_len=MIN_LEN_PACKAGE_NAME):
     return [pkg for pkg in package_list if len(pkg) >= min_len]
 
 
-def distance_calculations(package_of_interest, all_packages, max_distance=MAX_DISTANCE):
+def distance_calculations(
+    package_of_interest, all_packages, max_distance=MAX_DISTANCE, name_index=None
+):
     """Find packages <= defined edit distance and return sorted list.
 
+    If a name index built over all_packages is supplied, the index is
+    queried instead of computing the distance to every package name.
+    Both paths return identical results.
+
     Args:
         package_of_interest (str): package name on which to perform comparison
         all_packages (list): list of all package names
         max_distance (int): the maximum distance that justifies reporting
+        name_index (dict): optional index over all_packages from indexes module
 
     Returns:
         list: potential typosquatters
     """
+    # Query the index, if available, rather than scanning every name
+    if name_index is not None:
+        close_packages = search_name_index(
+            name_index, package_of_interest, max_distance
+        )
+        return sorted(pkg for pkg in close_packages if pkg != package_of_interest)
+
     # Empty list to store similar package names
     similar_package_names = []
 
@@ -58,46 +78,49 @@ def distance_calculations(package_of_interest, all_packages, max_distance=MAX_DI
     return sorted(similar_package_names)
 
 
-def order_attack_screen(package, all_packages):
+def order_attack_screen(package, all_packages, token_index=None):
     """Find packages that prey on user confusion about order.
 
     This screen checks for attacks that prey on user confusion
     about word order. For instance, python-nmap vs nmap-python.
     The edit distance is very high, but the conceptual distance is
-    close. This function currently identifies only packages that
-    capitalize on user confusion about  word order when words are
-    separated by dashes or underscores.
+    close. This function identifies packages that reorder the words
+    of a name, swap the dashes, underscores or periods between them,
+    or both, for names with any number of words.
+
+    Without a token bag index, only names that contain the longest
+    word of the package are split into words, which is much cheaper
+    than building an index for a single package.
 
     Args:
         package (str): package name on which to perform comparison
         all_packages (list): list of all package names
+        token_index (dict): optional token bag index over all_packages
 
     Returns:
-        list: potential typosquatting packages
+        list: potential typosquatting packages, sorted alphabetically
     """
-    # Check if there is only one total dash or underscore
-    # TODO: Consider dealing with other cases (e.g. >=2 dashes)
-    squatters = []
-    if package.count("-") + package.count("_") == 1:
-        if package.count("-") == 1:
-            pkg_name_list = package.split("-")
-            reversed_name = pkg_name_list[1] + "-" + pkg_name_list[0]
-            switch_symbol = pkg_name_list[0] + "_" + pkg_name_list[1]
-            switch_symbol_reversed = pkg_name_list[1] + "_" + pkg_name_list[0]
-        else:
-            pkg_name_list = package.split("_")
-            reversed_name = pkg_name_list[1] + "_" + pkg_name_list[0]
-            switch_symbol = pkg_name_list[0] + "-" + pkg_name_list[1]
-            switch_symbol_reversed = pkg_name_list[1] + "-" + pkg_name_list[0]
-        # Check if each attack is contained in the full package list
-        for attack in [reversed_name, switch_symbol, switch_symbol_reversed]:
-            if attack in all_packages:
-                squatters.append(attack)
-
-    return squatters
-
-
-def homophone_attack_screen(package_of_interest, all_packages):
+    # Names with one word cannot be reordered
+    token_bag = name_token_bag(package)
+    if len(token_bag) < 2:
+        return []
+
+    # Every reordering and separator swap shares the same token bag
+    if token_index is not None:
+        same_bag_packages = token_index.get(token_bag, [])
+    else:
+        longest_token = max(token_bag, key=len)
+        same_bag_packages = [
+            pkg
+            for pkg in all_packages
+            if longest_token in pkg and name_token_bag(pkg) == token_bag
+        ]
+    squatters = [pkg for pkg in same_bag_packages if pkg != package]
+
+    return sorted(squatters)
+
+
+def homophone_attack_screen(package_of_interest, all_packages, metaphone_index=None):
     """Find packages that prey on homophone confusion.
 
     This screen checks for attacks that prey on user confusion
@@ -105,19 +128,29 @@ def homophone_attack_screen(package_of_interest, all_packages):
     This function helps find confusion attacks, rather than
     misspelling attacks.
 
+    If a metaphone index built over all_packages is supplied, the
+    matching names are looked up rather than recomputing the
+    metaphone code of every package name.
+
     Args:
         package (str): package name on which to perform comparison
         all_packages (list): list of all package names
+        metaphone_index (dict): optional metaphone code to names mapping
 
     Returns:
         list: potential typosquatting packages
     """
-    # Empty list to store similar package names
-    homophone_package_names = []
-
     # Calculate metaphone code for package of interest, only once
     package_of_interest_metaphone = jellyfish.metaphone(package_of_interest)
 
+    # Look up names sharing the code, if an index is available
+    if metaphone_index is not None:
+        same_code_packages = metaphone_index.get(package_of_interest_metaphone, [])
+        return [pkg for pkg in same_code_packages if pkg != package_of_interest]
+
+    # Empty list to store similar package names
+    homophone_package_names = []
+
     # Loop thru all package names
     for package in all_packages:
 
@@ -133,6 +166,137 @@ def homophone_attack_screen(package_of_interest, all_packages):
     return homophone_package_names
 
 
+def drop_equivalent_names(package, squatters):
+    """Drop names that PyPI treats as the same project.
+
+    Names are compared by their PEP 503 canonical name. Squatters
+    equivalent to the package itself are removed, and of several
+    equivalent squatters only the first is kept.
+
+    Args:
+        package (str): package name on which comparison was performed
+        squatters (list): potential typosquatting packages
+
+    Returns:
+        list: potential typosquatting packages, one per project, in order
+    """
+    seen_names = {canonical_name(package)}
+    unique_squatters = []
+    for squatter in squatters:
+        squatter_canonical = canonical_name(squatter)
+        if squatter_canonical not in seen_names:
+            seen_names.add(squatter_canonical)
+            unique_squatters.append(squatter)
+    return unique_squatters
+
+
+# Compiled whitelists already loaded in this process, keyed by file
+WHITELIST_CACHE = {}
+
+
+def compile_whitelist(lines):
+    """Compile whitelist entries into one matcher.
+
+    Each entry is a package name, a glob such as "django-*", or a
+    "package:squatter" pair that only whitelists the squatter of that
+    one package, whose squatter may also be a glob. Text after a "#" is
+    a comment. Names are compared by their PEP 503 canonical name.
+
+    Exact names and pairs are kept in sets, and every glob is compiled
+    into a single regular expression over "package:squatter" strings.
+
+    Args:
+        lines (iterable): whitelist entries, one per line
+
+    Returns:
+        dict: whitelist that is_whitelisted can query
+    """
+    names = set()
+    pairs = set()
+    patterns = []
+    for line in lines:
+        entry = line.split("#", 1)[0].strip()
+        if not entry:
+            continue
+        package, _, squatter = entry.rpartition(":")
+        package = canonical_name(package.strip())
+        squatter = canonical_name(squatter.strip())
+        if not any(char in squatter for char in "*?["):
+            if package:
+                pairs.add((package, squatter))
+            else:
+                names.add(squatter)
+        elif package:
+            patterns.append(re.escape(package) + ":" + fnmatch.translate(squatter))
+        else:
+            patterns.append("[^:]*:" + fnmatch.translate(squatter))
+
+    pattern = None
+    if patterns:
+        pattern = re.compile("|".join("(?:" + part + ")" for part in patterns))
+    return {"names": names, "pairs": pairs, "pattern": pattern}
+
+
+def load_whitelist(whitelist_filename="whitelist.txt"):
+    """Return the compiled whitelist of a file, compiling it only once.
+
+    The compiled whitelist is kept in memory until the file is modified.
+
+    Args:
+        whitelist_filename (str): file location for whitelist
+
+    Returns:
+        dict: whitelist made by compile_whitelist
+    """
+    modified = os.stat(whitelist_filename).st_mtime_ns
+    cached = WHITELIST_CACHE.get(whitelist_filename)
+    count_cache("whitelist", cached is not None and cached[0] == modified)
+    if cached is None or cached[0] != modified:
+        with open(whitelist_filename, "r") as file:
+            cached = (modified, compile_whitelist(file))
+        WHITELIST_CACHE[whitelist_filename] = cached
+    return cached[1]
+
+
+def is_whitelisted(compiled_whitelist, squatter, package=""):
+    """Check whether a potential typosquatter is whitelisted.
+
+    Args:
+        compiled_whitelist (dict): whitelist made by compile_whitelist
+        squatter (str): potential typosquatting package
+        package (str): package it may typosquat, if any
+
+    Returns:
+        bool: whether the squatter is whitelisted for the package
+    """
+    squatter = canonical_name(squatter)
+    package = canonical_name(package)
+    if squatter in compiled_whitelist["names"]:
+        return True
+    if (package, squatter) in compiled_whitelist["pairs"]:
+        return True
+    pattern = compiled_whitelist["pattern"]
+    return pattern is not None and bool(pattern.match(package + ":" + squatter))
+
+
+def drop_whitelisted(package, squatters, compiled_whitelist):
+    """Drop whitelisted names from the potential typosquatters of a package.
+
+    Args:
+        package (str): package name on which comparison was performed
+        squatters (list): potential typosquatting packages
+        compiled_whitelist (dict): whitelist made by compile_whitelist
+
+    Returns:
+        list: potential typosquatting packages that are not whitelisted, in order
+    """
+    return [
+        squatter
+        for squatter in squatters
+        if not is_whitelisted(compiled_whitelist, squatter, package)
+    ]
+
+
 def whitelist(squat_candidates, whitelist_filename="whitelist.txt"):
     """Remove whitelisted packages from typosquat candidate list.
 
@@ -143,19 +307,11 @@ def whitelist(squat_candidates, whitelist_filename="whitelist.txt"):
     Returns:
         dict: packages and post-whitelist potential typosquatters
     """
-    # Create whitelist
-    whitelist = []
-    with open(whitelist_filename, "r") as file:
-        for line in file:
-            # Strip out end of line character
-            whitelist.append(line.strip("\n"))
-
-    # Remove packages contained in whitelist
-    whitelist_set = set(whitelist)
+    compiled_whitelist = load_whitelist(whitelist_filename)
     for pkg in squat_candidates:
-        new_squat_candidates_set = set(squat_candidates[pkg]) - whitelist_set
-        new_squat_candidates_list = list(new_squat_candidates_set)
-        # Update typosquat candidate list
-        squat_candidates[pkg] = new_squat_candidates_list
+        # Update typosquat candidate list, keeping its order
+        squat_candidates[pkg] = drop_whitelisted(
+            pkg, squat_candidates[pkg], compiled_whitelist
+        )
 
     return squat_candidates
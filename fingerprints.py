@@ -0,0 +1,415 @@
+"""Keep a local table of package metadata fingerprints.
+
+A module that contains functions that store a hash of each compared
+metadata field of every package whose metadata has been retrieved, one
+column per field, and look up the packages sharing metadata with a
+given package or with each other without asking PyPI again. The table
+can also be filled in bulk from a local dump of PyPI metadata, so that
+metadata comparisons can run without network access.
+
+Rows are looked up by the PEP 503 canonical name of a package, so a
+dump that spells a name differently from the simple index still
+matches it.
+
+The table is saved next to the package list snapshots. The file starts
+with a JSON header line holding the package names, padded so that the
+columns after it stay aligned. The time each row was retrieved follows
+as an array of doubles, then one array of 64-bit field hashes per
+field. A blank field, or a placeholder such as UNKNOWN, hashes to 0, so
+blank fields never match.
+"""
+
+import array
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+from time import time
+
+import constants
+from indexes import canonical_name
+
+METADATA_BLANK_VALUES = constants.METADATA_BLANK_VALUES
+METADATA_DUMP_TABLE = constants.METADATA_DUMP_TABLE
+METADATA_FIELDS = constants.METADATA_FIELDS
+
+
+def field_hash(value):
+    """Hash one metadata field to a 64-bit integer.
+
+    Args:
+        value (str): field value
+
+    Returns:
+        int: hash of the value, or 0 if the value is blank or a placeholder
+    """
+    if not value or str(value).strip() in METADATA_BLANK_VALUES:
+        return 0
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    # Keep 0 for blank fields only
+    return int.from_bytes(digest, "little") or 1
+
+
+def new_fingerprint_table(fields=METADATA_FIELDS):
+    """Create an empty fingerprint table.
+
+    Args:
+        fields (list): metadata fields to fingerprint
+
+    Returns:
+        dict: table with a row per package and a column per field
+    """
+    return {
+        "fields": list(fields),
+        "names": [],
+        "positions": {},
+        "fetched_at": array.array("d"),
+        "columns": {field: array.array("Q") for field in fields},
+        "indexes": {},
+    }
+
+
+def update_fingerprint_table(fingerprints, metadata, fetched_at=None):
+    """Add or replace the rows of packages whose metadata was retrieved.
+
+    Packages whose fields are all blank, e.g. because their download
+    failed, are left out so that they are retrieved again next time.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        metadata (dict): package name (key) and package metadata (value),
+        as from get_metadata_concurrently
+        fetched_at (float): time the metadata was retrieved, by default now
+
+    Returns:
+        int: number of rows added or replaced
+    """
+    fetched_at = time() if fetched_at is None else fetched_at
+    updated = 0
+    for name, package_metadata in metadata.items():
+        hashes = [
+            field_hash(package_metadata["info"].get(field, ""))
+            for field in fingerprints["fields"]
+        ]
+        if any(hashes):
+            set_fingerprint_row(fingerprints, name, hashes, fetched_at)
+            updated += 1
+    return updated
+
+
+def set_fingerprint_row(fingerprints, name, hashes, fetched_at):
+    """Add or replace the row of one package.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        name (str): package name
+        hashes (list): field hashes, in the order of the table's fields
+        fetched_at (float): time the metadata was retrieved
+    """
+    canonical = canonical_name(name)
+    position = fingerprints["positions"].get(canonical)
+    if position is None:
+        fingerprints["positions"][canonical] = len(fingerprints["names"])
+        fingerprints["names"].append(name)
+        fingerprints["fetched_at"].append(fetched_at)
+        for field, value in zip(fingerprints["fields"], hashes):
+            fingerprints["columns"][field].append(value)
+    else:
+        fingerprints["fetched_at"][position] = fetched_at
+        for field, value in zip(fingerprints["fields"], hashes):
+            fingerprints["columns"][field][position] = value
+    # Field indexes are rebuilt on their next use
+    fingerprints["indexes"].clear()
+
+
+def fingerprint_position(fingerprints, name):
+    """Find the row of a package, however its name is spelled.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        name (str): package name
+
+    Returns:
+        int: position of the package's row, or None if it has none
+    """
+    return fingerprints["positions"].get(canonical_name(name))
+
+
+def save_fingerprint_table(fingerprints, folder="package_lists"):
+    """Write a fingerprint table next to the package list snapshots.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        folder (str): folder in which the table is stored
+    """
+    path = os.path.join(folder, "pypi-metadata-fingerprints.bin")
+    header = {
+        "format": "fingerprints",
+        "byteorder": sys.byteorder,
+        "fields": fingerprints["fields"],
+        "blank_values": METADATA_BLANK_VALUES,
+        "names": fingerprints["names"],
+    }
+    header_line = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    header_line += b" " * (-(len(header_line) + 1) % 8) + b"\n"
+
+    os.makedirs(folder, exist_ok=True)
+    with open(path + ".part", "wb") as f:
+        f.write(header_line)
+        f.write(fingerprints["fetched_at"])
+        for field in fingerprints["fields"]:
+            f.write(fingerprints["columns"][field])
+    os.replace(path + ".part", path)
+
+
+def load_fingerprint_table(folder="package_lists", fields=METADATA_FIELDS):
+    """Read the stored fingerprint table, or start an empty one.
+
+    A stored table of other fields than those asked for is discarded,
+    since its rows cannot answer comparisons of the new fields, and so
+    is a table that hashed other values than METADATA_BLANK_VALUES as
+    blank, since its placeholder values would match each other.
+
+    Args:
+        folder (str): folder in which the table is stored
+        fields (list): metadata fields to fingerprint
+
+    Returns:
+        dict: table made by new_fingerprint_table
+    """
+    path = os.path.join(folder, "pypi-metadata-fingerprints.bin")
+    fingerprints = new_fingerprint_table(fields)
+    if not os.path.exists(path):
+        return fingerprints
+
+    with open(path, "rb") as f:
+        header = json.loads(f.readline())
+        if (
+            header["fields"] != fingerprints["fields"]
+            or header.get("blank_values") != METADATA_BLANK_VALUES
+        ):
+            return fingerprints
+        count = len(header["names"])
+        fingerprints["fetched_at"].frombytes(f.read(8 * count))
+        for field in fingerprints["fields"]:
+            fingerprints["columns"][field].frombytes(f.read(8 * count))
+
+    if header["byteorder"] != sys.byteorder:
+        fingerprints["fetched_at"].byteswap()
+        for column in fingerprints["columns"].values():
+            column.byteswap()
+    fingerprints["names"] = header["names"]
+    fingerprints["positions"] = {
+        canonical_name(name): position for position, name in enumerate(header["names"])
+    }
+    return fingerprints
+
+
+def fresh_packages(fingerprints, names, max_age):
+    """Find packages whose fingerprints are recent enough to use.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        names (iterable): package names to look for
+        max_age (float): seconds a row is used before it is retrieved again
+
+    Returns:
+        set: names with a row younger than max_age
+    """
+    now = time()
+    fresh = set()
+    for name in names:
+        position = fingerprint_position(fingerprints, name)
+        if (
+            position is not None
+            and now - fingerprints["fetched_at"][position] < max_age
+        ):
+            fresh.add(name)
+    return fresh
+
+
+def fingerprint_risk(fingerprints, pkg1, pkg2):
+    """Compare the fingerprints of two packages.
+
+    Packages without a row are treated as having only blank fields, as
+    PyPI returns for packages that do not exist.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        pkg1 (str): name of first package to compare
+        pkg2 (str): name of second package to compare
+
+    Returns:
+        str: a value of "no_risk" or "some_risk", as from metadata_risk
+    """
+    position1 = fingerprint_position(fingerprints, pkg1)
+    position2 = fingerprint_position(fingerprints, pkg2)
+    if position1 is None or position2 is None:
+        return "no_risk"
+    for column in fingerprints["columns"].values():
+        if column[position1] and column[position1] == column[position2]:
+            return "some_risk"
+    return "no_risk"
+
+
+def field_index(fingerprints, field):
+    """Group the rows of a fingerprint table by the hash of one field.
+
+    The index is built on first use and kept until the table changes.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        field (str): metadata field to group by
+
+    Returns:
+        dict: field hash (key) and positions of rows with that hash (value)
+    """
+    if field not in fingerprints["indexes"]:
+        index = {}
+        for position, value in enumerate(fingerprints["columns"][field]):
+            if value:
+                index.setdefault(value, []).append(position)
+        fingerprints["indexes"][field] = index
+    return fingerprints["indexes"][field]
+
+
+def shared_metadata_packages(fingerprints, package):
+    """Find every package sharing a metadata field with a package.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        package (str): package name to look up
+
+    Returns:
+        dict: field (key) and other packages with the same value (value),
+        for fields with at least one match
+    """
+    position = fingerprint_position(fingerprints, package)
+    if position is None:
+        return {}
+    shared = {}
+    for field in fingerprints["fields"]:
+        value = fingerprints["columns"][field][position]
+        if not value:
+            continue
+        names = [
+            fingerprints["names"][other]
+            for other in field_index(fingerprints, field)[value]
+            if other != position
+        ]
+        if names:
+            shared[field] = names
+    return shared
+
+
+def metadata_clusters(fingerprints, names=None, field="author_email", min_size=2):
+    """Group packages that share one value of a metadata field.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        names (iterable): only cluster these packages, by default all
+        field (str): metadata field to group by
+        min_size (int): fewest packages a cluster may have
+
+    Returns:
+        list: clusters of package names, sorted, largest cluster first
+    """
+    if names is None:
+        positions = range(len(fingerprints["names"]))
+    else:
+        positions = {fingerprint_position(fingerprints, name) for name in names}
+        positions.discard(None)
+    column = fingerprints["columns"][field]
+    clusters = {}
+    for position in positions:
+        if column[position]:
+            clusters.setdefault(column[position], []).append(
+                fingerprints["names"][position]
+            )
+    return sorted(
+        (sorted(cluster) for cluster in clusters.values() if len(cluster) >= min_size),
+        key=lambda cluster: (-len(cluster), cluster),
+    )
+
+
+def iter_metadata_dump(path, table=METADATA_DUMP_TABLE):
+    """Read package metadata records from a local dump.
+
+    A dump is either a JSON Lines file or a SQLite database. Each JSON
+    line is a PyPI JSON API response, with the fields under "info", or
+    a flat row with a "name" column, like a BigQuery export. A SQLite
+    dump holds flat rows in the given table.
+
+    Args:
+        path (str): dump file, ending in .jsonl, .json, .db or .sqlite
+        table (str): table of a SQLite dump holding the rows
+
+    Yields:
+        dict: flat record with the package name, metadata fields and,
+        if the dump has one, the upload time
+    """
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        # Table names cannot be query parameters, so only allow identifiers
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", table):
+            raise ValueError("Invalid SQLite table name: " + table)
+        connection = sqlite3.connect(path)
+        connection.row_factory = sqlite3.Row
+        try:
+            for row in connection.execute("SELECT * FROM " + table):  # nosec
+                yield dict(row)
+        finally:
+            connection.close()
+        return
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "info" in record:
+                info = dict(record["info"])
+                info.setdefault("upload_time", record.get("upload_time"))
+                record = info
+            yield record
+
+
+def ingest_metadata_dump(
+    fingerprints, path, table=METADATA_DUMP_TABLE, fetched_at=None
+):
+    """Fill a fingerprint table from a local dump of PyPI metadata.
+
+    Dumps often hold one row per release. Only the fields are hashed as
+    each row is read, and the row with the latest upload time of each
+    package is kept, or the last row if the dump has no upload times.
+
+    Args:
+        fingerprints (dict): table made by new_fingerprint_table
+        path (str): dump file, as read by iter_metadata_dump
+        table (str): table of a SQLite dump holding the rows
+        fetched_at (float): time to record for the rows, by default now
+
+    Returns:
+        int: number of packages added or replaced
+    """
+    fetched_at = time() if fetched_at is None else fetched_at
+    latest_rows = {}
+    for record in iter_metadata_dump(path, table):
+        name = record.get("name")
+        if not name:
+            continue
+        upload_time = str(record.get("upload_time") or "")
+        canonical = canonical_name(name)
+        latest = latest_rows.get(canonical)
+        if latest is not None and upload_time < latest[0]:
+            continue
+        hashes = [field_hash(record.get(field)) for field in fingerprints["fields"]]
+        latest_rows[canonical] = (upload_time, name, hashes)
+
+    updated = 0
+    for _, name, hashes in latest_rows.values():
+        if any(hashes):
+            set_fingerprint_row(fingerprints, name, hashes, fetched_at)
+            updated += 1
+    return updated
@@ -0,0 +1,997 @@
+"""Build and query indexes over PyPI package names.
+
+A module that contains functions that arrange the full list of package
+names into data structures that can answer "which names are close to
+this one?" without comparing against every name on PyPI.
+
+Every index is a plain dict with a "kind" key so that callers can pass
+any index to search_name_index and let this module pick the right
+search routine.
+"""
+
+import array
+import bisect
+import collections
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+
+import jellyfish
+import Levenshtein
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the numpy backend
+    np = None
+
+import constants
+from metrics import count_cache
+
+DELETION_PREFIX_LEN = constants.DELETION_PREFIX_LEN
+DELETION_INDEX_MAX_DISTANCE = constants.DELETION_INDEX_MAX_DISTANCE
+QGRAM_SIZE = constants.QGRAM_SIZE
+
+
+def build_bk_tree(package_names):
+    """Build a BK-tree over package names.
+
+    A BK-tree labels each edge with the edit distance between a parent
+    name and its child. Because edit distance obeys the triangle
+    inequality, a search only needs to descend into children whose
+    edge label is within max_distance of the distance to the parent.
+
+    The tree is stored as flat lists rather than nested dicts so that
+    deep trees never hit the recursion limit. Duplicate names are
+    counted rather than stored twice.
+
+    Args:
+        package_names (list): package names to index
+
+    Returns:
+        dict: BK-tree with parallel "names", "counts" and "children" lists
+    """
+    bk_tree = {"kind": "bk_tree", "names": [], "counts": [], "children": []}
+    return update_bk_tree(bk_tree, package_names, [])
+
+
+def update_bk_tree(bk_tree, added_packages, removed_packages):
+    """Patch a BK-tree in place with names added and removed.
+
+    A removed name keeps its node, since its children hang off it, but
+    its count drops so that searches no longer report it.
+
+    Args:
+        bk_tree (dict): BK-tree built by build_bk_tree
+        added_packages (iterable): names to add to the tree
+        removed_packages (iterable): names to drop from the tree
+
+    Returns:
+        dict: the updated BK-tree
+    """
+    names = bk_tree["names"]
+    counts = bk_tree["counts"]
+    children = bk_tree["children"]
+
+    for package in removed_packages:
+        node = 0 if names else None
+        while node is not None:
+            distance = Levenshtein.distance(package, names[node])
+            if distance == 0:
+                counts[node] = max(counts[node] - 1, 0)
+                break
+            node = children[node].get(distance)
+
+    for package in added_packages:
+        # The first name becomes the root
+        if not names:
+            names.append(package)
+            counts.append(1)
+            children.append({})
+            continue
+
+        # Walk down the tree until an empty edge is found
+        node = 0
+        while True:
+            distance = Levenshtein.distance(package, names[node])
+            if distance == 0:
+                counts[node] += 1
+                break
+            child = children[node].get(distance)
+            if child is None:
+                children[node][distance] = len(names)
+                names.append(package)
+                counts.append(1)
+                children.append({})
+                break
+            node = child
+
+    return bk_tree
+
+
+def search_bk_tree(bk_tree, package_of_interest, max_distance):
+    """Find all names in a BK-tree within an edit distance.
+
+    Args:
+        bk_tree (dict): BK-tree built by build_bk_tree
+        package_of_interest (str): package name on which to perform comparison
+        max_distance (int): the maximum distance that justifies reporting
+
+    Returns:
+        list: names within max_distance, including package_of_interest
+        itself if it was indexed
+    """
+    names = bk_tree["names"]
+    counts = bk_tree["counts"]
+    children = bk_tree["children"]
+
+    matches = []
+    if not names:
+        return matches
+
+    # Use an explicit stack instead of recursion
+    nodes_to_visit = [0]
+    while nodes_to_visit:
+        node = nodes_to_visit.pop()
+        distance = Levenshtein.distance(package_of_interest, names[node])
+        if distance <= max_distance:
+            matches.extend([names[node]] * counts[node])
+        # Triangle inequality: only these edges can lead to matches
+        for edge, child in children[node].items():
+            if distance - max_distance <= edge <= distance + max_distance:
+                nodes_to_visit.append(child)
+
+    return matches
+
+
+def deletion_variants(name, max_deletions):
+    """Generate every string reachable by deleting characters from a name.
+
+    Args:
+        name (str): string from which to delete characters
+        max_deletions (int): the maximum number of characters to delete
+
+    Returns:
+        set: variants, including the unmodified name
+    """
+    variants = {name}
+    frontier = {name}
+    for _ in range(max_deletions):
+        next_frontier = set()
+        for variant in frontier:
+            for i in range(len(variant)):
+                next_frontier.add(variant[:i] + variant[i + 1 :])
+        variants |= next_frontier
+        frontier = next_frontier
+    return variants
+
+
+def build_deletion_index(package_names, max_distance, prefix_len=DELETION_PREFIX_LEN):
+    """Build a symmetric deletion index over package names.
+
+    Two names within edit distance k always share a string that can be
+    reached by deleting at most k characters from each. Indexing the
+    deletion variants of every name turns a search into a handful of
+    dict lookups followed by exact verification of the few candidates.
+
+    As in SymSpell, only the first prefix_len characters of each name
+    are indexed, which keeps the index size bounded for long names.
+    The search compensates by probing several prefix lengths of the
+    package of interest, so no match is lost.
+
+    Args:
+        package_names (list): package names to index
+        max_distance (int): the largest edit distance the index can answer
+        prefix_len (int): number of leading characters to index
+
+    Returns:
+        dict: deletion index mapping each variant to name positions
+    """
+    deletion_index = {
+        "kind": "deletion",
+        "max_distance": max_distance,
+        "prefix_len": prefix_len,
+        "names": [],
+        "variants": {},
+    }
+    return update_deletion_index(deletion_index, package_names, [])
+
+
+def update_deletion_index(deletion_index, added_packages, removed_packages):
+    """Patch a deletion index in place with names added and removed.
+
+    Added names take new positions at the end of the index. A removed
+    name is dropped from every variant that points at it and leaves an
+    unused position behind, so the other positions stay valid.
+
+    Args:
+        deletion_index (dict): index built by build_deletion_index
+        added_packages (iterable): names to add to the index
+        removed_packages (iterable): names to drop from the index
+
+    Returns:
+        dict: the updated deletion index
+    """
+    names = deletion_index["names"]
+    variants = deletion_index["variants"]
+    max_distance = deletion_index["max_distance"]
+    prefix_len = deletion_index["prefix_len"]
+
+    for package in removed_packages:
+        # Every position of a name is listed under its unmodified prefix
+        position = next(
+            (p for p in variants.get(package[:prefix_len], ()) if names[p] == package),
+            None,
+        )
+        if position is None:
+            continue
+        for variant in deletion_variants(package[:prefix_len], max_distance):
+            positions = variants[variant]
+            positions.remove(position)
+            # Drop variants with no names left to keep the index compact
+            if not positions:
+                del variants[variant]
+        names[position] = None
+
+    for package in added_packages:
+        position = len(names)
+        names.append(package)
+        for variant in deletion_variants(package[:prefix_len], max_distance):
+            positions = variants.get(variant)
+            if positions is None:
+                variants[variant] = [position]
+            else:
+                positions.append(position)
+
+    return deletion_index
+
+
+def search_deletion_index(deletion_index, package_of_interest, max_distance):
+    """Find all names in a deletion index within an edit distance.
+
+    An optimal alignment of two names maps the indexed prefix of one
+    onto a prefix of the other that is at most max_distance characters
+    longer or shorter, so each of those prefix lengths is probed.
+
+    Args:
+        deletion_index (dict): index built by build_deletion_index
+        package_of_interest (str): package name on which to perform comparison
+        max_distance (int): the maximum distance that justifies reporting
+
+    Returns:
+        list: names within max_distance, including package_of_interest
+        itself if it was indexed
+    """
+    if max_distance > deletion_index["max_distance"]:
+        raise ValueError(
+            "Deletion index was built for a maximum edit distance of "
+            + str(deletion_index["max_distance"])
+        )
+    names = deletion_index["names"]
+    variants = deletion_index["variants"]
+    prefix_len = deletion_index["prefix_len"]
+
+    # Collect candidate positions that share any deletion variant
+    candidates = set()
+    probes = set()
+    for length in range(
+        max(prefix_len - max_distance, 0), prefix_len + max_distance + 1
+    ):
+        probes |= deletion_variants(package_of_interest[:length], max_distance)
+    for probe in probes:
+        candidates.update(variants.get(probe, ()))
+
+    # Verify candidates with the exact edit distance
+    target_len = len(package_of_interest)
+    matches = []
+    for position in sorted(candidates):
+        package = names[position]
+        if abs(len(package) - target_len) > max_distance:
+            continue
+        if Levenshtein.distance(package_of_interest, package) <= max_distance:
+            matches.append(package)
+
+    return matches
+
+
+def build_numpy_index(package_names):
+    """Encode package names into length-bucketed NumPy arrays.
+
+    Names of the same length are stacked into one integer array of
+    character codes, so one package of interest can be compared against
+    a whole bucket of names with a few array operations per character.
+
+    Args:
+        package_names (list): package names to index
+
+    Returns:
+        dict: names and character code arrays, both keyed by name length
+    """
+    if np is None:
+        raise ImportError("The numpy backend requires numpy to be installed")
+
+    names = {}
+    for package in package_names:
+        names.setdefault(len(package), []).append(package)
+
+    codes = {}
+    for length, same_length_names in names.items():
+        encoded = "".join(same_length_names).encode("utf-32-le")
+        codes[length] = np.frombuffer(encoded, dtype=np.uint32).reshape(
+            len(same_length_names), length
+        )
+
+    return {"kind": "numpy", "names": names, "codes": codes}
+
+
+def bounded_distances(target_codes, bucket_codes, max_distance):
+    """Find rows of a bucket within an edit distance of a target.
+
+    This runs the Levenshtein dynamic program for every name in the
+    bucket at once, one target character per step. Only cells within
+    max_distance of the diagonal are computed, values are capped at
+    max_distance + 1, and names whose whole row exceeds max_distance are
+    dropped as soon as that happens.
+
+    Args:
+        target_codes (numpy.ndarray): character codes of the package of interest
+        bucket_codes (numpy.ndarray): character codes of same-length names, one per row
+        max_distance (int): the maximum distance that justifies reporting
+
+    Returns:
+        numpy.ndarray: positions of the rows within max_distance
+    """
+    num_names, length = bucket_codes.shape
+    cap = max_distance + 1
+    alive = np.arange(num_names)
+    codes = bucket_codes
+
+    # Distances from the empty prefix of the target
+    previous = np.minimum(np.arange(length + 1, dtype=np.int32), cap)
+    previous = np.tile(previous, (num_names, 1))
+
+    for i in range(1, len(target_codes) + 1):
+        current = np.full_like(previous, cap)
+        current[:, 0] = min(i, cap)
+        # Cells further than max_distance from the diagonal always exceed it
+        for j in range(max(1, i - max_distance), min(length, i + max_distance) + 1):
+            substitution = previous[:, j - 1] + (codes[:, j - 1] != target_codes[i - 1])
+            insertion_deletion = np.minimum(previous[:, j], current[:, j - 1]) + 1
+            current[:, j] = np.minimum(
+                np.minimum(substitution, insertion_deletion), cap
+            )
+
+        # Stop tracking names that can no longer be within max_distance
+        keep = current.min(axis=1) <= max_distance
+        if not keep.all():
+            current = current[keep]
+            codes = codes[keep]
+            alive = alive[keep]
+            if alive.size == 0:
+                return alive
+        previous = current
+
+    return alive[previous[:, length] <= max_distance]
+
+
+def search_numpy_index(numpy_index, package_of_interest, max_distance):
+    """Find all names in a NumPy index within an edit distance.
+
+    Buckets whose name length differs from the package of interest by
+    more than max_distance cannot hold a match and are skipped.
+
+    Args:
+        numpy_index (dict): index built by build_numpy_index
+        package_of_interest (str): package name on which to perform comparison
+        max_distance (int): the maximum distance that justifies reporting
+
+    Returns:
+        list: names within max_distance, including package_of_interest
+        itself if it was indexed
+    """
+    target_len = len(package_of_interest)
+    target_codes = np.frombuffer(
+        package_of_interest.encode("utf-32-le"), dtype=np.uint32
+    )
+
+    matches = []
+    for length in range(target_len - max_distance, target_len + max_distance + 1):
+        if length not in numpy_index["names"]:
+            continue
+        positions = bounded_distances(
+            target_codes, numpy_index["codes"][length], max_distance
+        )
+        same_length_names = numpy_index["names"][length]
+        matches.extend(same_length_names[position] for position in positions)
+
+    return matches
+
+
+def qgrams(package_name, q=QGRAM_SIZE):
+    """Split a package name into its q-grams.
+
+    Names are padded so that their first and last characters appear in
+    as many q-grams as the others. Repeated q-grams are numbered by
+    occurrence, which turns the multiset of q-grams into a set that
+    can be counted through an inverted index.
+
+    Args:
+        package_name (str): name to split
+        q (int): number of characters in each q-gram
+
+    Returns:
+        list: len(package_name) + q - 1 numbered q-grams
+    """
+    padded = "\0" * (q - 1) + package_name + "\0" * (q - 1)
+    occurrences = {}
+    grams = []
+    for start in range(len(padded) - q + 1):
+        gram = padded[start : start + q]
+        occurrence = occurrences.get(gram, 0)
+        occurrences[gram] = occurrence + 1
+        grams.append(gram + str(occurrence))
+    return grams
+
+
+def build_qgram_index(package_names, q=QGRAM_SIZE):
+    """Build an inverted index from q-grams to the names containing them.
+
+    Names are numbered in order of length, so the names of any range of
+    lengths are a contiguous range of ids. A name listed more than once
+    gets an id each time, so searches report it as often as a scan of
+    the list does. Everything is stored in flat
+    arrays: posting lists are slices of one array of ids, and names are
+    slices of one UTF-8 blob, so the index can be written to disk and
+    memory-mapped by save_qgram_index and load_qgram_index.
+
+    Args:
+        package_names (list): package names to index
+        q (int): number of characters in each q-gram
+
+    Returns:
+        dict: q-gram index that search_qgram_index can query
+    """
+    names = sorted(package_names, key=lambda package: (len(package), package))
+
+    postings_by_gram = collections.defaultdict(lambda: array.array("I"))
+    for package_id, package in enumerate(names):
+        for gram in qgrams(package, q):
+            postings_by_gram[gram].append(package_id)
+
+    grams = {}
+    postings = array.array("I")
+    for gram, package_ids in postings_by_gram.items():
+        grams[gram] = [len(postings), len(postings) + len(package_ids)]
+        postings.extend(package_ids)
+
+    # length_starts[n] is the id of the first name at least n characters long
+    length_starts = []
+    for package_id, package in enumerate(names):
+        while len(length_starts) <= len(package):
+            length_starts.append(package_id)
+    length_starts.append(len(names))
+
+    encoded_names = [package.encode("utf-8") for package in names]
+    name_offsets = array.array("I", [0])
+    for encoded in encoded_names:
+        name_offsets.append(name_offsets[-1] + len(encoded))
+
+    return {
+        "kind": "qgram",
+        "q": q,
+        "grams": grams,
+        "length_starts": length_starts,
+        "postings": memoryview(postings),
+        "name_offsets": memoryview(name_offsets),
+        "names": memoryview(b"".join(encoded_names)),
+    }
+
+
+def search_qgram_index(qgram_index, package_of_interest, max_distance):
+    """Find all names in a q-gram index within an edit distance.
+
+    Only names whose length is within max_distance of the package of
+    interest are considered. Each edit destroys at most q of the
+    q-grams, so names within max_distance share at least
+    len(package_of_interest) + q - 1 - max_distance * q q-grams with
+    it. Names below that count are skipped and the rest are verified
+    with an exact edit distance. Targets too short for the count to
+    rule anything out are compared with every name of a suitable length.
+
+    Args:
+        qgram_index (dict): index built by build_qgram_index or load_qgram_index
+        package_of_interest (str): package name on which to perform comparison
+        max_distance (int): the maximum distance that justifies reporting
+
+    Returns:
+        list: names within max_distance, including package_of_interest
+        itself if it was indexed
+    """
+    q = qgram_index["q"]
+    length_starts = qgram_index["length_starts"]
+    postings = qgram_index["postings"]
+    name_offsets = qgram_index["name_offsets"]
+    names = qgram_index["names"]
+
+    # Ids of names with a length that could be within max_distance
+    target_len = len(package_of_interest)
+    longest = len(length_starts) - 1
+    first_id = length_starts[min(max(target_len - max_distance, 0), longest)]
+    end_id = length_starts[min(target_len + max_distance + 1, longest)]
+
+    min_common = target_len + q - 1 - max_distance * q
+    if min_common <= 0:
+        candidates = range(first_id, end_id)
+    else:
+        counts = collections.Counter()
+        for gram in qgrams(package_of_interest, q):
+            if gram not in qgram_index["grams"]:
+                continue
+            start, end = qgram_index["grams"][gram]
+            # Posting lists are sorted, so names of suitable length are a slice
+            package_ids = postings[start:end]
+            low = bisect.bisect_left(package_ids, first_id)
+            high = bisect.bisect_left(package_ids, end_id)
+            counts.update(package_ids[low:high])
+        candidates = [
+            package_id for package_id, count in counts.items() if count >= min_common
+        ]
+
+    matches = []
+    for package_id in candidates:
+        package = str(
+            names[name_offsets[package_id] : name_offsets[package_id + 1]], "utf-8"
+        )
+        if Levenshtein.distance(package_of_interest, package) <= max_distance:
+            matches.append(package)
+    return matches
+
+
+def save_qgram_index(qgram_index, path, digest):
+    """Write a q-gram index to a file that load_qgram_index can map.
+
+    The file starts with a JSON header line holding the q-gram table,
+    padded so that the arrays after it stay aligned. The posting ids,
+    name offsets and name blob follow as raw bytes. The file is written
+    under a temporary name and moved into place, so processes mapping
+    the previous index are never handed a partial file.
+
+    Args:
+        qgram_index (dict): index built by build_qgram_index
+        path (str): file to write the index to
+        digest (str): snapshot digest of the indexed names
+    """
+    header = {
+        "digest": digest,
+        "q": qgram_index["q"],
+        "byteorder": sys.byteorder,
+        "grams": qgram_index["grams"],
+        "length_starts": qgram_index["length_starts"],
+        "postings_count": len(qgram_index["postings"]),
+        "name_count": len(qgram_index["name_offsets"]) - 1,
+    }
+    header_line = json.dumps(header).encode("utf-8")
+    header_line += b" " * (-(len(header_line) + 1) % 4) + b"\n"
+
+    with open(path + ".part", "wb") as f:
+        f.write(header_line)
+        f.write(qgram_index["postings"])
+        f.write(qgram_index["name_offsets"])
+        f.write(qgram_index["names"])
+    os.replace(path + ".part", path)
+
+
+def load_qgram_index(path):
+    """Memory-map a q-gram index written by save_qgram_index.
+
+    The arrays are left in the mapped file, so loading costs only the
+    header, and processes that map the same file share its pages.
+
+    Args:
+        path (str): file the index was written to
+
+    Returns:
+        tuple: header of the file and the q-gram index
+    """
+    with open(path, "rb") as f:
+        header_line = f.readline()
+        buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    header = json.loads(header_line)
+
+    # Slice the arrays that follow the header out of the mapped file
+    postings_start = len(header_line)
+    offsets_start = postings_start + 4 * header["postings_count"]
+    names_start = offsets_start + 4 * (header["name_count"] + 1)
+    qgram_index = {
+        "kind": "qgram",
+        "q": header["q"],
+        "grams": header["grams"],
+        "length_starts": header["length_starts"],
+        "postings": buffer[postings_start:offsets_start].cast("I"),
+        "name_offsets": buffer[offsets_start:names_start].cast("I"),
+        "names": buffer[names_start:],
+    }
+    return header, qgram_index
+
+
+def get_qgram_index(package_names, folder="package_lists", q=QGRAM_SIZE):
+    """Map the stored q-gram index for a snapshot, building it if stale.
+
+    The index is saved next to the package list snapshots and built only
+    once per snapshot. Later scans, and every worker process of a
+    parallel scan, map the stored file instead of building their own.
+
+    Args:
+        package_names (list): package names in the current snapshot
+        folder (str): folder in which the index is stored
+        q (int): number of characters in each q-gram
+
+    Returns:
+        dict: q-gram index that search_qgram_index can query
+    """
+    digest = snapshot_digest(package_names)
+    path = os.path.join(folder, "pypi-qgram-index.bin")
+
+    if os.path.exists(path):
+        header, qgram_index = load_qgram_index(path)
+        if (header["digest"], header["q"], header["byteorder"]) == (
+            digest,
+            q,
+            sys.byteorder,
+        ):
+            count_cache("qgram_index", True)
+            return qgram_index
+
+    count_cache("qgram_index", False)
+    save_qgram_index(build_qgram_index(package_names, q), path, digest)
+    return load_qgram_index(path)[1]
+
+
+# Map each index kind to the function that searches it
+SEARCH_FUNCTIONS = {
+    "bk_tree": search_bk_tree,
+    "deletion": search_deletion_index,
+    "qgram": search_qgram_index,
+    "numpy": search_numpy_index,
+}
+
+
+def search_name_index(name_index, package_of_interest, max_distance):
+    """Find all indexed names within an edit distance of a package.
+
+    Args:
+        name_index (dict): any index built by this module
+        package_of_interest (str): package name on which to perform comparison
+        max_distance (int): the maximum distance that justifies reporting
+
+    Returns:
+        list: names within max_distance, in no particular order
+    """
+    search_function = SEARCH_FUNCTIONS[name_index["kind"]]
+    return search_function(name_index, package_of_interest, max_distance)
+
+
+def choose_backend(max_distance, backend="auto"):
+    """Resolve the "auto" edit distance backend for a distance.
+
+    Deletion indexes answer small edit distances with a few lookups but
+    grow quickly with the distance, so larger distances use a q-gram
+    index, whose size does not depend on the distance.
+
+    Args:
+        max_distance (int): the maximum edit distance that will be searched
+        backend (str): requested backend
+
+    Returns:
+        str: backend to build
+    """
+    if backend != "auto":
+        return backend
+    if max_distance <= DELETION_INDEX_MAX_DISTANCE:
+        return "deletion"
+    return "qgram"
+
+
+def build_name_index(package_names, max_distance, backend="auto"):
+    """Build a name index with the chosen edit distance backend.
+
+    Args:
+        package_names (list): package names to index
+        max_distance (int): the maximum edit distance that will be searched
+        backend (str): "auto", "deletion", "qgram", "bk-tree" or "numpy"
+
+    Returns:
+        dict: name index that search_name_index can query
+    """
+    backend = choose_backend(max_distance, backend)
+    if backend == "deletion":
+        return build_deletion_index(package_names, max_distance)
+    if backend == "qgram":
+        return build_qgram_index(package_names)
+    if backend == "bk-tree":
+        return build_bk_tree(package_names)
+    if backend == "numpy":
+        return build_numpy_index(package_names)
+    raise ValueError("Unknown edit distance backend: " + backend)
+
+
+# Map each index kind that can be patched to the function that patches it
+UPDATE_FUNCTIONS = {"bk_tree": update_bk_tree, "deletion": update_deletion_index}
+
+
+def update_name_index(name_index, added_packages, removed_packages):
+    """Patch a name index in place with names added and removed.
+
+    Only BK-trees and deletion indexes can be patched. Q-gram and numpy
+    indexes are packed into arrays and have to be rebuilt.
+
+    Args:
+        name_index (dict): index built by build_name_index
+        added_packages (iterable): names to add to the index
+        removed_packages (iterable): names to drop from the index
+
+    Returns:
+        dict: the updated name index
+    """
+    update_function = UPDATE_FUNCTIONS.get(name_index["kind"])
+    if update_function is None:
+        raise ValueError("Cannot update a " + name_index["kind"] + " index")
+    return update_function(name_index, added_packages, removed_packages)
+
+
+def snapshot_digest(package_names):
+    """Compute a digest that identifies a package list snapshot.
+
+    Names are sorted first so that a list and a set holding the same
+    names produce the same digest.
+
+    Args:
+        package_names (list): package names in the snapshot
+
+    Returns:
+        str: hex digest that changes whenever the list of names changes
+    """
+    digest = hashlib.sha256()
+    for package in sorted(package_names):
+        digest.update(package.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+# Name indexes already built in this process, keyed by snapshot
+NAME_INDEX_CACHE = {}
+
+
+def get_name_index(package_names, max_distance, backend="auto"):
+    """Return a name index for a snapshot, building it only once.
+
+    Indexes are kept in memory keyed by the snapshot digest, the edit
+    distance and the backend, so every scan of the same package list
+    shares one index. Q-gram indexes are also stored on disk by
+    get_qgram_index, since they can be mapped rather than loaded. The
+    other indexes are faster to rebuild than to load, so they are not
+    written out.
+
+    Args:
+        package_names (list): package names to index
+        max_distance (int): the maximum edit distance that will be searched
+        backend (str): "auto", "deletion", "qgram", "bk-tree" or "numpy"
+
+    Returns:
+        dict: name index that search_name_index can query
+    """
+    key = (snapshot_digest(package_names), max_distance, backend)
+    count_cache("name_index", key in NAME_INDEX_CACHE)
+    if key not in NAME_INDEX_CACHE:
+        # Keep only the most recent snapshot to bound memory use
+        NAME_INDEX_CACHE.clear()
+        if choose_backend(max_distance, backend) == "qgram":
+            NAME_INDEX_CACHE[key] = get_qgram_index(package_names)
+        else:
+            NAME_INDEX_CACHE[key] = build_name_index(
+                package_names, max_distance, backend
+            )
+    return NAME_INDEX_CACHE[key]
+
+
+def canonical_name(package_name):
+    """Normalize a package name as described in PEP 503.
+
+    Runs of "-", "_" and "." become a single "-" and letters are
+    lowercased, so names that PyPI treats as the same project, such as
+    Foo_Bar, foo-bar and foo.bar, share one canonical name.
+
+    Args:
+        package_name (str): package name to normalize
+
+    Returns:
+        str: the canonical name
+    """
+    return re.sub(r"[-_.]+", "-", package_name).lower()
+
+
+def build_canonical_index(package_names):
+    """Group package names by their PEP 503 canonical name.
+
+    Args:
+        package_names (iterable): package names to index
+
+    Returns:
+        dict: canonical name (key) and display names with that canonical
+        name (value), in the order they were first seen
+    """
+    canonical_index = {}
+    for package in package_names:
+        canonical_index.setdefault(canonical_name(package), []).append(package)
+    return canonical_index
+
+
+def update_canonical_index(canonical_index, added_packages, removed_packages):
+    """Patch a canonical name index in place with names added and removed.
+
+    Args:
+        canonical_index (dict): index built by build_canonical_index
+        added_packages (iterable): names to add to the index
+        removed_packages (iterable): names to drop from the index
+
+    Returns:
+        dict: the updated canonical name index
+    """
+    for package in removed_packages:
+        canonical = canonical_name(package)
+        display_names = canonical_index.get(canonical, [])
+        if package in display_names:
+            display_names.remove(package)
+        # Drop canonical names with no names left to keep the index compact
+        if not display_names:
+            canonical_index.pop(canonical, None)
+    for package in added_packages:
+        canonical_index.setdefault(canonical_name(package), []).append(package)
+    return canonical_index
+
+
+def name_token_bag(package_name):
+    """Reduce a package name to its sorted separator-delimited tokens.
+
+    Names that differ only in word order or in which of "-", "_" and
+    "." separate the words share the same token bag.
+
+    Args:
+        package_name (str): package name to split
+
+    Returns:
+        tuple: sorted non-empty tokens of the name
+    """
+    tokens = [token for token in re.split(r"[-_.]+", package_name) if token]
+    return tuple(sorted(tokens))
+
+
+def build_token_index(package_names):
+    """Group multi-word package names by their token bag.
+
+    Names with a single token cannot be reordered, so they are left
+    out of the index.
+
+    Args:
+        package_names (list): package names to index
+
+    Returns:
+        dict: token bag (key) and names with that token bag (value)
+    """
+    token_index = {}
+    for package in package_names:
+        token_bag = name_token_bag(package)
+        if len(token_bag) >= 2:
+            token_index.setdefault(token_bag, []).append(package)
+    return token_index
+
+
+def update_token_index(token_index, added_packages, removed_packages):
+    """Patch a token bag index in place with names added and removed.
+
+    Args:
+        token_index (dict): index built by build_token_index
+        added_packages (iterable): names to add to the index
+        removed_packages (iterable): names to drop from the index
+
+    Returns:
+        dict: the updated token bag index
+    """
+    for package in removed_packages:
+        token_bag = name_token_bag(package)
+        same_bag_packages = token_index.get(token_bag, [])
+        if package in same_bag_packages:
+            same_bag_packages.remove(package)
+        # Drop token bags with no names left to keep the index compact
+        if not same_bag_packages:
+            token_index.pop(token_bag, None)
+    update_packages = build_token_index(added_packages)
+    for token_bag, same_bag_packages in update_packages.items():
+        token_index.setdefault(token_bag, []).extend(same_bag_packages)
+    return token_index
+
+
+def build_metaphone_index(package_names):
+    """Group package names by their metaphone code.
+
+    Args:
+        package_names (list): package names to index
+
+    Returns:
+        dict: metaphone code (key) and names with that code (value)
+    """
+    metaphone_index = {}
+    for package in package_names:
+        metaphone_index.setdefault(jellyfish.metaphone(package), []).append(package)
+    return metaphone_index
+
+
+def update_metaphone_index(metaphone_index, added_packages, removed_packages):
+    """Patch a metaphone index in place with names added and removed.
+
+    Args:
+        metaphone_index (dict): index built by build_metaphone_index
+        added_packages (iterable): names to add to the index
+        removed_packages (iterable): names to drop from the index
+
+    Returns:
+        dict: the updated metaphone index
+    """
+    for package in removed_packages:
+        code = jellyfish.metaphone(package)
+        same_code_packages = metaphone_index.get(code, [])
+        if package in same_code_packages:
+            same_code_packages.remove(package)
+        # Drop codes with no names left to keep the index compact
+        if not same_code_packages:
+            metaphone_index.pop(code, None)
+    for package in added_packages:
+        metaphone_index.setdefault(jellyfish.metaphone(package), []).append(package)
+    return metaphone_index
+
+
+def get_metaphone_index(package_names, folder="package_lists"):
+    """Load the stored metaphone index for a snapshot, updating it if stale.
+
+    The index is saved next to the package list snapshots so that the
+    metaphone code of each name is only ever computed once. When the
+    stored index belongs to an older snapshot, only the names added or
+    removed since then are recomputed before the index is saved again.
+
+    Args:
+        package_names (list): package names in the current snapshot
+        folder (str): folder in which the index is stored
+
+    Returns:
+        dict: metaphone code (key) and names with that code (value)
+    """
+    digest = snapshot_digest(package_names)
+    path = os.path.join(folder, "pypi-metaphone-index.json")
+
+    # Reuse the stored index, patching it if it is for another snapshot
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        metaphone_index = stored["codes"]
+        count_cache("metaphone_index", stored["digest"] == digest)
+        if stored["digest"] == digest:
+            return metaphone_index
+        current_packages = set(package_names)
+        stored_packages = set()
+        for same_code_packages in metaphone_index.values():
+            stored_packages.update(same_code_packages)
+        update_metaphone_index(
+            metaphone_index,
+            current_packages - stored_packages,
+            stored_packages - current_packages,
+        )
+    else:
+        count_cache("metaphone_index", False)
+        metaphone_index = build_metaphone_index(package_names)
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"digest": digest, "codes": metaphone_index}, f, ensure_ascii=False)
+
+    return metaphone_index
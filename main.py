@@ -31,13 +31,28 @@ specified minimum are analyzed.
 Another (scan-recent) examines packages recently uploaded (at least 24
 hours ago) to PyPI and checks whether these news packages are potential
 typosquatters.
+
+Another (history) looks up when a package name was first and last seen
+in a saved package list and every typosquatting finding involving it.
 """
 
 import argparse
+import cProfile
 import sys
 import textwrap
 
-from porcelain import mod_squatters, names_to_defend, top_mods, scan_recent
+import constants
+from metrics import enable_metrics, print_profile, write_metrics
+from porcelain import (
+    history,
+    ingest_metadata,
+    mod_squatters,
+    names_to_defend,
+    top_mods,
+    scan_recent,
+    serve,
+    watch,
+)
 
 
 def parse_args():
@@ -49,7 +64,16 @@ def parse_args():
         "-o",
         "--operation",
         help="Specify operation to perform.",
-        choices=["mod-squatters", "top-mods", "defend-name", "scan-recent"],
+        choices=[
+            "mod-squatters",
+            "top-mods",
+            "defend-name",
+            "scan-recent",
+            "serve",
+            "watch",
+            "ingest-metadata",
+            "history",
+        ],
         default="mod-squatters",
     )
     parser.add_argument(
@@ -86,6 +110,112 @@ def parse_args():
         help="When using scan-recent, save newly created package list",
         action="store_true",
     )
+    parser.add_argument(
+        "--delta",
+        help="With --save, only store the changes since the previous package list",
+        action="store_true",
+    )
+    # Switch to sync new packages from the PyPI changelog
+    parser.add_argument(
+        "--incremental",
+        help="When using scan-recent, only fetch PyPI changes since the last scan",
+        action="store_true",
+    )
+    # Options for the on-disk cache of downloaded PyPI data
+    parser.add_argument(
+        "--cache_max_age",
+        help="Seconds to reuse cached PyPI downloads before checking for changes",
+        default=constants.CACHE_MAX_AGE,
+        type=int,
+    )
+    parser.add_argument(
+        "--offline",
+        help="Only use cached PyPI downloads and never access the network",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes used to screen packages for typosquatters",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--screens",
+        help="With top-mods or scan-recent, the screens to run, in order",
+        choices=constants.SCREEN_CHOICES,
+        default=constants.SCREENS,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--no_results_cache",
+        help="With top-mods, rescan every name rather than patch stored results",
+        action="store_true",
+    )
+    # Options for the serve operation
+    parser.add_argument(
+        "--port",
+        help="Localhost port on which to answer queries",
+        default=constants.SERVE_PORT,
+        type=int,
+    )
+    parser.add_argument(
+        "--socket", help="Answer queries on this Unix socket instead of a port"
+    )
+    parser.add_argument(
+        "--refresh_interval",
+        help="Seconds between refreshes of the package list when serving",
+        default=constants.SERVE_REFRESH_INTERVAL,
+        type=float,
+    )
+    # Options for the watch operation
+    parser.add_argument(
+        "--poll_interval",
+        help="Seconds between polls of PyPI when watching for new packages",
+        default=constants.WATCH_POLL_INTERVAL,
+        type=float,
+    )
+    parser.add_argument(
+        "--output",
+        help="With watch, append findings to this file instead of printing them",
+    )
+    parser.add_argument(
+        "--distance_backend",
+        help="How to find package names within the edit distance",
+        choices=constants.DISTANCE_BACKENDS,
+        default="auto",
+    )
+    # Options for the ingest-metadata operation
+    parser.add_argument(
+        "--dump", help="JSON Lines file or SQLite database of PyPI package metadata"
+    )
+    parser.add_argument(
+        "--dump_table",
+        help="Table of a SQLite dump holding one row per release",
+        default=constants.METADATA_DUMP_TABLE,
+    )
+    # Options for recording where a run spends its time
+    parser.add_argument(
+        "--metrics",
+        help="Write per-stage time, memory, requests and cache hits to this JSON file",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Print the time spent in each stage and function when done",
+        action="store_true",
+    )
+    # Options for downloading package metadata from PyPI
+    parser.add_argument(
+        "--metadata_workers",
+        help="Maximum number of package metadata downloads at the same time",
+        default=constants.METADATA_WORKERS,
+        type=int,
+    )
+    parser.add_argument(
+        "--metadata_timeout",
+        help="Seconds to wait for PyPI to respond to a metadata request",
+        default=constants.METADATA_TIMEOUT,
+        type=float,
+    )
     args = parser.parse_args()
 
     return args
@@ -95,6 +225,14 @@ if __name__ == "__main__":
 
     cli_args = parse_args()  # get command line arguments
 
+    # Record where the run spends its time, if asked to
+    if cli_args.metrics or cli_args.profile:
+        enable_metrics()
+    profiler = None
+    if cli_args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     # Check top packages for typosquatters
     if cli_args.operation == "top-mods":
         top_mods(
@@ -102,6 +240,14 @@ if __name__ == "__main__":
             cli_args.number_packages,
             cli_args.len_package_name,
             cli_args.stored_json,
+            cli_args.cache_max_age,
+            cli_args.offline,
+            cli_args.metadata_workers,
+            cli_args.metadata_timeout,
+            cli_args.workers,
+            cli_args.distance_backend,
+            not cli_args.no_results_cache,
+            cli_args.screens,
         )
 
     # Check particular package for typosquatters
@@ -119,7 +265,13 @@ if __name__ == "__main__":
             )
             sys.exit(0)  # Exit program
         else:
-            mod_squatters(cli_args.module_name, cli_args.edit_distance)
+            mod_squatters(
+                cli_args.module_name,
+                cli_args.edit_distance,
+                cli_args.cache_max_age,
+                cli_args.offline,
+                cli_args.distance_backend,
+            )
 
     # Enumerate potential names that could potentially be typosquatted
     elif cli_args.operation == "defend-name":
@@ -140,7 +292,78 @@ if __name__ == "__main__":
 
     # Scan packages recently added to PyPI for potential typosquatters
     elif cli_args.operation == "scan-recent":
-        scan_recent(cli_args.edit_distance, cli_args.save)
+        scan_recent(
+            cli_args.edit_distance,
+            cli_args.save,
+            cli_args.cache_max_age,
+            cli_args.offline,
+            cli_args.metadata_workers,
+            cli_args.metadata_timeout,
+            cli_args.incremental,
+            cli_args.workers,
+            cli_args.distance_backend,
+            cli_args.delta,
+            cli_args.screens,
+        )
+
+    # Answer queries from resident indexes until interrupted
+    elif cli_args.operation == "serve":
+        serve(
+            cli_args.edit_distance,
+            cli_args.number_packages,
+            cli_args.stored_json,
+            cli_args.cache_max_age,
+            cli_args.offline,
+            cli_args.distance_backend,
+            cli_args.port,
+            cli_args.socket,
+            cli_args.refresh_interval,
+        )
+
+    # Screen packages as they are added to PyPI until interrupted
+    elif cli_args.operation == "watch":
+        watch(
+            cli_args.edit_distance,
+            cli_args.poll_interval,
+            cli_args.output,
+            cli_args.metadata_workers,
+            cli_args.metadata_timeout,
+            cli_args.distance_backend,
+        )
+
+    # Load package metadata from a local dump for offline comparisons
+    elif cli_args.operation == "ingest-metadata":
+        # Make sure user provided --dump flag
+        if cli_args.dump == None:
+            print(
+                textwrap.dedent(
+                    """
+                    ERROR: User must use --dump flag to specify a metadata dump.
+                    For instance:
+                    >>> python main.py -o ingest-metadata --dump metadata.jsonl
+                    """
+                )
+            )
+            sys.exit(0)
+        else:
+            ingest_metadata(cli_args.dump, cli_args.dump_table)
+
+    # Look up the recorded history of a package name
+    elif cli_args.operation == "history":
+        # Make sure user provided --module flag
+        if cli_args.module_name == None:
+            print(
+                textwrap.dedent(
+                    """
+                    ERROR: User must use -m flag to specify module.
+                    For instance:
+                    >>> python main.py -o history -m requests
+                    """
+                )
+            )
+            sys.exit(0)
+        else:
+            history(cli_args.module_name)
 
     # Check if operation argument was incorrectly specified
     else:
@@ -152,3 +375,9 @@ if __name__ == "__main__":
             )
         )
         sys.exit(0)
+
+    if profiler is not None:
+        profiler.disable()
+        print_profile(profiler)
+    if cli_args.metrics:
+        write_metrics(cli_args.metrics)
@@ -0,0 +1,243 @@
+"""Record where a run of pypi-scan spends its time.
+
+A module that contains functions that time named stages of an
+operation and count HTTP requests, downloaded bytes and cache hits
+during each of them. Recording is off unless enable_metrics is called,
+so stages and counters cost almost nothing in normal runs.
+
+Stages may be nested, and a nested stage is reported under its full
+path, such as "screen/homophone_screen". A stage entered many
+times, like the screen of each top package, is reported once with its
+totals. Each thread nests its own stages, so a stage entered by a
+metadata download thread is reported from the top.
+
+The operating system only reports the peak memory use of the whole
+process, so each stage records the process peak when it ended and how
+much the stage raised that peak.
+"""
+
+import collections
+import contextlib
+import json
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Stages, counters and the stages each thread has entered so far of the current run
+METRICS = {
+    "enabled": False,
+    "started": 0.0,
+    "stages": collections.OrderedDict(),
+    "counters": collections.Counter(),
+    "stack": threading.local(),
+}
+
+# Guard the stages and counters, which are updated from metadata download threads
+METRICS_LOCK = threading.Lock()
+
+
+def enable_metrics():
+    """Start recording stages and counters, discarding earlier records."""
+    METRICS["enabled"] = True
+    METRICS["started"] = time.perf_counter()
+    METRICS["stages"].clear()
+    METRICS["counters"].clear()
+    METRICS["stack"] = threading.local()
+
+
+def stage_stack():
+    """Return the stages the current thread has entered and not yet left.
+
+    Returns:
+        list: names of the stages, outermost first
+    """
+    stack = getattr(METRICS["stack"], "names", None)
+    if stack is None:
+        stack = METRICS["stack"].names = []
+    return stack
+
+
+def peak_rss():
+    """Measure the largest resident set size of this process so far.
+
+    Returns:
+        int: peak resident set size in bytes, or 0 if it cannot be measured
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+def count(name, amount=1):
+    """Add to a counter, if metrics are being recorded.
+
+    Args:
+        name (str): counter to add to, e.g. "http_requests"
+        amount (int): amount to add
+    """
+    if METRICS["enabled"]:
+        with METRICS_LOCK:
+            METRICS["counters"][name] += amount
+
+
+def count_cache(cache, hit, amount=1):
+    """Count lookups in a cache, if metrics are being recorded.
+
+    Args:
+        cache (str): name of the cache, e.g. "metadata"
+        hit (bool): whether the lookups were answered from the cache
+        amount (int): number of lookups
+    """
+    count(cache + ("_cache_hits" if hit else "_cache_misses"), amount)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a stage of an operation, if metrics are being recorded.
+
+    Args:
+        name (str): name of the stage, unique among its siblings
+
+    Yields:
+        None: the body of the with statement is the stage being timed
+    """
+    if not METRICS["enabled"]:
+        yield
+        return
+
+    stack = stage_stack()
+    stack.append(name)
+    with METRICS_LOCK:
+        # Create the record on entry so stages are reported in the order run
+        record = METRICS["stages"].setdefault(
+            "/".join(stack),
+            {
+                "calls": 0,
+                "wall_seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "process_peak_rss_bytes": 0,
+                "peak_rss_growth_bytes": 0,
+                "counters": collections.Counter(),
+            },
+        )
+        counters_before = collections.Counter(METRICS["counters"])
+    peak_rss_before = peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+        process_peak_rss = peak_rss()
+        stack.pop()
+        with METRICS_LOCK:
+            counters = METRICS["counters"] - counters_before
+            record["calls"] += 1
+            record["wall_seconds"] += wall_seconds
+            record["cpu_seconds"] += cpu_seconds
+            record["process_peak_rss_bytes"] = process_peak_rss
+            record["peak_rss_growth_bytes"] = max(
+                record["peak_rss_growth_bytes"], process_peak_rss - peak_rss_before
+            )
+            record["counters"].update(counters)
+
+
+def cache_hit_rates(counters):
+    """Compute the hit rate of each cache from its counters.
+
+    Args:
+        counters (dict): counters including "<cache>_cache_hits" and
+        "<cache>_cache_misses" pairs
+
+    Returns:
+        dict: (key) cache name and (value) share of lookups that were hits
+    """
+    hit_rates = {}
+    for name in counters:
+        if name.endswith("_cache_hits") or name.endswith("_cache_misses"):
+            cache = name.rsplit("_cache_", 1)[0]
+            hits = counters.get(cache + "_cache_hits", 0)
+            lookups = hits + counters.get(cache + "_cache_misses", 0)
+            hit_rates[cache] = hits / lookups if lookups else 0.0
+    return hit_rates
+
+
+def metrics_report():
+    """Gather the recorded stages and counters into one report.
+
+    Returns:
+        dict: totals of the run and of each stage, ready to dump as JSON
+    """
+    stages = collections.OrderedDict()
+    with METRICS_LOCK:
+        records = list(METRICS["stages"].items())
+    for path, record in records:
+        stages[path] = dict(record)
+        stages[path]["counters"] = dict(record["counters"])
+        stages[path]["cache_hit_rates"] = cache_hit_rates(record["counters"])
+    return {
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "wall_seconds": time.perf_counter() - METRICS["started"],
+        "cpu_seconds": time.process_time(),
+        "peak_rss_bytes": peak_rss(),
+        "counters": dict(METRICS["counters"]),
+        "cache_hit_rates": cache_hit_rates(METRICS["counters"]),
+        "stages": stages,
+    }
+
+
+def write_metrics(path):
+    """Write the metrics report to a JSON file.
+
+    Args:
+        path (str): file to write the report to
+    """
+    with open(path, "w") as f:
+        json.dump(metrics_report(), f, indent=2)
+
+
+def print_profile(profiler=None, number_functions=25, file=None):
+    """Print a table of the recorded stages and the slowest functions.
+
+    Args:
+        profiler (cProfile.Profile): profiler that ran during the operation
+        number_functions (int): number of functions to list
+        file (file): stream to print to, by default standard error
+    """
+    file = file or sys.stderr
+    report = metrics_report()
+    row_format = "{:<48}{:>7}{:>10}{:>10}{:>10}{:>12}"
+    print(
+        row_format.format("Stage", "Calls", "Wall", "CPU", "Peak +MB", "HTTP bytes"),
+        file=file,
+    )
+    for path, record in report["stages"].items():
+        print(
+            row_format.format(
+                path,
+                record["calls"],
+                "{:.3f}s".format(record["wall_seconds"]),
+                "{:.3f}s".format(record["cpu_seconds"]),
+                record["peak_rss_growth_bytes"] // 2 ** 20,
+                record["counters"].get("http_bytes", 0),
+            ),
+            file=file,
+        )
+    for cache, hit_rate in sorted(report["cache_hit_rates"].items()):
+        print(cache + " cache hit rate: {:.1%}".format(hit_rate), file=file)
+
+    if profiler is not None:
+        print(file=file)
+        stats = pstats.Stats(profiler, stream=file)
+        stats.sort_stats("cumulative").print_stats(number_functions)
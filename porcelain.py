@@ -3,19 +3,53 @@
 These are the main related functionalities that can be called in main.py
 """
 
-from filters import filter_by_package_name_len, whitelist
+import datetime
+import json
+import sys
+from time import time
+
+import constants
+from filters import filter_by_package_name_len, is_whitelisted, load_whitelist
+from fingerprints import (
+    ingest_metadata_dump,
+    load_fingerprint_table,
+    save_fingerprint_table,
+)
+from indexes import get_metaphone_index
+from metrics import stage
 from scrapers import get_all_packages, get_top_packages
+from server import load_server_state, run_server
+from snapshots import diff_snapshots, snapshot_from_names
+from store import finding_history, name_history, open_store, record_findings
 from utils import (
+    create_cached_suspicious_package_dict,
     create_potential_squatter_names,
     create_suspicious_package_dict,
-    load_most_recent_packages,
+    load_most_recent_snapshot,
     print_suspicious_packages,
     store_squatting_candidates,
     store_recent_scan_results,
+    sync_package_list,
+    watch_new_packages,
 )
 
+CACHE_MAX_AGE = constants.CACHE_MAX_AGE
+SCREENS = constants.SCREENS
+SERVE_PORT = constants.SERVE_PORT
+SERVE_REFRESH_INTERVAL = constants.SERVE_REFRESH_INTERVAL
+METADATA_WORKERS = constants.METADATA_WORKERS
+METADATA_DUMP_TABLE = constants.METADATA_DUMP_TABLE
+METADATA_TIMEOUT = constants.METADATA_TIMEOUT
+WATCH_POLL_INTERVAL = constants.WATCH_POLL_INTERVAL
+
 
-def mod_squatters(module, max_distance):
+def mod_squatters(
+    module,
+    max_distance,
+    cache_max_age=CACHE_MAX_AGE,
+    offline=False,
+    distance_backend="auto",
+):
     """Check if a particular package name has potential squatters.
 
     Prints any potential typosquatters for specified module
@@ -23,13 +57,22 @@ def mod_squatters(module, max_distance):
     Args:
         module (str): name to check for typosquatting
         max_distance (int): maximum edit distance to check for typosquatting
+        cache_max_age (int): seconds cached downloads are used without revalidation
+        offline (bool): whether to only use cached downloads
+        distance_backend (str): how to find names within the edit distance
 
     """
     module_in_list = [module]
-    package_names = get_all_packages()
-    squat_candidates = create_suspicious_package_dict(
-        package_names, module_in_list, max_distance
-    )
+    with stage("download_package_list"):
+        package_names = get_all_packages(cache_max_age=cache_max_age, offline=offline)
+    with stage("screen"):
+        squat_candidates = create_suspicious_package_dict(
+            package_names,
+            module_in_list,
+            max_distance,
+            metaphone_index=get_metaphone_index(package_names),
+            distance_backend=distance_backend,
+        )
     # Print results
     print("Checking " + module + " for typosquatting candidates.")
     # Check for no typosquatting candidates
@@ -55,7 +98,20 @@ def names_to_defend(module_name):
         print(f"{i}:", name)
 
 
-def top_mods(max_distance, top_n, min_len, stored_json):
+def top_mods(
+    max_distance,
+    top_n,
+    min_len,
+    stored_json,
+    cache_max_age=CACHE_MAX_AGE,
+    offline=False,
+    metadata_workers=METADATA_WORKERS,
+    metadata_timeout=METADATA_TIMEOUT,
+    workers=1,
+    distance_backend="auto",
+    results_cache=True,
+    screens=SCREENS,
+):
     """Check top packages for typosquatters.
 
     Prints top packages and any potential typosquatters
@@ -65,50 +121,345 @@ def top_mods(max_distance, top_n, min_len, stored_json):
         top_n (int): the number of top packages to retrieve
         min_len (int): a minimum length of characters
         stored_json (bool): a flag to denote whether to used stored top packages json
+        cache_max_age (int): seconds cached downloads are used without revalidation
+        offline (bool): whether to only use cached downloads
+        metadata_workers (int): maximum number of metadata downloads at the same time
+        metadata_timeout (float): seconds to wait for each metadata response
+        workers (int): number of processes to screen top packages with
+        distance_backend (str): how to find names within the edit distance
+        results_cache (bool): whether to patch stored results rather than rescan
+        screens (list): screens to run, from SCREEN_CHOICES
 
     """
     # Get list of potential typosquatters
-    package_names = get_all_packages()
-    top_packages = get_top_packages(top_n=top_n, stored=stored_json)
+    with stage("download_package_list"):
+        package_names = get_all_packages(cache_max_age=cache_max_age, offline=offline)
+    with stage("download_top_packages"):
+        top_packages = get_top_packages(
+            top_n=top_n,
+            stored=stored_json,
+            cache_max_age=cache_max_age,
+            offline=offline,
+        )
     filtered_package_list = filter_by_package_name_len(top_packages, min_len=min_len)
-    squat_candidates = create_suspicious_package_dict(
-        package_names, filtered_package_list, max_distance
-    )
-    post_whitelist_candidates = whitelist(squat_candidates)
-    store_squatting_candidates(post_whitelist_candidates)
+    # Whitelisted names are dropped while screening, before any metadata is fetched
+    compiled_whitelist = load_whitelist()
+    with stage("screen"):
+        if results_cache:
+            # Only screen names that changed since the stored results
+            squat_candidates = create_cached_suspicious_package_dict(
+                package_names,
+                filtered_package_list,
+                max_distance,
+                workers=workers,
+                distance_backend=distance_backend,
+                compiled_whitelist=compiled_whitelist,
+                screens=screens,
+            )
+        else:
+            metaphone_index = None
+            if "homophone" in screens:
+                metaphone_index = get_metaphone_index(package_names)
+            squat_candidates = create_suspicious_package_dict(
+                package_names,
+                filtered_package_list,
+                max_distance,
+                metaphone_index=metaphone_index,
+                workers=workers,
+                distance_backend=distance_backend,
+                compiled_whitelist=compiled_whitelist,
+                screens=screens,
+            )
+    store = open_store()
+    with stage("store"):
+        store_squatting_candidates(squat_candidates)
+        record_findings(
+            store,
+            (
+                (package, squatter)
+                for package in squat_candidates
+                for squatter in squat_candidates[package]
+            ),
+        )
 
-    print_suspicious_packages(post_whitelist_candidates)
+    fingerprints = load_fingerprint_table()
+    print_suspicious_packages(
+        squat_candidates,
+        metadata_workers,
+        metadata_timeout,
+        fingerprints,
+        offline,
+        store,
+    )
+    save_fingerprint_table(fingerprints)
+    store.close()
 
 
-def scan_recent(max_distance, save_new_list=False):
+def scan_recent(
+    max_distance,
+    save_new_list=False,
+    cache_max_age=CACHE_MAX_AGE,
+    offline=False,
+    metadata_workers=METADATA_WORKERS,
+    metadata_timeout=METADATA_TIMEOUT,
+    incremental=False,
+    workers=1,
+    distance_backend="auto",
+    save_as_delta=False,
+    screens=SCREENS,
+):
     """Scan packages recently added to pypi for possible typosquatting.
 
     Print recently added packages and any package names on which these
-    packages are potentially typosquatting.
+    packages are potentially typosquatting. In incremental mode, the
+    packages added since the previous incremental scan are found from
+    PyPI's changelog rather than by comparing against a stored list
+    from at least a day ago.
 
     Args:
         max_distance (int): maximum edit distance to check for typosquatting
         save_new_list (bool): flag to save new list
+        cache_max_age (int): seconds cached downloads are used without revalidation
+        offline (bool): whether to only use cached downloads
+        metadata_workers (int): maximum number of metadata downloads at the same time
+        metadata_timeout (float): seconds to wait for each metadata response
+        incremental (bool): flag to sync new packages from the PyPI changelog
+        workers (int): number of processes to screen new packages with
+        distance_backend (str): how to find names within the edit distance
+        save_as_delta (bool): flag to save only the changes since the last list
+        screens (list): screens to run, from SCREEN_CHOICES
 
     """
-    # Download current list of PyPI packages and convert to set
-    current_packages_set = set(get_all_packages())
-    # If saving is requested, save new list with timestamped name
-    if save_new_list == True:
-        store_recent_scan_results(list(current_packages_set))
+    if incremental:
+        # Replay PyPI events since the last sync onto the synced list
+        with stage("sync_package_list"):
+            current_packages, new_packages, _ = sync_package_list()
+    else:
+        # Download current list of PyPI packages
+        with stage("download_package_list"):
+            current_packages = get_all_packages(
+                cache_max_age=cache_max_age, offline=offline
+            )
+        # If saving is requested, save new list with timestamped name
+        if save_new_list == True:
+            with stage("store"):
+                store_recent_scan_results(current_packages, delta=save_as_delta)
+
+        # Open the catalogued baseline from at least a day ago
+        with stage("diff"):
+            recent_snapshot = load_most_recent_snapshot()
 
-    # Load most recent stored list of PyPI packages and concert to set
-    recent_packages_set = load_most_recent_packages()
+            # Find packages that are in newest list but not old list
+            # Both lists are sorted, so they are merged rather than held as sets
+            new_packages = [
+                package
+                for package, change in diff_snapshots(
+                    recent_snapshot, snapshot_from_names(current_packages)
+                )
+                if change == "added"
+            ]
 
-    # Find packages that are in newest list but not old list
-    # This is a set operation: find all elements in first not in second
-    new_packages = current_packages_set - recent_packages_set
+    # Whitelisted new packages are known good, so they are not screened
+    compiled_whitelist = load_whitelist()
+    new_packages = [
+        package
+        for package in new_packages
+        if not is_whitelisted(compiled_whitelist, package)
+    ]
 
     # Check each new package and see if it is a potential typosquatter
-    squat_candidates = create_suspicious_package_dict(
-        current_packages_set, new_packages, max_distance
-    )
+    with stage("screen"):
+        metaphone_index = None
+        if "homophone" in screens:
+            metaphone_index = get_metaphone_index(current_packages)
+        squat_candidates = create_suspicious_package_dict(
+            current_packages,
+            new_packages,
+            max_distance,
+            metaphone_index=metaphone_index,
+            workers=workers,
+            distance_backend=distance_backend,
+            screens=screens,
+        )
+    # Drop whitelisted pairs, whose squatter is the new package
+    for new_package in squat_candidates:
+        squat_candidates[new_package] = [
+            package
+            for package in squat_candidates[new_package]
+            if not is_whitelisted(compiled_whitelist, new_package, package)
+        ]
 
     # TODO: Consider adding in length to avoid checking short package names
 
-    print_suspicious_packages(squat_candidates)
+    # New packages are the potential typosquatters of the names they resemble
+    store = open_store()
+    record_findings(
+        store,
+        (
+            (package, new_package)
+            for new_package in squat_candidates
+            for package in squat_candidates[new_package]
+        ),
+    )
+
+    fingerprints = load_fingerprint_table()
+    print_suspicious_packages(
+        squat_candidates,
+        metadata_workers,
+        metadata_timeout,
+        fingerprints,
+        offline,
+        store,
+    )
+    save_fingerprint_table(fingerprints)
+    store.close()
+
+
+def history(module):
+    """Print when a package name was seen and every finding involving it.
+
+    Both are looked up in the store, which records each saved package
+    list and each scan, so no stored package list is read.
+
+    Args:
+        module (str): package name to look up
+
+    """
+    store = open_store()
+    seen = name_history(store, module)
+    findings = finding_history(store, module)
+    store.close()
+
+    def date(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+
+    if seen is None:
+        print(module + " is in no saved package list.")
+    else:
+        print(
+            module
+            + " was first seen on "
+            + date(seen[0])
+            + " and last seen on "
+            + date(seen[1])
+            + "."
+        )
+    if not findings:
+        print("No typosquatting findings involve " + module + ".")
+    for package, squatter, first_found, last_found in findings:
+        print(
+            squatter
+            + " may typosquat "
+            + package
+            + ": first found "
+            + date(first_found)
+            + ", last found "
+            + date(last_found)
+            + "."
+        )
+
+
+def ingest_metadata(dump_path, table=METADATA_DUMP_TABLE):
+    """Load package metadata from a local dump into the fingerprint table.
+
+    Afterwards top-mods and scan-recent can compare metadata with
+    --offline, without asking PyPI for any of it.
+
+    Args:
+        dump_path (str): JSON Lines file or SQLite database of package metadata
+        table (str): table of a SQLite dump holding the rows
+
+    """
+    start = time()
+    fingerprints = load_fingerprint_table()
+    with stage("ingest"):
+        ingested = ingest_metadata_dump(fingerprints, dump_path, table)
+    with stage("store"):
+        save_fingerprint_table(fingerprints)
+    print(
+        "Loaded metadata of "
+        + str(ingested)
+        + " packages in "
+        + str(round(time() - start, 1))
+        + " seconds."
+    )
+
+
+def serve(
+    max_distance,
+    top_n,
+    stored_json,
+    cache_max_age=CACHE_MAX_AGE,
+    offline=False,
+    distance_backend="auto",
+    port=SERVE_PORT,
+    socket_path=None,
+    refresh_interval=SERVE_REFRESH_INTERVAL,
+):
+    """Answer typosquatting queries from resident indexes until interrupted.
+
+    The package list and indexes are built once and refreshed in the
+    background, so each query only costs a few index lookups.
+
+    Args:
+        max_distance (int): largest edit distance queries may ask for
+        top_n (int): the number of top packages to keep
+        stored_json (bool): a flag to denote whether to used stored top packages json
+        cache_max_age (int): seconds cached downloads are used without revalidation
+        offline (bool): whether to only use cached downloads
+        distance_backend (str): how to find names within the edit distance
+        port (int): localhost port to listen on
+        socket_path (str): Unix socket to listen on instead of a port
+        refresh_interval (float): seconds between refreshes of the package list
+
+    """
+    print("Building indexes over the PyPI package list.")
+    state = load_server_state(
+        max_distance, top_n, stored_json, cache_max_age, offline, distance_backend
+    )
+    run_server(state, port, socket_path, refresh_interval)
+
+
+def watch(
+    max_distance,
+    poll_interval=WATCH_POLL_INTERVAL,
+    output_file=None,
+    metadata_workers=METADATA_WORKERS,
+    metadata_timeout=METADATA_TIMEOUT,
+    distance_backend="auto",
+):
+    """Screen packages as they are added to PyPI until interrupted.
+
+    Each finding is written as one JSON object per line, either to
+    standard output or appended to a file, and flushed straight away so
+    that other programs can follow it.
+
+    Args:
+        max_distance (int): maximum edit distance to check for typosquatting
+        poll_interval (float): seconds between polls of PyPI
+        output_file (str): file to append findings to instead of standard output
+        metadata_workers (int): maximum number of metadata downloads at the same time
+        metadata_timeout (float): seconds to wait for each metadata response
+        distance_backend (str): how to find names within the edit distance
+    """
+    output = sys.stdout
+    if output_file:
+        output = open(output_file, "a", encoding="utf-8")
+    try:
+        for finding in watch_new_packages(
+            max_distance,
+            poll_interval,
+            metadata_workers=metadata_workers,
+            metadata_timeout=metadata_timeout,
+            distance_backend=distance_backend,
+            compiled_whitelist=load_whitelist(),
+        ):
+            output.write(json.dumps(finding, ensure_ascii=False) + "\n")
+            output.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output_file:
+            output.close()
@@ -4,65 +4,266 @@ A module that contains any functions that can make internet
 calls to gather data related to typosquatting.
 """
 
+import codecs
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import html
 import json
+import os
+import re
 import sys
-import urllib.request
+import threading
+from time import time
+import urllib.parse
+import xmlrpc.client  # nosec
 
-from bs4 import BeautifulSoup
 import requests
 import jsontree
 
 import constants
+from metrics import count, count_cache, stage
 
 TOP_N = constants.TOP_N
+CHUNK_SIZE = constants.CHUNK_SIZE
+CACHE_FOLDER = constants.CACHE_FOLDER
+CACHE_MAX_AGE = constants.CACHE_MAX_AGE
+METADATA_FIELDS = constants.METADATA_FIELDS
+METADATA_CACHE_TTL = constants.METADATA_CACHE_TTL
+METADATA_CACHE_MAX_BYTES = constants.METADATA_CACHE_MAX_BYTES
+METADATA_LRU_SIZE = constants.METADATA_LRU_SIZE
+METADATA_WORKERS = constants.METADATA_WORKERS
+METADATA_TIMEOUT = constants.METADATA_TIMEOUT
+PYPI_XMLRPC_URL = constants.PYPI_XMLRPC_URL
 
+# Media types for the PEP 691 JSON simple index and the HTML fallback
+SIMPLE_INDEX_ACCEPT = "application/vnd.pypi.simple.v1+json, text/html;q=0.1"
 
-def get_all_packages(page="https://pypi.org/simple/"):
-    """Download simple list of PyPI package names.
+# Match the name inside each <a> tag of the HTML simple index
+HTML_NAME_PATTERN = re.compile(r"<a\b[^>]*>([^<]*)</a>", re.IGNORECASE)
+
+# Match the "name" value of each project in the JSON simple index
+JSON_NAME_PATTERN = re.compile(r'"name"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+def parse_simple_index(chunks, json_format=False):
+    """Incrementally extract package names from the simple index.
+
+    Names are yielded as soon as the bytes containing them arrive, and
+    only the unparsed tail of the document is held in memory, so memory
+    use does not grow with the size of the index.
+
+    Args:
+        chunks (iterable): bytes of the simple index, in order
+        json_format (bool): whether the index is PEP 691 JSON instead of HTML
+
+    Yields:
+        str: package names in the order they appear
+    """
+    if json_format:
+        pattern = JSON_NAME_PATTERN
+        unescape = json.loads
+    else:
+        pattern = HTML_NAME_PATTERN
+        unescape = html.unescape
+
+    # Decode incrementally so characters split across chunks survive
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        parsed_up_to = 0
+        for match in pattern.finditer(buffer):
+            yield unescape(match.group(1))
+            parsed_up_to = match.end()
+        # Keep only the text that may hold a partially received name
+        buffer = buffer[parsed_up_to:]
+    buffer += decoder.decode(b"", final=True)
+    for match in pattern.finditer(buffer):
+        yield unescape(match.group(1))
+
+
+def fetch_cached(
+    url,
+    headers=None,
+    cache_max_age=CACHE_MAX_AGE,
+    offline=False,
+    cache_folder=CACHE_FOLDER,
+):
+    """Download a web page through an on-disk HTTP cache.
+
+    A cached copy younger than cache_max_age seconds is used without
+    touching the network. An older copy is revalidated with a
+    conditional GET using its ETag and Last-Modified headers, so an
+    unchanged page costs a 304 response rather than a full download.
+    In offline mode the cached copy is used no matter how old it is.
+
+    Args:
+        url (str): webpage to download
+        headers (dict): extra request headers, e.g. Accept
+        cache_max_age (int): seconds a cached copy is used without revalidation
+        offline (bool): whether to only ever use the cached copy
+        cache_folder (str): folder in which to store cached pages
+
+    Returns:
+        tuple: path to the cached page body and the page's content type
+    """
+    headers = dict(headers or {})
+    # Key on the Accept header too, as it changes the returned format
+    cache_key = hashlib.sha256(
+        (url + "\n" + headers.get("Accept", "")).encode("utf-8")
+    ).hexdigest()
+    body_path = os.path.join(cache_folder, cache_key + ".body")
+    info_path = os.path.join(cache_folder, cache_key + ".json")
+
+    # Load details of the cached copy, if there is one
+    cache_info = None
+    if os.path.exists(info_path) and os.path.exists(body_path):
+        with open(info_path, "r") as f:
+            cache_info = json.load(f)
+
+    if offline:
+        if cache_info is None:
+            print("No cached copy of " + url + " available in offline mode")
+            sys.exit(1)
+        count_cache("http", True)
+        return body_path, cache_info["content_type"]
+
+    # Serve recent copies without revalidating
+    if cache_info is not None and time() - cache_info["fetched_at"] < cache_max_age:
+        count_cache("http", True)
+        return body_path, cache_info["content_type"]
+
+    # Ask the server to skip the download if nothing has changed
+    if cache_info is not None:
+        if cache_info["etag"]:
+            headers["If-None-Match"] = cache_info["etag"]
+        if cache_info["last_modified"]:
+            headers["If-Modified-Since"] = cache_info["last_modified"]
+
+    os.makedirs(cache_folder, exist_ok=True)
+    with requests.get(url, headers=headers, stream=True) as response:
+        count("http_requests")
+        if response.status_code == 304 and cache_info is not None:
+            count_cache("http", True)
+            cache_info["fetched_at"] = time()
+        else:
+            response.raise_for_status()
+            # Write to a temporary file so a failed download leaves the
+            # previous copy intact
+            partial_path = body_path + ".part"
+            with open(partial_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    count("http_bytes", len(chunk))
+            os.replace(partial_path, body_path)
+            count_cache("http", False)
+            cache_info = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "content_type": response.headers.get("Content-Type", ""),
+                "fetched_at": time(),
+            }
+
+    with open(info_path, "w") as f:
+        json.dump(cache_info, f)
+
+    return body_path, cache_info["content_type"]
+
+
+def download_package_names(
+    page="https://pypi.org/simple/",
+    cache_max_age=CACHE_MAX_AGE,
+    offline=False,
+    cache_folder=CACHE_FOLDER,
+):
+    """Download simple list of PyPI package names, raising on failure.
 
     pypi.org/simple conveniently lists all the names of current
-    packages. This function scrapes that listing and then places
-    the package names in a python list structure.
+    packages. This function downloads that listing through the HTTP
+    cache, preferring the PEP 691 JSON format when the server offers
+    it, streams the package names out of it and then places them in
+    a python list structure.
 
     Args:
         page (str): webpage from which to download pypi package names
+        cache_max_age (int): seconds a cached listing is used without revalidation
+        offline (bool): whether to only use the cached listing
+        cache_folder (str): folder in which to cache the listing
 
     Returns:
         list: package names on pypi
+
+    Raises:
+        requests.exceptions.RequestException: if the listing cannot be downloaded
     """
     # Retrieve package name listing data from pypy
+    with stage("download"):
+        path, content_type = fetch_cached(
+            page,
+            headers={"Accept": SIMPLE_INDEX_ACCEPT},
+            cache_max_age=cache_max_age,
+            offline=offline,
+            cache_folder=cache_folder,
+        )
+
+    # Stream names out of the listing without reading it all at once
+    with stage("parse"), open(path, "rb") as f:
+        chunks = iter(functools.partial(f.read, CHUNK_SIZE), b"")
+        package_names = list(
+            parse_simple_index(chunks, json_format="json" in content_type)
+        )
+
+    return package_names
+
+
+def get_all_packages(
+    page="https://pypi.org/simple/",
+    cache_max_age=CACHE_MAX_AGE,
+    offline=False,
+    cache_folder=CACHE_FOLDER,
+):
+    """Download simple list of PyPI package names.
+
+    Like download_package_names, but exits with an error message if
+    there is an internet connection issue.
+
+    Args:
+        page (str): webpage from which to download pypi package names
+        cache_max_age (int): seconds a cached listing is used without revalidation
+        offline (bool): whether to only use the cached listing
+        cache_folder (str): folder in which to cache the listing
+
+    Returns:
+        list: package names on pypi
+    """
     try:
-        pypi_package_page = requests.get(page)
-    except requests.exceptions.ConnectionError as e:
+        return download_package_names(page, cache_max_age, offline, cache_folder)
+    except requests.exceptions.RequestException as e:
         print("Internet connection issue. Check connection")
         print(e)
         sys.exit(1)
 
-    # Convert html to easily digestible format
-    soup = BeautifulSoup(pypi_package_page.text, "html.parser")
-
-    # Store package names in list
-    package_names = []
-    for elem in soup.find_all("a"):  # Find all <a> tags
-        package_names.append(elem.string)  # Get string inside a tag
-
-    # Return timestamp and package name list
-    return package_names
-
 
-def get_top_packages(top_n=TOP_N, stored=False):
+def get_top_packages(
+    top_n=TOP_N, stored=False, cache_max_age=CACHE_MAX_AGE, offline=False
+):
     """Identify top packages by download count on pypi.
 
     A friendly person has already provided an occasionally
     updated JSON feed to enable this program to build a list
     of the top pypi packages by download count. The default
-    does a fresh pull of this feed. If the user wants to use
+    pulls this feed through the HTTP cache. If the user wants to use
     a stored list, that is possible if the user sets the stored
     flag to true.
 
     Args:
         top_n (int): the number of top packages to retrieve
         stored (bool): whether to use the stored package list
+        cache_max_age (int): seconds a cached feed is used without revalidation
+        offline (bool): whether to only use the cached feed
 
     Returns:
         dict: top packages
@@ -76,12 +277,15 @@ def get_top_packages(top_n=TOP_N, stored=False):
         )
         # Catch if internet connectivity causes failure
         try:
-            with urllib.request.urlopen(top_packages_url) as url:  # nosec
-                data = json.loads(url.read().decode())
-        except urllib.error.URLError as e:
+            path, _ = fetch_cached(
+                top_packages_url, cache_max_age=cache_max_age, offline=offline
+            )
+        except requests.exceptions.RequestException as e:
             print("Internet connection issue. Check connection")
             print(e)
             sys.exit(1)
+        with open(path, "r") as f:
+            data = json.load(f)
 
     # Make JSON data easy to navigate
     json_data = jsontree.jsontree(data)
@@ -97,36 +301,244 @@ def get_top_packages(top_n=TOP_N, stored=False):
     return top_packages
 
 
-def get_metadata(name):
+def get_last_serial(url=PYPI_XMLRPC_URL):
+    """Retrieve the serial number of the latest event on PyPI.
+
+    Every change on PyPI, such as a project being created or removed,
+    is recorded as an event with an increasing serial number.
+
+    Args:
+        url (str): PyPI XML-RPC endpoint
+
+    Returns:
+        int: serial of the latest event
+    """
+    count("http_requests")
+    try:
+        return xmlrpc.client.ServerProxy(url).changelog_last_serial()  # nosec
+    except (OSError, xmlrpc.client.Error) as e:
+        print("Internet connection issue. Check connection")
+        print(e)
+        sys.exit(1)
+
+
+def get_changelog_since_serial(serial, url=PYPI_XMLRPC_URL):
+    """Retrieve PyPI events that happened after a given event serial.
+
+    Args:
+        serial (int): serial of the last event already seen
+        url (str): PyPI XML-RPC endpoint
+
+    Returns:
+        list: events as [name, version, timestamp, action, serial] lists
+    """
+    count("http_requests")
+    try:
+        return xmlrpc.client.ServerProxy(url).changelog_since_serial(serial)  # nosec
+    except (OSError, xmlrpc.client.Error) as e:
+        print("Internet connection issue. Check connection")
+        print(e)
+        sys.exit(1)
+
+
+# Recently used package metadata, least recently used first
+METADATA_LRU = collections.OrderedDict()
+
+# Bytes used by each on-disk metadata cache folder, measured on first use
+METADATA_CACHE_BYTES = {}
+
+# Guard the metadata caches when metadata is fetched from several threads
+METADATA_LOCK = threading.Lock()
+
+
+def download_metadata(name, session=None, timeout=None):
+    """Download the compared metadata fields of one package from PyPI.
+
+    Args:
+        name (str): name of package on pypi for which to retrieve metadata
+        session (requests.Session): optional session whose connections to reuse
+        timeout (float): seconds to wait for a response, or None to wait forever
+
+    Returns:
+        dict: package metadata fields, blank if the package does not exist
+
+    Raises:
+        requests.exceptions.HTTPError: PyPI answered with an error other than 404
+    """
+    # Make call to specified PyPI package via API endpoint
+    link = "https://pypi.org/pypi/" + name + "/json"
+    response = (session or requests).get(link, timeout=timeout)
+    count("http_requests")
+    count("http_bytes", len(response.content))
+
+    # Deleted or renamed packages answer 404 with a body that has no "info"
+    info = {}
+    if response.status_code != 404:
+        response.raise_for_status()
+        try:
+            # Convert JSON to dict
+            info = response.json().get("info") or {}
+        except (json.decoder.JSONDecodeError, AttributeError):
+            info = {}
+
+    # Keep only the fields that are compared
+    return {field: info.get(field, "") for field in METADATA_FIELDS}
+
+
+def prune_metadata_cache(cache_folder, max_bytes):
+    """Evict the oldest cached metadata until the cache fits its size cap.
+
+    The cache is pruned to 90% of the cap so that eviction does not
+    run again on the very next write. Only finished entries are counted
+    and evicted, never the temporary files other threads are writing.
+
+    Args:
+        cache_folder (str): folder holding cached metadata
+        max_bytes (int): maximum total bytes of cached metadata
+
+    Returns:
+        int: bytes of cached metadata left after pruning
+    """
+    entries = [
+        (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+        for entry in os.scandir(cache_folder)
+        if entry.is_file() and entry.name.endswith(".json")
+    ]
+    total_bytes = sum(size for _, size, _ in entries)
+    if total_bytes > max_bytes:
+        for _, size, path in sorted(entries):
+            if total_bytes <= 0.9 * max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+    return total_bytes
+
+
+def get_metadata(
+    name,
+    cache_ttl=METADATA_CACHE_TTL,
+    cache_folder=os.path.join(CACHE_FOLDER, "metadata"),
+    max_cache_bytes=METADATA_CACHE_MAX_BYTES,
+    session=None,
+    timeout=None,
+):
     """Retrieve pypi package metadata for one package.
 
     Retrieve via an internet call to PyPI via JSON metadata on a particular
-    PyPI package and return this information.
+    PyPI package and return this information. Only the compared fields
+    are kept, and they are cached both in memory and on disk for
+    cache_ttl seconds, so repeated lookups of the same package cost no
+    further requests. The on-disk cache is capped at max_cache_bytes by
+    evicting the least recently fetched packages. Blank metadata, from a
+    package that does not exist or a response PyPI could not serve, is
+    not cached, so that a passing PyPI error is retried on the next run.
 
     Args:
         name (str): name of package on pypi for which to retrieve metadata
+        cache_ttl (int): seconds cached metadata is used before downloading again
+        cache_folder (str): folder in which to cache metadata
+        max_cache_bytes (int): maximum total bytes of the on-disk cache
+        session (requests.Session): optional session whose connections to reuse
+        timeout (float): seconds to wait for a response, or None to wait forever
 
     Returns:
         dict: package metadata
     """
-    try:
-        # Make call to specified PyPI package via API endpoint
-        link = "https://pypi.org/pypi/" + name + "/json"
-        response = requests.get(link)
-
-        # Convert JSON to dict
-        metadata_dict = response.json()
-    except json.decoder.JSONDecodeError as e:
-        metadata_dict = {
-            "info": {
-                "author_email": "",
-                "author": "",
-                "package_url": "",
-                "description": "",
-                "home_page": "",
-                "summary": "",
-            }
+    now = time()
+    cache_key = (cache_folder, name)
+
+    # Check the in-memory cache first
+    with METADATA_LOCK:
+        cached = METADATA_LRU.get(cache_key)
+        if cached is not None and now - cached["fetched_at"] < cache_ttl:
+            METADATA_LRU.move_to_end(cache_key)
+            count_cache("metadata", True)
+            return {"info": dict(cached["info"])}
+
+    # Then check the on-disk cache
+    path = os.path.join(cache_folder, urllib.parse.quote(name, safe="") + ".json")
+    cached = None
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+
+    # Download metadata when there is no fresh copy
+    fresh = cached is not None and now - cached["fetched_at"] < cache_ttl
+    count_cache("metadata", fresh)
+    if not fresh:
+        cached = {
+            "fetched_at": now,
+            "info": download_metadata(name, session=session, timeout=timeout),
         }
+        if not any(cached["info"].values()):
+            return {"info": dict(cached["info"])}
+        os.makedirs(cache_folder, exist_ok=True)
+        # Write to a temporary file so readers never see a partial entry
+        partial_path = path + "." + str(threading.get_ident()) + ".part"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            json.dump(cached, f, ensure_ascii=False)
+        with METADATA_LOCK:
+            if cache_folder not in METADATA_CACHE_BYTES:
+                METADATA_CACHE_BYTES[cache_folder] = prune_metadata_cache(
+                    cache_folder, max_cache_bytes
+                )
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(partial_path, path)
+            METADATA_CACHE_BYTES[cache_folder] += os.path.getsize(path) - old_size
+            if METADATA_CACHE_BYTES[cache_folder] > max_cache_bytes:
+                METADATA_CACHE_BYTES[cache_folder] = prune_metadata_cache(
+                    cache_folder, max_cache_bytes
+                )
+
+    # Remember the metadata in memory, evicting the least recently used
+    with METADATA_LOCK:
+        METADATA_LRU[cache_key] = cached
+        METADATA_LRU.move_to_end(cache_key)
+        while len(METADATA_LRU) > METADATA_LRU_SIZE:
+            METADATA_LRU.popitem(last=False)
 
     # Return dict version
-    return metadata_dict
+    return {"info": dict(cached["info"])}
+
+
+def get_metadata_concurrently(
+    names, max_workers=METADATA_WORKERS, timeout=METADATA_TIMEOUT
+):
+    """Retrieve pypi package metadata for many packages at once.
+
+    Downloads run on a bounded pool of threads that share one session,
+    so connections to PyPI are kept alive and reused. A package whose
+    metadata cannot be retrieved, e.g. because PyPI timed out, gets
+    blank metadata rather than stopping the whole batch.
+
+    Args:
+        names (iterable): names of packages on pypi
+        max_workers (int): maximum number of downloads at the same time
+        timeout (float): seconds to wait for each response
+
+    Returns:
+        dict: package name (key) and package metadata (value)
+    """
+    unique_names = list(dict.fromkeys(names))
+    metadata = {}
+    with requests.Session() as session:
+        # Allow one pooled connection per worker
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_workers
+        )
+        session.mount("https://", adapter)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {}
+            for name in unique_names:
+                future = executor.submit(
+                    get_metadata, name, session=session, timeout=timeout
+                )
+                futures[future] = name
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    metadata[name] = future.result()
+                except requests.exceptions.RequestException:
+                    metadata[name] = {"info": {field: "" for field in METADATA_FIELDS}}
+
+    return metadata
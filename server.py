@@ -0,0 +1,449 @@
+"""Answer typosquatting queries from a long-running local server.
+
+A module that contains functions that keep the package list and the
+indexes over it in memory, refresh them in the background, and answer
+mod-squatters, top-mods and defend-name queries over HTTP on localhost
+or on a Unix socket.
+
+Queries are GET requests whose parameters match the command line
+options, and answers are JSON. For instance:
+
+    curl "http://127.0.0.1:8765/mod-squatters?module=requests&module=numpy"
+    curl --unix-socket scan.sock "http://localhost/top-mods?number_packages=10"
+"""
+
+import http.server
+import json
+import os
+import re
+import socketserver
+import threading
+from time import time
+import urllib.parse
+
+import constants
+from filters import filter_by_package_name_len, load_whitelist
+from indexes import (
+    build_canonical_index,
+    build_metaphone_index,
+    build_name_index,
+    build_token_index,
+    snapshot_digest,
+)
+from scrapers import get_all_packages, get_top_packages
+from utils import (
+    assess_suspicious_packages,
+    create_potential_squatter_names,
+    create_suspicious_package_dict,
+)
+
+MIN_LEN_PACKAGE_NAME = constants.MIN_LEN_PACKAGE_NAME
+SERVE_PORT = constants.SERVE_PORT
+SERVE_REFRESH_INTERVAL = constants.SERVE_REFRESH_INTERVAL
+
+# Match a valid project name, as defined in PEP 508
+PACKAGE_NAME_PATTERN = re.compile(
+    r"^([A-Z0-9]|[A-Z0-9][A-Z0-9._-]*[A-Z0-9])$", re.IGNORECASE
+)
+
+
+def build_server_snapshot(package_names, top_packages, max_distance, distance_backend):
+    """Build the package list and indexes that queries are answered from.
+
+    Args:
+        package_names (list): all package names
+        top_packages (list): top packages, most downloaded first
+        max_distance (int): largest edit distance queries may ask for
+        distance_backend (str): one of DISTANCE_BACKENDS
+
+    Returns:
+        dict: package names, top packages and indexes
+    """
+    name_index = None
+    if distance_backend != "brute-force":
+        name_index = build_name_index(package_names, max_distance, distance_backend)
+    return {
+        "package_names": package_names,
+        "digest": snapshot_digest(package_names),
+        "top_packages": top_packages,
+        "name_index": name_index,
+        "metaphone_index": build_metaphone_index(package_names),
+        "token_index": build_token_index(package_names),
+        "canonical_index": build_canonical_index(package_names),
+        "refreshed": time(),
+    }
+
+
+def refresh_server_state(state):
+    """Download the package lists again and swap in new indexes if needed.
+
+    Indexes are only rebuilt when the package list has changed. The new
+    snapshot replaces the old one in a single assignment, so queries
+    running during a refresh keep using the old one. A failed download
+    keeps the old snapshot in place.
+
+    Args:
+        state (dict): server state made by load_server_state
+
+    Returns:
+        bool: whether the snapshot was replaced
+    """
+    old_snapshot = state["snapshot"]
+    try:
+        package_names = get_all_packages(
+            cache_max_age=state["cache_max_age"], offline=state["offline"]
+        )
+    except SystemExit:
+        # Downloads exit the program on failure; a server keeps running
+        return False
+
+    top_packages = old_snapshot["top_packages"] if old_snapshot else []
+    try:
+        top_packages = list(
+            get_top_packages(
+                top_n=state["top_n"],
+                stored=state["stored_json"],
+                cache_max_age=state["cache_max_age"],
+                offline=state["offline"],
+            )
+        )
+    except SystemExit:
+        pass
+
+    if old_snapshot and old_snapshot["digest"] == snapshot_digest(package_names):
+        old_snapshot["top_packages"] = top_packages
+        old_snapshot["refreshed"] = time()
+        return False
+
+    state["snapshot"] = build_server_snapshot(
+        package_names, top_packages, state["max_distance"], state["distance_backend"]
+    )
+    return True
+
+
+def load_server_state(
+    max_distance, top_n, stored_json, cache_max_age, offline, distance_backend="auto"
+):
+    """Download the package lists and build the initial server state.
+
+    Args:
+        max_distance (int): largest edit distance queries may ask for
+        top_n (int): the number of top packages to keep
+        stored_json (bool): whether to use the stored top packages json
+        cache_max_age (int): seconds cached downloads are used without revalidation
+        offline (bool): whether to only use cached downloads
+        distance_backend (str): one of DISTANCE_BACKENDS
+
+    Returns:
+        dict: settings and the snapshot that queries are answered from
+    """
+    state = {
+        "max_distance": max_distance,
+        "top_n": top_n,
+        "stored_json": stored_json,
+        "cache_max_age": cache_max_age,
+        "offline": offline,
+        "distance_backend": distance_backend,
+        "snapshot": None,
+    }
+    refresh_server_state(state)
+    if state["snapshot"] is None:
+        raise RuntimeError("Could not download the PyPI package list.")
+    return state
+
+
+def refresh_periodically(state, refresh_interval, stop_event):
+    """Refresh the server state until asked to stop.
+
+    Args:
+        state (dict): server state made by load_server_state
+        refresh_interval (float): seconds between refreshes
+        stop_event (threading.Event): set to stop refreshing
+    """
+    while not stop_event.wait(refresh_interval):
+        refresh_server_state(state)
+
+
+def query_int(params, name, default):
+    """Read an integer query parameter.
+
+    Args:
+        params (dict): query parameters, as from urllib.parse.parse_qs
+        name (str): name of the parameter
+        default (int): value used when the parameter is missing
+
+    Returns:
+        int: value of the parameter
+    """
+    if name not in params:
+        return default
+    value = params[name][0]
+    if not re.fullmatch(r"[0-9]+", value):
+        raise ValueError(name + " must be a non-negative integer.")
+    return int(value)
+
+
+def query_modules(params):
+    """Read the package names given in module query parameters.
+
+    Args:
+        params (dict): query parameters, as from urllib.parse.parse_qs
+
+    Returns:
+        list: package names to answer the query for
+    """
+    if "module" not in params:
+        raise ValueError("The module parameter is required.")
+    for module in params["module"]:
+        if not PACKAGE_NAME_PATTERN.match(module):
+            raise ValueError(module + " is not a valid package name.")
+    return params["module"]
+
+
+def query_edit_distance(state, params):
+    """Read the edit distance of a query, checking the indexes can answer it.
+
+    Args:
+        state (dict): server state made by load_server_state
+        params (dict): query parameters, as from urllib.parse.parse_qs
+
+    Returns:
+        int: the edit distance to screen with
+    """
+    max_distance = query_int(params, "edit_distance", state["max_distance"])
+    if not 0 <= max_distance <= state["max_distance"]:
+        raise ValueError(
+            "edit_distance must be between 0 and "
+            + str(state["max_distance"])
+            + ", the distance the server was started with."
+        )
+    return max_distance
+
+
+def screen_packages(state, packages, params):
+    """Screen packages against the resident indexes.
+
+    Whitelisted names are dropped while screening, before any metadata
+    is fetched.
+
+    Args:
+        state (dict): server state made by load_server_state
+        packages (list): package names to screen
+        params (dict): query parameters, as from urllib.parse.parse_qs
+
+    Returns:
+        dict: potential typosquatters of each package and, if the
+        metadata parameter is set, the risk of each pair
+    """
+    snapshot = state["snapshot"]
+    squat_candidates = create_suspicious_package_dict(
+        snapshot["package_names"],
+        packages,
+        query_edit_distance(state, params),
+        snapshot["name_index"],
+        snapshot["metaphone_index"],
+        snapshot["token_index"],
+        distance_backend=state["distance_backend"],
+        canonical_index=snapshot["canonical_index"],
+        compiled_whitelist=load_whitelist(),
+    )
+    answer = {"results": squat_candidates}
+    if params.get("metadata", ["false"])[0].lower() in ["1", "true", "yes"]:
+        risks = assess_suspicious_packages(squat_candidates)
+        answer["risks"] = [
+            {"package": package, "squatter": squatter, "risk": risk}
+            for (package, squatter), risk in risks.items()
+        ]
+    return answer
+
+
+def query_mod_squatters(state, params):
+    """Find potential typosquatters of one or more packages.
+
+    Args:
+        state (dict): server state made by load_server_state
+        params (dict): query parameters, as from urllib.parse.parse_qs
+
+    Returns:
+        dict: answer to send back as JSON
+    """
+    return screen_packages(state, query_modules(params), params)
+
+
+def query_top_mods(state, params):
+    """Find potential typosquatters of the top packages.
+
+    Args:
+        state (dict): server state made by load_server_state
+        params (dict): query parameters, as from urllib.parse.parse_qs
+
+    Returns:
+        dict: answer to send back as JSON
+    """
+    if not state["snapshot"]["top_packages"]:
+        raise ValueError("The top packages list could not be downloaded.")
+    top_n = query_int(params, "number_packages", state["top_n"])
+    if not 0 <= top_n <= len(state["snapshot"]["top_packages"]):
+        raise ValueError(
+            "number_packages must be between 0 and "
+            + str(len(state["snapshot"]["top_packages"]))
+            + "."
+        )
+    min_len = query_int(params, "len_package_name", MIN_LEN_PACKAGE_NAME)
+    top_packages = state["snapshot"]["top_packages"][:top_n]
+    filtered_package_list = filter_by_package_name_len(top_packages, min_len=min_len)
+    return screen_packages(state, filtered_package_list, params)
+
+
+def query_defend_name(state, params):
+    """List names within a keyboard typo of one or more packages.
+
+    Args:
+        state (dict): server state made by load_server_state
+        params (dict): query parameters, as from urllib.parse.parse_qs
+
+    Returns:
+        dict: answer to send back as JSON
+    """
+    return {
+        "results": {
+            module: sorted(create_potential_squatter_names(module))
+            for module in query_modules(params)
+        }
+    }
+
+
+def query_health(state, params):
+    """Describe the snapshot that queries are answered from.
+
+    Args:
+        state (dict): server state made by load_server_state
+        params (dict): query parameters, as from urllib.parse.parse_qs
+
+    Returns:
+        dict: answer to send back as JSON
+    """
+    snapshot = state["snapshot"]
+    return {
+        "packages": len(snapshot["package_names"]),
+        "top_packages": len(snapshot["top_packages"]),
+        "refreshed": snapshot["refreshed"],
+    }
+
+
+# Map each path the server answers to the function that answers it
+QUERY_FUNCTIONS = {
+    "/mod-squatters": query_mod_squatters,
+    "/top-mods": query_top_mods,
+    "/defend-name": query_defend_name,
+    "/health": query_health,
+}
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    """Answer GET requests with the query function for their path."""
+
+    def do_GET(self):
+        """Answer a GET request with JSON.
+
+        Unknown paths are answered with a 404 and invalid query
+        parameters with a 400, each carrying an error message.
+        """
+        url = urllib.parse.urlsplit(self.path)
+        query_function = QUERY_FUNCTIONS.get(url.path)
+        if query_function is None:
+            self.send_json(404, {"error": "Unknown path " + url.path})
+            return
+        try:
+            answer = query_function(self.server.state, urllib.parse.parse_qs(url.query))
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(200, answer)
+
+    def send_json(self, status, answer):
+        """Send a response with a JSON body.
+
+        Args:
+            status (int): HTTP status code
+            answer (dict): body to send as JSON
+        """
+        body = json.dumps(answer, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        """Describe the client in request logs.
+
+        Returns:
+            str: client address, or "unix" for Unix socket clients
+        """
+        # Unix socket clients have no address to log
+        if not self.client_address:
+            return "unix"
+        return super().address_string()
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve HTTP on a Unix socket, one thread per request."""
+
+    daemon_threads = True
+
+
+def make_server(state, port=SERVE_PORT, socket_path=None):
+    """Create a server that answers queries from the given state.
+
+    Args:
+        state (dict): server state made by load_server_state
+        port (int): localhost port to listen on
+        socket_path (str): Unix socket to listen on instead of a port
+
+    Returns:
+        socketserver.BaseServer: server that has not started serving yet
+    """
+    if socket_path:
+        # Remove a socket left behind by a previous server
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, QueryHandler)
+    else:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), QueryHandler)
+    server.state = state
+    return server
+
+
+def run_server(
+    state, port=SERVE_PORT, socket_path=None, refresh_interval=SERVE_REFRESH_INTERVAL
+):
+    """Answer queries until interrupted, refreshing in the background.
+
+    Args:
+        state (dict): server state made by load_server_state
+        port (int): localhost port to listen on
+        socket_path (str): Unix socket to listen on instead of a port
+        refresh_interval (float): seconds between refreshes
+    """
+    server = make_server(state, port, socket_path)
+    stop_event = threading.Event()
+    refresher = threading.Thread(
+        target=refresh_periodically,
+        args=(state, refresh_interval, stop_event),
+        daemon=True,
+    )
+    refresher.start()
+    if socket_path:
+        print("Answering queries on " + socket_path)
+    else:
+        print("Answering queries on http://127.0.0.1:" + str(server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,251 @@
+"""Store and read snapshots of the full PyPI package list.
+
+A module that contains functions that save the full list of package
+names in a compact binary format and read it back without parsing the
+whole file.
+
+A full snapshot starts with a JSON header line, padded so that the
+array after it stays aligned. An array of offsets follows, then one
+blob of the sorted UTF-8 encoded names. The file can be memory-mapped
+and searched by bisection, and the names are decoded only when they are
+read. A delta snapshot holds only a JSON header line with the names
+added and removed since a base snapshot in the same folder.
+
+Package list snapshots written as JSON by earlier versions can be read
+by the same functions.
+"""
+
+import array
+import functools
+import hashlib
+import json
+import mmap
+import os
+import sys
+
+import constants
+
+CHUNK_SIZE = constants.CHUNK_SIZE
+
+
+def snapshot_from_names(package_names, depth=0):
+    """Arrange package names as an in-memory snapshot.
+
+    Args:
+        package_names (iterable): package names in the snapshot
+        depth (int): number of delta snapshots read to get these names
+
+    Returns:
+        dict: snapshot with the same layout as a mapped snapshot file
+    """
+    encoded_names = sorted({package.encode("utf-8") for package in package_names})
+    offsets = array.array("I", [0])
+    for encoded in encoded_names:
+        offsets.append(offsets[-1] + len(encoded))
+    return {
+        "count": len(encoded_names),
+        "depth": depth,
+        "offsets": memoryview(offsets),
+        "names": memoryview(b"".join(encoded_names)),
+    }
+
+
+def write_snapshot(package_names, path):
+    """Write package names to a full snapshot file.
+
+    Names are sorted by their UTF-8 encoding, which matches the order
+    of sorting them as strings. The file is written under a temporary
+    name and moved into place, so readers never see a partial file.
+
+    Args:
+        package_names (iterable): package names in the snapshot
+        path (str): file to write the snapshot to
+    """
+    snapshot = snapshot_from_names(package_names)
+    header = {"format": "full", "byteorder": sys.byteorder, "count": snapshot["count"]}
+    header_line = json.dumps(header).encode("utf-8")
+    header_line += b" " * (-(len(header_line) + 1) % 4) + b"\n"
+
+    with open(path + ".part", "wb") as f:
+        f.write(header_line)
+        f.write(snapshot["offsets"])
+        f.write(snapshot["names"])
+    os.replace(path + ".part", path)
+
+
+def write_delta_snapshot(package_names, path, base_path):
+    """Write package names as the changes since a base snapshot.
+
+    Args:
+        package_names (iterable): package names in the snapshot
+        path (str): file to write the snapshot to
+        base_path (str): snapshot in the same folder that the changes apply to
+    """
+    base_snapshot = open_snapshot(base_path)
+    current_packages = set(package_names)
+    removed_packages = []
+    for package in iter_snapshot(base_snapshot):
+        if package in current_packages:
+            current_packages.remove(package)
+        else:
+            removed_packages.append(package)
+
+    header = {
+        "format": "delta",
+        "base": os.path.basename(base_path),
+        "depth": base_snapshot["depth"] + 1,
+        "added": sorted(current_packages),
+        "removed": removed_packages,
+    }
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False)
+        f.write("\n")
+    os.replace(path + ".part", path)
+
+
+def open_snapshot(path):
+    """Open a package list snapshot of any format.
+
+    Full snapshots are memory-mapped. Delta snapshots are applied to
+    their base snapshot, and JSON snapshots are parsed, and both are
+    then arranged in memory with the same layout.
+
+    Args:
+        path (str): snapshot file to open
+
+    Returns:
+        dict: snapshot that snapshot_name, iter_snapshot and
+        snapshot_contains can read
+    """
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return snapshot_from_names(json.load(f))
+
+    with open(path, "rb") as f:
+        header_line = f.readline()
+        header = json.loads(header_line)
+        if header["format"] == "delta":
+            base_path = os.path.join(os.path.dirname(path), header["base"])
+            removed_packages = set(header["removed"])
+            package_names = [
+                package
+                for package in iter_snapshot(open_snapshot(base_path))
+                if package not in removed_packages
+            ]
+            package_names.extend(header["added"])
+            return snapshot_from_names(package_names, header["depth"])
+        buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    names_start = len(header_line) + 4 * (header["count"] + 1)
+    offsets = buffer[len(header_line) : names_start].cast("I")
+    if header["byteorder"] != sys.byteorder:
+        # Offsets written on a machine of the other byte order are copied
+        offsets = array.array("I", offsets)
+        offsets.byteswap()
+        offsets = memoryview(offsets)
+    return {
+        "count": header["count"],
+        "depth": 0,
+        "offsets": offsets,
+        "names": buffer[names_start:],
+    }
+
+
+def snapshot_name(snapshot, position):
+    """Read one name from a snapshot.
+
+    Args:
+        snapshot (dict): snapshot opened by open_snapshot
+        position (int): position of the name in sorted order
+
+    Returns:
+        str: the package name
+    """
+    offsets = snapshot["offsets"]
+    return str(snapshot["names"][offsets[position] : offsets[position + 1]], "utf-8")
+
+
+def iter_snapshot(snapshot):
+    """Read the names of a snapshot one at a time in sorted order.
+
+    Args:
+        snapshot (dict): snapshot opened by open_snapshot
+
+    Yields:
+        str: package names in sorted order
+    """
+    for position in range(snapshot["count"]):
+        yield snapshot_name(snapshot, position)
+
+
+def snapshot_contains(snapshot, package):
+    """Check whether a snapshot holds a package by bisection.
+
+    Args:
+        snapshot (dict): snapshot opened by open_snapshot
+        package (str): package name to look for
+
+    Returns:
+        bool: whether the package is in the snapshot
+    """
+    encoded = package.encode("utf-8")
+    offsets = snapshot["offsets"]
+    names = snapshot["names"]
+    low, high = 0, snapshot["count"]
+    while low < high:
+        middle = (low + high) // 2
+        name = bytes(names[offsets[middle] : offsets[middle + 1]])
+        if name < encoded:
+            low = middle + 1
+        elif name > encoded:
+            high = middle
+        else:
+            return True
+    return False
+
+
+def diff_snapshots(old_snapshot, new_snapshot):
+    """Find the names added and removed between two snapshots.
+
+    Both snapshots are read in sorted order and merged, so only one
+    name from each is held at a time, however many names they hold.
+
+    Args:
+        old_snapshot (dict): earlier snapshot opened by open_snapshot
+        new_snapshot (dict): later snapshot opened by open_snapshot
+
+    Yields:
+        tuple: package name and either "added" or "removed", in sorted order
+    """
+    old_names = iter_snapshot(old_snapshot)
+    new_names = iter_snapshot(new_snapshot)
+    old_package = next(old_names, None)
+    new_package = next(new_names, None)
+    while old_package is not None or new_package is not None:
+        if new_package is None or (
+            old_package is not None and old_package < new_package
+        ):
+            yield old_package, "removed"
+            old_package = next(old_names, None)
+        elif old_package is None or new_package < old_package:
+            yield new_package, "added"
+            new_package = next(new_names, None)
+        else:
+            old_package = next(old_names, None)
+            new_package = next(new_names, None)
+
+
+def snapshot_checksum(path):
+    """Compute the checksum of a snapshot file.
+
+    Args:
+        path (str): snapshot file to read
+
+    Returns:
+        str: hex SHA-256 digest of the file contents
+    """
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
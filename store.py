@@ -0,0 +1,232 @@
+"""Keep the history of scans in an embedded SQLite database.
+
+A module that contains functions that record when each package name
+was first and last seen in a stored package list, when each potential
+typosquatter was first and last found, and the metadata retrieved for
+each package, and that answer questions about that history with index
+lookups rather than by reading every stored file.
+
+Writes are split into batches of STORE_BATCH_SIZE rows, each written
+in one transaction, so that a million names are stored quickly without
+holding one huge transaction open. Names are written in sorted order,
+so each batch touches few pages of the names table, and rows that
+would not change are not rewritten.
+"""
+
+import os
+import sqlite3
+from time import time
+
+import constants
+
+METADATA_FIELDS = constants.METADATA_FIELDS
+STORE_BATCH_SIZE = constants.STORE_BATCH_SIZE
+
+# Tables and indexes of the store, created when it is first opened
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    taken_at REAL PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS findings (
+    package TEXT NOT NULL,
+    squatter TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (package, squatter)
+);
+CREATE INDEX IF NOT EXISTS findings_squatter ON findings (squatter);
+CREATE INDEX IF NOT EXISTS findings_first_seen ON findings (first_seen);
+CREATE TABLE IF NOT EXISTS metadata (
+    name TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    {fields}
+);
+CREATE INDEX IF NOT EXISTS metadata_author_email ON metadata (author_email);
+""".format(
+    fields=",\n    ".join(field + " TEXT" for field in METADATA_FIELDS)
+)
+
+
+def open_store(folder="package_lists"):
+    """Open the store, creating it if it does not exist yet.
+
+    Args:
+        folder (str): folder in which the store is kept
+
+    Returns:
+        sqlite3.Connection: connection to the store
+    """
+    os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(folder, "pypi-scan.sqlite3"))
+    connection.executescript(STORE_SCHEMA)
+    return connection
+
+
+def write_in_batches(connection, statements, rows, batch_size=STORE_BATCH_SIZE):
+    """Run statements over many rows, one transaction per batch.
+
+    Args:
+        connection (sqlite3.Connection): connection to the store
+        statements (list): SQL statements, each run with executemany over a batch
+        rows (iterable): parameters of each row
+        batch_size (int): number of rows written in each transaction
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            with connection:
+                for statement in statements:
+                    connection.executemany(statement, batch)
+            batch = []
+    if batch:
+        with connection:
+            for statement in statements:
+                connection.executemany(statement, batch)
+
+
+def record_snapshot(connection, package_names, taken_at=None):
+    """Record that package names were seen in a package list.
+
+    Names seen before keep their first_seen time, and their last_seen
+    time moves forward to taken_at.
+
+    Args:
+        connection (sqlite3.Connection): connection to the store
+        package_names (iterable): names in the package list
+        taken_at (float): time the package list was downloaded, by default now
+    """
+    taken_at = time() if taken_at is None else taken_at
+    package_names = sorted(set(package_names))
+    write_in_batches(
+        connection,
+        [
+            "INSERT OR IGNORE INTO names VALUES (?1, ?2, ?2)",
+            "UPDATE names SET first_seen = MIN(first_seen, ?2),"
+            " last_seen = MAX(last_seen, ?2)"
+            " WHERE name = ?1 AND (first_seen > ?2 OR last_seen < ?2)",
+        ],
+        ((package, taken_at) for package in package_names),
+    )
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?)",
+            (taken_at, len(package_names)),
+        )
+
+
+def name_history(connection, package):
+    """Look up when a package name was first and last seen.
+
+    Args:
+        connection (sqlite3.Connection): connection to the store
+        package (str): package name
+
+    Returns:
+        tuple: first and last time the name was seen, or None if never seen
+    """
+    return connection.execute(
+        "SELECT first_seen, last_seen FROM names WHERE name = ?", (package,)
+    ).fetchone()
+
+
+def record_findings(connection, pairs, found_at=None):
+    """Record that packages were found to be potential typosquatters.
+
+    Args:
+        connection (sqlite3.Connection): connection to the store
+        pairs (iterable): (package, potential typosquatter) pairs
+        found_at (float): time of the scan, by default now
+    """
+    found_at = time() if found_at is None else found_at
+    write_in_batches(
+        connection,
+        [
+            "INSERT OR IGNORE INTO findings VALUES (?1, ?2, ?3, ?3)",
+            "UPDATE findings SET first_seen = MIN(first_seen, ?3),"
+            " last_seen = MAX(last_seen, ?3)"
+            " WHERE package = ?1 AND squatter = ?2"
+            " AND (first_seen > ?3 OR last_seen < ?3)",
+        ],
+        ((package, squatter, found_at) for package, squatter in pairs),
+    )
+
+
+def finding_history(connection, package):
+    """Look up every finding involving a package, on either side.
+
+    Args:
+        connection (sqlite3.Connection): connection to the store
+        package (str): package name
+
+    Returns:
+        list: (package, potential typosquatter, first found, last found)
+        tuples, oldest first
+    """
+    return connection.execute(
+        "SELECT package, squatter, first_seen, last_seen FROM findings"
+        " WHERE squatter = ?1 OR package = ?1 ORDER BY first_seen, package, squatter",
+        (package,),
+    ).fetchall()
+
+
+def record_metadata(connection, metadata, fetched_at=None):
+    """Record package metadata retrieved from PyPI.
+
+    Args:
+        connection (sqlite3.Connection): connection to the store
+        metadata (dict): package name (key) and package metadata (value),
+        as from get_metadata_concurrently
+        fetched_at (float): time the metadata was retrieved, by default now
+    """
+    fetched_at = time() if fetched_at is None else fetched_at
+    placeholders = ", ".join("?" * (len(METADATA_FIELDS) + 2))
+    write_in_batches(
+        connection,
+        ["INSERT OR REPLACE INTO metadata VALUES (" + placeholders + ")"],
+        (
+            [name, fetched_at]
+            + [
+                str(package_metadata["info"].get(field, ""))
+                for field in METADATA_FIELDS
+            ]
+            for name, package_metadata in metadata.items()
+            # Blank metadata means the download failed or the package is gone
+            if any(package_metadata["info"].get(field) for field in METADATA_FIELDS)
+        ),
+    )
+
+
+def stored_metadata(connection, names, max_age=None):
+    """Read stored metadata of packages.
+
+    Args:
+        connection (sqlite3.Connection): connection to the store
+        names (iterable): package names to read
+        max_age (float): seconds stored metadata is used, or None for any age
+
+    Returns:
+        dict: package name (key) and package metadata (value), in the
+        format of get_metadata with the time it was retrieved added as
+        "fetched_at", for packages with recent enough metadata
+    """
+    oldest = -1 if max_age is None else time() - max_age
+    metadata = {}
+    query = (
+        "SELECT fetched_at, " + ", ".join(METADATA_FIELDS) + " FROM metadata"
+        " WHERE name = ? AND fetched_at >= ?"
+    )
+    for name in names:
+        row = connection.execute(query, (name, oldest)).fetchone()
+        if row is not None:
+            metadata[name] = {
+                "info": dict(zip(METADATA_FIELDS, row[1:])),
+                "fetched_at": row[0],
+            }
+    return metadata
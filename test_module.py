@@ -1,28 +1,130 @@
 """Test all functions used to execute pypi-scan"""
 
 import collections
+import functools
+import http.server
 from io import StringIO
+import json
 import os
+import shutil
+import socket
+import sqlite3
 import subprocess  # nosec
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+import urllib.error
+import urllib.request
+import xmlrpc.server
 
+from benchmarks import compare_to_baseline, synthetic_package_names
+import constants
+import filters
 from filters import (
+    compile_whitelist,
     distance_calculations,
+    drop_equivalent_names,
+    drop_whitelisted,
     filter_by_package_name_len,
     homophone_attack_screen,
+    is_whitelisted,
+    load_whitelist,
     order_attack_screen,
     whitelist,
 )
-from scrapers import get_all_packages, get_top_packages, get_metadata
+from fingerprints import (
+    fingerprint_risk,
+    fresh_packages,
+    ingest_metadata_dump,
+    load_fingerprint_table,
+    metadata_clusters,
+    new_fingerprint_table,
+    save_fingerprint_table,
+    shared_metadata_packages,
+    update_fingerprint_table,
+)
+import indexes
+from indexes import (
+    build_bk_tree,
+    build_canonical_index,
+    build_deletion_index,
+    build_metaphone_index,
+    build_name_index,
+    build_numpy_index,
+    build_qgram_index,
+    build_token_index,
+    canonical_name,
+    choose_backend,
+    deletion_variants,
+    get_metaphone_index,
+    get_name_index,
+    get_qgram_index,
+    qgrams,
+    search_bk_tree,
+    search_deletion_index,
+    search_name_index,
+    search_numpy_index,
+    update_canonical_index,
+    update_name_index,
+    update_token_index,
+)
+import metrics
+from metrics import count, count_cache, enable_metrics, metrics_report, stage
+import scrapers
+import utils
+from scrapers import (
+    fetch_cached,
+    get_all_packages,
+    get_top_packages,
+    get_metadata,
+    get_metadata_concurrently,
+    parse_simple_index,
+    prune_metadata_cache,
+)
+from server import (
+    QueryHandler,
+    build_server_snapshot,
+    make_server,
+    refresh_server_state,
+)
+from snapshots import (
+    diff_snapshots,
+    iter_snapshot,
+    open_snapshot,
+    snapshot_contains,
+    snapshot_name,
+    write_delta_snapshot,
+    write_snapshot,
+)
+from store import (
+    finding_history,
+    name_history,
+    open_store,
+    record_findings,
+    record_metadata,
+    record_snapshot,
+    stored_metadata,
+)
 from utils import (
+    assess_suspicious_packages,
+    backoff_delay,
     compare_metadata,
+    create_cached_suspicious_package_dict,
     create_potential_squatter_names,
     create_suspicious_package_dict,
+    get_keyboard_variants,
+    keyboard_typo_screen,
+    list_package_snapshots,
     load_most_recent_packages,
+    load_most_recent_snapshot,
+    load_snapshot_catalog,
+    metadata_risk,
     print_suspicious_packages,
     store_recent_scan_results,
     store_squatting_candidates,
+    sync_package_list,
+    watch_new_packages,
 )
 
 
@@ -34,6 +136,74 @@ class TestFunctions(unittest.TestCase):
         package_names = get_all_packages()
         self.assertTrue(len(package_names) > 200000)
 
+    def start_test_server(self):
+        """Serve test_data from a local stand-in for PyPI.
+
+        Returns:
+            tuple: server base url and list of response status codes sent
+        """
+        status_codes = []
+
+        class QuietHandler(http.server.SimpleHTTPRequestHandler):
+            def log_request(self, code="-", size="-"):
+                status_codes.append(int(code))
+
+        handler = functools.partial(QuietHandler, directory="test_data")
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:" + str(server.server_address[1]), status_codes
+
+    def test_get_all_packages_local(self):
+        """Test get_all_packages against a local stand-in for PyPI."""
+        url, _ = self.start_test_server()
+        expected = ["nmap-python", "python-nmap", "requests", "requestz"]
+        with tempfile.TemporaryDirectory() as folder:
+            # HTML simple index
+            output = get_all_packages(url + "/simple/", cache_folder=folder)
+            self.assertEqual(output, expected)
+            # JSON simple index
+            output = get_all_packages(url + "/simple.json", cache_folder=folder)
+            self.assertEqual(output, expected)
+
+    def test_fetch_cached(self):
+        """Test fetch_cached revalidates and works offline."""
+        url, status_codes = self.start_test_server()
+        page = url + "/simple.json"
+        with tempfile.TemporaryDirectory() as folder:
+            # Nothing cached yet, so offline mode must fail
+            with self.assertRaises(SystemExit):
+                with patch("sys.stdout", new=StringIO()):
+                    fetch_cached(page, offline=True, cache_folder=folder)
+            path, content_type = fetch_cached(page, cache_folder=folder)
+            self.assertEqual(content_type, "application/json")
+            with open(path, "rb") as f, open("test_data/simple.json", "rb") as g:
+                self.assertEqual(f.read(), g.read())
+            # Fresh copy is served without a request
+            self.assertEqual(fetch_cached(page, cache_folder=folder)[0], path)
+            self.assertEqual(status_codes, [200])
+            # Stale copy is revalidated with a conditional request
+            fetch_cached(page, cache_max_age=0, cache_folder=folder)
+            self.assertEqual(status_codes, [200, 304])
+            # Offline mode ignores the age of the cached copy
+            output = fetch_cached(
+                page, cache_max_age=0, offline=True, cache_folder=folder
+            )
+            self.assertEqual(output, (path, content_type))
+            self.assertEqual(status_codes, [200, 304])
+
+    def test_parse_simple_index(self):
+        """Test parse_simple_index when names are split across chunks."""
+        html_page = b'<a href="/simple/a-b/">a-b</a><a href="/simple/c/">c&#95;d</a>'
+        chunks = [html_page[i : i + 3] for i in range(0, len(html_page), 3)]
+        self.assertEqual(list(parse_simple_index(chunks)), ["a-b", "c_d"])
+
+        json_page = b'{"projects": [{"name": "a-b"}, {"name": "c\\u00e9"}]}'
+        chunks = [json_page[i : i + 2] for i in range(0, len(json_page), 2)]
+        output = list(parse_simple_index(chunks, json_format=True))
+        self.assertEqual(output, ["a-b", "c\u00e9"])
+
     def test_get_top_packages(self):
         """Test get_top_packages function."""
         # Check default setting
@@ -58,6 +228,132 @@ class TestFunctions(unittest.TestCase):
         squatters = distance_calculations(package_of_interest, all_packages)
         self.assertEqual(squatters, ["bat"])
 
+    def test_distance_calculations_with_index(self):
+        """Test distance_calculations matches brute force when using an index."""
+        all_packages = ["bat", "apple", "cat", "cart", "act", "bat", "dog"]
+        name_index = build_bk_tree(all_packages)
+        for max_distance in [0, 1, 2, 3]:
+            expected = distance_calculations("cat", all_packages, max_distance)
+            output = distance_calculations(
+                "cat", all_packages, max_distance, name_index
+            )
+            self.assertEqual(output, expected)
+
+    def test_bk_tree(self):
+        """Test build_bk_tree and search_bk_tree functions."""
+        bk_tree = build_bk_tree(["requests", "request", "requests", "numpy"])
+        self.assertEqual(bk_tree["names"], ["requests", "request", "numpy"])
+        self.assertEqual(bk_tree["counts"], [2, 1, 1])
+        matches = search_bk_tree(bk_tree, "requests", 1)
+        self.assertEqual(sorted(matches), ["request", "requests", "requests"])
+        self.assertEqual(search_name_index(bk_tree, "numpy", 0), ["numpy"])
+        self.assertEqual(search_bk_tree(build_bk_tree([]), "numpy", 1), [])
+
+    def test_update_name_index(self):
+        """Test update_name_index function."""
+        all_packages = ["requests", "requestz", "request", "requestsss", "numpy"]
+        added = ["requestx", "nunpy"]
+        removed = ["requestz", "requests"]
+        updated_packages = [p for p in all_packages if p not in removed] + added
+        for backend in ["deletion", "bk-tree"]:
+            name_index = build_name_index(all_packages, 2, backend)
+            update_name_index(name_index, added, removed)
+            rebuilt_index = build_name_index(updated_packages, 2, backend)
+            for package in ["requests", "numpy", "requestsss"]:
+                self.assertEqual(
+                    sorted(search_name_index(name_index, package, 2)),
+                    sorted(search_name_index(rebuilt_index, package, 2)),
+                )
+        with self.assertRaises(ValueError):
+            update_name_index(build_qgram_index(all_packages), added, removed)
+
+    def test_deletion_index(self):
+        """Test build_deletion_index and search_deletion_index functions."""
+        self.assertEqual(deletion_variants("cat", 1), {"cat", "at", "ct", "ca"})
+        all_packages = ["requests", "requestz", "request", "requestsss", "numpy"]
+        deletion_index = build_deletion_index(all_packages, 2, prefix_len=4)
+        for max_distance in [0, 1, 2]:
+            expected = distance_calculations("requests", all_packages, max_distance)
+            output = distance_calculations(
+                "requests", all_packages, max_distance, deletion_index
+            )
+            self.assertEqual(output, expected)
+        self.assertEqual(search_deletion_index(deletion_index, "numpy", 0), ["numpy"])
+        with self.assertRaises(ValueError):
+            search_deletion_index(deletion_index, "numpy", 3)
+
+    def test_get_name_index(self):
+        """Test get_name_index function."""
+        name_index = get_name_index(["eeny", "meeny", "miny"], 1)
+        self.assertEqual(name_index["kind"], "deletion")
+        # Same snapshot in a different order reuses the built index
+        self.assertIs(get_name_index({"miny", "meeny", "eeny"}, 1), name_index)
+        self.assertEqual(choose_backend(1), "deletion")
+        self.assertEqual(choose_backend(3), "qgram")
+        self.assertEqual(choose_backend(3, "numpy"), "numpy")
+        bk_tree = get_name_index(["eeny", "meeny", "miny"], 1, "bk-tree")
+        self.assertEqual(bk_tree["kind"], "bk_tree")
+        with self.assertRaises(ValueError):
+            build_name_index(["eeny", "meeny"], 1, "soundex")
+
+    def test_qgram_index(self):
+        """Test build_qgram_index and search_qgram_index functions."""
+        self.assertEqual(qgrams("abab"), ["\0a0", "ab0", "ba0", "ab1", "b\x000"])
+        all_packages = [
+            "requests",
+            "requestz",
+            "rekwests",
+            "numpy",
+            "nunpy",
+            "",
+            "a",
+            "requestz",
+        ]
+        qgram_index = build_qgram_index(all_packages)
+        self.assertEqual(qgram_index["length_starts"], [0, 1, 2, 2, 2, 2, 4, 4, 4, 8])
+        for max_distance in [0, 1, 2, 3]:
+            for package in ["requests", "requést", "num-py", "a", ""]:
+                expected = distance_calculations(package, all_packages, max_distance)
+                output = distance_calculations(
+                    package, all_packages, max_distance, qgram_index
+                )
+                self.assertEqual(output, expected)
+        self.assertEqual(search_name_index(qgram_index, "numpy", 0), ["numpy"])
+
+    def test_get_qgram_index(self):
+        """Test get_qgram_index stores and maps the index."""
+        with tempfile.TemporaryDirectory() as folder:
+            qgram_index = get_qgram_index(["requests", "requestz"], folder)
+            path = os.path.join(folder, "pypi-qgram-index.bin")
+            self.assertTrue(os.path.exists(path))
+            modified = os.path.getmtime(path)
+            # The same snapshot maps the stored index rather than rebuilding it
+            qgram_index = get_qgram_index(["requestz", "requests"], folder)
+            self.assertEqual(os.path.getmtime(path), modified)
+            output = search_name_index(qgram_index, "requests", 1)
+            self.assertEqual(sorted(output), ["requests", "requestz"])
+            # A new snapshot rebuilds the stored index
+            qgram_index = get_qgram_index(["numpy", "nunpy"], folder)
+            self.assertEqual(
+                sorted(search_name_index(qgram_index, "numpy", 1)), ["numpy", "nunpy"]
+            )
+
+    @unittest.skipUnless(indexes.np, "numpy is not installed")
+    def test_numpy_index(self):
+        """Test build_numpy_index and search_numpy_index functions."""
+        all_packages = ["requests", "requestz", "request", "rekuests", "numpy", ""]
+        numpy_index = build_numpy_index(all_packages)
+        self.assertEqual(numpy_index["names"][8], ["requests", "requestz", "rekuests"])
+        self.assertEqual(numpy_index["codes"][8].shape, (3, 8))
+        for max_distance in [0, 1, 2, 3]:
+            for package in ["requests", "requést", "num-py", ""]:
+                expected = distance_calculations(package, all_packages, max_distance)
+                output = distance_calculations(
+                    package, all_packages, max_distance, numpy_index
+                )
+                self.assertEqual(output, expected)
+        self.assertEqual(search_numpy_index(numpy_index, "numpy", 0), ["numpy"])
+
     def test_filter_by_package_name_len(self):
         """Test filterByPackageNameLen."""
         initial_list = ["eeny", "meeny", "miny", "moe"]
@@ -78,6 +374,66 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(len(result), 2)
         self.assertTrue("key1" in result)
 
+        # Candidates keep their order
+        result = whitelist({"key": ["c", "val1", "b", "a"]}, "test_data/whitelist.txt")
+        self.assertEqual(result, {"key": ["c", "b", "a"]})
+
+    def test_compile_whitelist(self):
+        """Test whitelist names, globs and pairs."""
+        compiled_whitelist = compile_whitelist(
+            [
+                "Foo_Bar\n",
+                "django-*  # Known good plugins\n",
+                "numpy:nunpy\n",
+                "requests:req?\n",
+                "\n",
+                "# Comment\n",
+            ]
+        )
+        self.assertTrue(is_whitelisted(compiled_whitelist, "foo.bar"))
+        self.assertTrue(is_whitelisted(compiled_whitelist, "Django_Rest", "django"))
+        self.assertFalse(is_whitelisted(compiled_whitelist, "django", "djangp"))
+        self.assertTrue(is_whitelisted(compiled_whitelist, "nunpy", "NumPy"))
+        self.assertFalse(is_whitelisted(compiled_whitelist, "nunpy", "numba"))
+        self.assertFalse(is_whitelisted(compiled_whitelist, "nunpy"))
+        self.assertTrue(is_whitelisted(compiled_whitelist, "reqs", "requests"))
+        self.assertFalse(is_whitelisted(compiled_whitelist, "reqs", "request"))
+        self.assertEqual(
+            drop_whitelisted(
+                "numpy", ["numpi", "nunpy", "foo-bar", "numpy2"], compiled_whitelist
+            ),
+            ["numpi", "numpy2"],
+        )
+
+    def test_load_whitelist(self):
+        """Test that a whitelist is only compiled again once its file changes."""
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "whitelist.txt")
+            with open(path, "w") as f:
+                f.write("nunpy\n")
+            compiled_whitelist = load_whitelist(path)
+            self.assertIs(load_whitelist(path), compiled_whitelist)
+            with open(path, "w") as f:
+                f.write("numpi\n")
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(load_whitelist(path)["names"], {"numpi"})
+        filters.WHITELIST_CACHE.clear()
+
+    def test_create_suspicious_package_dict_whitelist(self):
+        """Test dropping whitelisted names while screening."""
+        all_packages = ["numpy", "nunpy", "numpi", "requests", "reqests"]
+        top_packages = ["numpy", "requests"]
+        compiled_whitelist = compile_whitelist(["numpy:nunpy", "req*"])
+        expected_output = {"numpy": ["numpi"], "requests": []}
+        for workers in [1, 2]:
+            output = create_suspicious_package_dict(
+                all_packages,
+                top_packages,
+                workers=workers,
+                compiled_whitelist=compiled_whitelist,
+            )
+            self.assertEqual(output, expected_output)
+
     def test_potential_squatter_names(self):
         """Test create_potential_squatter_names function."""
         module_name = "test"
@@ -87,19 +443,536 @@ class TestFunctions(unittest.TestCase):
         )
         self.assertEqual(potential_list, expected_list)
 
+    def test_create_suspicious_package_dict_workers(self):
+        """Test create_suspicious_package_dict with several processes."""
+        all_packages = ["eeny", "meeny", "miny", "moe", "cup-joe", "joe-cup", "clumps"]
+        top_packages = ["moe", "eeny", "cup-joe", "klumpz", "miny"]
+        expected_output = create_suspicious_package_dict(all_packages, top_packages)
+        output = create_suspicious_package_dict(all_packages, top_packages, workers=2)
+        self.assertEqual(output, expected_output)
+        self.assertEqual(list(output), top_packages)
+        output = create_suspicious_package_dict(
+            all_packages, top_packages, workers=2, distance_backend="bk-tree"
+        )
+        self.assertEqual(output, expected_output)
+        # Without shared memory, as on Python 3.7, packages are screened serially
+        with patch("utils.shared_memory", None), patch(
+            "utils.screen_shards_in_parallel", side_effect=AssertionError
+        ):
+            output = create_suspicious_package_dict(
+                all_packages, top_packages, workers=2
+            )
+        self.assertEqual(output, expected_output)
+
+    def test_create_suspicious_package_dict_backends(self):
+        """Test create_suspicious_package_dict with each distance backend."""
+        all_packages = ["eeny", "meeny", "miny", "moe", "cup-joe", "joe-cup", "clumps"]
+        top_packages = ["moe", "eeny", "cup-joe", "klumpz", "miny"]
+        expected_output = create_suspicious_package_dict(
+            all_packages, top_packages, 2, distance_backend="brute-force"
+        )
+        backends = ["auto", "deletion", "qgram", "bk-tree"]
+        if indexes.np is not None:
+            backends.append("numpy")
+        with tempfile.TemporaryDirectory() as folder:
+            # Keep the stored q-gram index out of package_lists
+            qgram_index_in_folder = functools.partial(get_qgram_index, folder=folder)
+            with patch("indexes.get_qgram_index", qgram_index_in_folder):
+                for backend in backends:
+                    output = create_suspicious_package_dict(
+                        all_packages, top_packages, 2, distance_backend=backend
+                    )
+                    self.assertEqual(output, expected_output)
+
+    def test_create_cached_suspicious_package_dict(self):
+        """Test create_cached_suspicious_package_dict patches stored results."""
+        all_packages = ["eeny", "meeny", "miny", "moe", "cup-joe", "joe-cup", "clumps"]
+        top_packages = ["moe", "eeny", "cup-joe", "klumpz", "miny"]
+        with tempfile.TemporaryDirectory() as folder:
+            output = create_cached_suspicious_package_dict(
+                all_packages, top_packages, 1, folder
+            )
+            expected_output = create_suspicious_package_dict(
+                all_packages, top_packages, 1
+            )
+            self.assertEqual(output, expected_output)
+            # Only the changed names are screened on the next run
+            all_packages = all_packages[1:] + ["joe_cup", "mo", "klumps"]
+            with patch(
+                "utils.create_suspicious_package_dict",
+                wraps=create_suspicious_package_dict,
+            ) as screen:
+                output = create_cached_suspicious_package_dict(
+                    all_packages, top_packages, 1, folder
+                )
+            screen.assert_called_once()
+            self.assertEqual(screen.call_args[0][0], ["joe_cup", "klumps", "mo"])
+            expected_output = create_suspicious_package_dict(
+                all_packages, top_packages, 1
+            )
+            self.assertEqual(list(output), top_packages)
+            for package in top_packages:
+                self.assertEqual(
+                    sorted(output[package]), sorted(expected_output[package])
+                )
+            # Another edit distance is not answered from the cache
+            output = create_cached_suspicious_package_dict(
+                all_packages, top_packages, 2, folder
+            )
+            self.assertEqual(
+                output, create_suspicious_package_dict(all_packages, top_packages, 2)
+            )
+            # Other screens are not answered from the cache either
+            output = create_cached_suspicious_package_dict(
+                all_packages, top_packages, 1, folder, screens=["keyboard"]
+            )
+            self.assertEqual(
+                output,
+                create_suspicious_package_dict(
+                    all_packages, top_packages, 1, screens=["keyboard"]
+                ),
+            )
+            # Results of each edit distance and set of screens are kept
+            with patch(
+                "utils.create_suspicious_package_dict",
+                wraps=create_suspicious_package_dict,
+            ) as screen:
+                output = create_cached_suspicious_package_dict(
+                    all_packages, top_packages, 2, folder
+                )
+            screen.assert_not_called()
+            self.assertEqual(
+                output, create_suspicious_package_dict(all_packages, top_packages, 2)
+            )
+            # A changed package list patches the results of every key
+            all_packages = all_packages + ["eenyy"]
+            create_cached_suspicious_package_dict(all_packages, top_packages, 1, folder)
+            for max_distance, screens in [(2, constants.SCREENS), (1, ["keyboard"])]:
+                with patch(
+                    "utils.create_suspicious_package_dict",
+                    wraps=create_suspicious_package_dict,
+                ) as screen:
+                    output = create_cached_suspicious_package_dict(
+                        all_packages,
+                        top_packages,
+                        max_distance,
+                        folder,
+                        screens=screens,
+                    )
+                screen.assert_not_called()
+                expected_output = create_suspicious_package_dict(
+                    all_packages, top_packages, max_distance, screens=screens
+                )
+                for package in top_packages:
+                    self.assertEqual(
+                        sorted(output[package]), sorted(expected_output[package])
+                    )
+
+    def test_keyboard_typo_screen(self):
+        """Test probing keyboard typos of a package among all packages."""
+        variants = get_keyboard_variants("Test")
+        self.assertEqual(
+            variants, ["rest", "teat", "tedt", "tesr", "tesy", "trst", "twst", "yest"]
+        )
+        # Variants are generated once per name
+        self.assertIs(get_keyboard_variants("Test"), variants)
+        utils.KEYBOARD_VARIANT_CACHE.clear()
+
+        all_packages = ["test", "Rest", "te-st", "tesy", "tost", "Twst"]
+        canonical_index = build_canonical_index(all_packages)
+        self.assertEqual(
+            keyboard_typo_screen("test", canonical_index), ["Rest", "tesy", "Twst"]
+        )
+        output = create_suspicious_package_dict(
+            all_packages, ["test"], screens=["keyboard"]
+        )
+        self.assertEqual(output, {"test": ["Rest", "tesy", "Twst"]})
+        # Every keyboard typo is also a misspelling
+        output = create_suspicious_package_dict(
+            all_packages, ["test"], screens=["misspelling", "keyboard"]
+        )
+        self.assertEqual(output, create_suspicious_package_dict(all_packages, ["test"]))
+
+    def test_server(self):
+        """Test queries answered by the serve operation."""
+        all_packages = ["eeny", "meeny", "miny", "moe", "cup-joe", "joe-cup", "clumps"]
+        top_packages = ["cup-joe", "meeny", "miny"]
+        state = {
+            "max_distance": 1,
+            "top_n": 3,
+            "stored_json": False,
+            "cache_max_age": 0,
+            "offline": True,
+            "distance_backend": "auto",
+            "snapshot": build_server_snapshot(all_packages, top_packages, 1, "auto"),
+        }
+        # Keep request logs out of the test output
+        log_patch = patch.object(QueryHandler, "log_message")
+        log_patch.start()
+        self.addCleanup(log_patch.stop)
+        server = make_server(state, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:" + str(server.server_address[1])
+
+        def query(path):
+            with urllib.request.urlopen(url + path) as response:  # nosec
+                return json.load(response)
+
+        answer = query("/mod-squatters?module=eeny&module=klumpz")
+        expected = create_suspicious_package_dict(all_packages, ["eeny", "klumpz"])
+        self.assertEqual(answer, {"results": expected})
+        answer = query("/top-mods?number_packages=2&len_package_name=5")
+        results = {
+            package: sorted(answer["results"][package]) for package in answer["results"]
+        }
+        self.assertEqual(results, {"cup-joe": ["joe-cup"], "meeny": ["eeny", "miny"]})
+        answer = query("/defend-name?module=test")
+        self.assertEqual(answer["results"]["test"][:2], ["rest", "teat"])
+        self.assertEqual(query("/health")["packages"], 7)
+        for path, status in [
+            ("/mod-squatters?module=moe&edit_distance=2", 400),
+            ("/mod-squatters?module=moe&edit_distance=one", 400),
+            ("/mod-squatters?module=caf%C3%A9", 400),
+            ("/defend-name?module=a%20b", 400),
+            ("/defend-name", 400),
+            ("/top-mods?number_packages=-1", 400),
+            ("/nope", 404),
+        ]:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                query(path)
+            self.assertEqual(context.exception.code, status)
+        # Whitelisted names are dropped before any metadata is fetched
+        with patch(
+            "server.load_whitelist", return_value=compile_whitelist(["meeny"])
+        ), patch("server.assess_suspicious_packages", return_value={}) as assess:
+            answer = query("/mod-squatters?module=eeny&metadata=true")
+        self.assertEqual(assess.call_args[0][0], {"eeny": []})
+        self.assertEqual(answer, {"results": {"eeny": []}, "risks": []})
+
+        # The same queries can be sent over a Unix socket
+        with tempfile.TemporaryDirectory() as folder:
+            socket_path = os.path.join(folder, "scan.sock")
+            unix_server = make_server(state, socket_path=socket_path)
+            threading.Thread(target=unix_server.serve_forever, daemon=True).start()
+            self.addCleanup(unix_server.server_close)
+            self.addCleanup(unix_server.shutdown)
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(socket_path)
+                client.sendall(b"GET /health HTTP/1.0\r\n\r\n")
+                response = client.makefile("rb").read()
+            self.assertTrue(response.startswith(b"HTTP/1.0 200"))
+            self.assertEqual(json.loads(response.split(b"\r\n\r\n")[1])["packages"], 7)
+
+        # Refreshes only replace the snapshot when the package list changed
+        snapshot = state["snapshot"]
+        with patch("server.get_all_packages", return_value=all_packages), patch(
+            "server.get_top_packages", return_value={"moe": 1}
+        ):
+            self.assertFalse(refresh_server_state(state))
+        self.assertIs(state["snapshot"], snapshot)
+        self.assertEqual(snapshot["top_packages"], ["moe"])
+        with patch("server.get_all_packages", side_effect=SystemExit(1)):
+            self.assertFalse(refresh_server_state(state))
+        with patch("server.get_all_packages", return_value=["moe", "mo"]), patch(
+            "server.get_top_packages", side_effect=SystemExit(1)
+        ):
+            self.assertTrue(refresh_server_state(state))
+        self.assertEqual(query("/mod-squatters?module=moe")["results"], {"moe": ["mo"]})
+        self.assertEqual(state["snapshot"]["top_packages"], ["moe"])
+
     def test_store_recent_scan_results(self):
         """Test store_recent_scan_results function."""
         test_package_list = ["peter", "paul", "mary"]
-        store_recent_scan_results(test_package_list, folder="test_data")
+        with tempfile.TemporaryDirectory() as folder:
+            store_recent_scan_results(test_package_list, folder=folder)
+            snapshots = list_package_snapshots(folder)
+            self.assertEqual(len(snapshots), 1)
+            snapshot = open_snapshot(snapshots[0][1])
+            self.assertEqual(list(iter_snapshot(snapshot)), sorted(test_package_list))
+
+    def test_store_recent_scan_results_delta(self):
+        """Test store_recent_scan_results stores deltas against the newest list."""
+        with tempfile.TemporaryDirectory() as folder:
+            old_path = os.path.join(
+                folder, "pypi-package-list-2020-07-01-00-00-00.snap"
+            )
+            write_snapshot(["peter", "paul"], old_path)
+            store_recent_scan_results(["peter", "mary"], folder, delta=True)
+            snapshots = list_package_snapshots(folder)
+            self.assertEqual(len(snapshots), 2)
+            self.assertEqual(snapshots[1][1], old_path)
+            snapshot = open_snapshot(snapshots[0][1])
+            self.assertEqual(snapshot["depth"], 1)
+            self.assertEqual(list(iter_snapshot(snapshot)), ["mary", "peter"])
+            self.assertEqual(load_most_recent_packages(folder), {"peter", "paul"})
+
+    def test_snapshot_catalog(self):
+        """Test the snapshot catalog picks and checks the baseline."""
+        with tempfile.TemporaryDirectory() as folder:
+            old_path = os.path.join(
+                folder, "pypi-package-list-2020-07-01-00-00-00.snap"
+            )
+            write_snapshot(["peter", "paul"], old_path)
+            # Snapshots stored before the catalog existed are catalogued
+            store_recent_scan_results(["peter", "paul", "mary"], folder)
+            catalog = load_snapshot_catalog(folder)
+            self.assertEqual(catalog[0]["file"], os.path.basename(old_path))
+            self.assertEqual([entry["count"] for entry in catalog], [2, 3])
+            snapshot = load_most_recent_snapshot(folder)
+            self.assertEqual(list(iter_snapshot(snapshot)), ["paul", "peter"])
+            # A changed baseline no longer matches its checksum
+            write_snapshot(["peter"], old_path)
+            with self.assertRaises(ValueError):
+                load_most_recent_snapshot(folder)
+            # A removed baseline is dropped from the rebuilt catalog
+            os.remove(old_path)
+            with self.assertRaises(FileNotFoundError):
+                load_most_recent_snapshot(folder)
+            self.assertEqual(len(load_snapshot_catalog(folder)), 1)
+
+    def test_snapshots(self):
+        """Test writing and reading package list snapshots."""
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "full.snap")
+            write_snapshot(["peter", "paul", "mary", "zoë", "paul"], path)
+            snapshot = open_snapshot(path)
+            self.assertEqual(snapshot["count"], 4)
+            self.assertEqual(snapshot_name(snapshot, 0), "mary")
+            names = list(iter_snapshot(snapshot))
+            self.assertEqual(names, ["mary", "paul", "peter", "zoë"])
+            for package in names:
+                self.assertTrue(snapshot_contains(snapshot, package))
+            for package in ["", "a", "pau", "paula", "zz"]:
+                self.assertFalse(snapshot_contains(snapshot, package))
+            # Deltas are read by applying them to their base snapshot
+            delta_path = os.path.join(folder, "delta.snap")
+            write_delta_snapshot(["mary", "peter", "john"], delta_path, path)
+            delta_snapshot = open_snapshot(delta_path)
+            self.assertEqual(delta_snapshot["depth"], 1)
+            names = list(iter_snapshot(delta_snapshot))
+            self.assertEqual(names, ["john", "mary", "peter"])
+            self.assertFalse(snapshot_contains(delta_snapshot, "paul"))
+            changes = list(diff_snapshots(snapshot, delta_snapshot))
+            self.assertEqual(
+                changes, [("john", "added"), ("paul", "removed"), ("zoë", "removed")]
+            )
+        # Snapshots stored as JSON can still be read
+        json_path = "test_data/pypi-package-list-2020-07-03-13-22-39.json"
+        self.assertEqual(
+            list(iter_snapshot(open_snapshot(json_path))), ["mary", "paul", "peter"]
+        )
 
     def test_load_most_recent_packages(self):
         """Test load_most_recent_packages function."""
         with self.assertRaises(FileNotFoundError):
             load_most_recent_packages("docs")
-        # Sort because loading order appears to happen randomly
-        package_list = load_most_recent_packages("test_data")
+        # Load a copy so the snapshot catalog is not written to test_data
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copy(
+                os.path.join("test_data", "pypi-package-list-2020-07-03-13-22-39.json"),
+                folder,
+            )
+            # Sort because loading order appears to happen randomly
+            package_list = load_most_recent_packages(folder)
         self.assertEqual(["peter", "paul", "mary"].sort(), list(package_list).sort())
 
+    def test_sync_package_list(self):
+        """Test sync_package_list against a local stand-in for PyPI."""
+        url, _ = self.start_test_server()
+        events = []
+        xmlrpc_server = xmlrpc.server.SimpleXMLRPCServer(
+            ("127.0.0.1", 0), logRequests=False, allow_none=True
+        )
+        xmlrpc_server.register_function(lambda: 1000, "changelog_last_serial")
+        xmlrpc_server.register_function(
+            lambda serial: [e for e in events if e[4] > serial],
+            "changelog_since_serial",
+        )
+        threading.Thread(target=xmlrpc_server.serve_forever, daemon=True).start()
+        self.addCleanup(xmlrpc_server.server_close)
+        self.addCleanup(xmlrpc_server.shutdown)
+        xmlrpc_url = "http://127.0.0.1:" + str(xmlrpc_server.server_address[1])
+
+        with tempfile.TemporaryDirectory() as folder:
+            # First sync downloads the full list
+            packages, added, removed = sync_package_list(
+                folder, xmlrpc_url, url + "/simple.json", cache_folder=folder
+            )
+            expected = {"nmap-python", "python-nmap", "requests", "requestz"}
+            self.assertEqual((packages, added, removed), (expected, set(), set()))
+
+            # Later syncs replay only new events
+            events.extend(
+                [
+                    ["requestss", None, 0, "create", 1001],
+                    ["requestss", "1.0", 0, "new release", 1002],
+                    ["requestz", None, 0, "remove project", 1003],
+                    ["nmap_python", None, 0, "rename from nmap-python", 1004],
+                    ["temporary", None, 0, "create", 1005],
+                    ["temporary", None, 0, "remove project", 1006],
+                ]
+            )
+            packages, added, removed = sync_package_list(folder, xmlrpc_url, None)
+            self.assertEqual(
+                packages, {"nmap_python", "python-nmap", "requests", "requestss"}
+            )
+            self.assertEqual(added, {"nmap_python", "requestss"})
+            self.assertEqual(removed, {"nmap-python", "requestz"})
+            with open(os.path.join(folder, "pypi-synced-package-list.json")) as f:
+                synced = json.load(f)
+            self.assertEqual(synced["serial"], 1006)
+            self.assertEqual(synced["packages"], sorted(packages))
+
+            # Nothing new happened since the last sync
+            self.assertEqual(
+                sync_package_list(folder, xmlrpc_url, None), (packages, set(), set())
+            )
+
+    def test_backoff_delay(self):
+        """Test backoff_delay function."""
+        for failures, delay in [(1, 30), (2, 60), (3, 120), (20, 3600)]:
+            self.assertTrue(delay / 2 <= backoff_delay(failures) <= delay)
+
+    def test_watch_new_packages(self):
+        """Test watch_new_packages against a scripted series of polls."""
+        polls = [
+            ["requests", "numpy"],
+            scrapers.requests.exceptions.ConnectionError("offline"),
+            ["requests", "numpy", "requestss", "nunpy"],
+            ["Requests", "numpy", "requestss", "nunpy", "unrelated-name"],
+        ]
+        with patch("utils.download_package_names", side_effect=polls), patch(
+            "utils.sleep"
+        ) as fake_sleep, patch(
+            "utils.assess_suspicious_packages",
+            side_effect=lambda packages, *args: {
+                (package, squatter): "low"
+                for package in packages
+                for squatter in packages[package]
+            },
+        ), patch(
+            "sys.stderr", new=StringIO()
+        ):
+            findings = list(watch_new_packages(max_distance=1, max_polls=4))
+
+        # New names on the third poll are screened, and the fourth adds
+        # a name with nothing similar to it and respells an old one
+        self.assertEqual(
+            [(f["package"], f["similar_packages"], f["risks"]) for f in findings],
+            [
+                ("nunpy", ["numpy"], ["low"]),
+                ("requestss", ["requests"], ["low"]),
+                ("Requests", ["requestss"], ["low"]),
+            ],
+        )
+        # Polling backs off after the failure
+        delays = [call[0][0] for call in fake_sleep.call_args_list]
+        self.assertEqual(delays[0], constants.WATCH_POLL_INTERVAL)
+        self.assertTrue(15 <= delays[1] <= 30)
+        self.assertEqual(delays[2], constants.WATCH_POLL_INTERVAL)
+
+        # Whitelisted new packages and pairs are dropped before metadata
+        polls = [polls[0]] + polls[2:]
+        with patch("utils.download_package_names", side_effect=polls), patch(
+            "utils.sleep"
+        ), patch(
+            "utils.assess_suspicious_packages",
+            side_effect=lambda packages, *args: {
+                (package, squatter): "low"
+                for package in packages
+                for squatter in packages[package]
+            },
+        ) as assess:
+            findings = list(
+                watch_new_packages(
+                    max_distance=1,
+                    max_polls=3,
+                    compiled_whitelist=compile_whitelist(
+                        ["nunpy", "requestss:Requests"]
+                    ),
+                )
+            )
+        self.assertEqual(
+            [call[0][0] for call in assess.call_args_list],
+            [{"requestss": ["requests"]}],
+        )
+        self.assertEqual([f["package"] for f in findings], ["requestss"])
+
+    def test_synthetic_package_names(self):
+        """Test synthetic_package_names function."""
+        package_names = synthetic_package_names(2000, seed=1)
+        self.assertEqual(len(set(package_names)), 2000)
+        self.assertEqual(package_names, synthetic_package_names(2000, seed=1))
+        self.assertNotEqual(package_names, synthetic_package_names(2000, seed=2))
+
+    def test_compare_to_baseline(self):
+        """Test compare_to_baseline function."""
+        baseline = {"timings": {"1000": {"whitelist": 1.0, "open_snapshot": 0.001}}}
+        results = {
+            "timings": {
+                "1000": {"whitelist": 1.5, "open_snapshot": 0.002, "new": 1.0},
+                "5000": {"whitelist": 5.0},
+            }
+        }
+        comparison = compare_to_baseline(results, baseline, tolerance=0.25)
+        # Benchmarks missing from the baseline are left out, and tiny
+        # timings do not regress however much they grow
+        self.assertEqual(
+            [(row["benchmark"], row["regressed"]) for row in comparison],
+            [("whitelist", True), ("open_snapshot", False)],
+        )
+        self.assertEqual(comparison[0]["ratio"], 1.5)
+
+    def test_metrics(self):
+        """Test stages and counters of the metrics module."""
+        # Nothing is recorded until metrics are enabled
+        with stage("ignored"):
+            count("http_requests")
+        self.assertEqual(metrics.METRICS["stages"], {})
+
+        enable_metrics()
+        self.addCleanup(metrics.METRICS.update, {"enabled": False})
+        with stage("screen"):
+            count("http_requests", 2)
+            for hit in [True, True, False]:
+                with stage("homophone_screen"):
+                    count_cache("metadata", hit)
+        count("http_bytes", 100)
+
+        report = metrics_report()
+        self.assertEqual(list(report["stages"]), ["screen", "screen/homophone_screen"])
+        screen = report["stages"]["screen"]
+        self.assertEqual(screen["calls"], 1)
+        self.assertEqual(
+            screen["counters"],
+            {"http_requests": 2, "metadata_cache_hits": 2, "metadata_cache_misses": 1},
+        )
+        self.assertEqual(report["stages"]["screen/homophone_screen"]["calls"], 3)
+        self.assertAlmostEqual(report["cache_hit_rates"]["metadata"], 2 / 3)
+        self.assertEqual(report["counters"]["http_bytes"], 100)
+        self.assertGreater(report["peak_rss_bytes"], 0)
+        self.assertLessEqual(screen["process_peak_rss_bytes"], report["peak_rss_bytes"])
+        self.assertGreaterEqual(screen["peak_rss_growth_bytes"], 0)
+        self.assertGreaterEqual(
+            screen["wall_seconds"],
+            report["stages"]["screen/homophone_screen"]["wall_seconds"],
+        )
+
+        # Each thread nests its own stages
+        def download():
+            with stage("download"):
+                count("http_requests")
+
+        with stage("metadata"):
+            worker = threading.Thread(target=download)
+            worker.start()
+            worker.join()
+        self.assertEqual(
+            list(metrics_report()["stages"])[-2:], ["metadata", "download"]
+        )
+
     def test_print_suspicious_packages(self):
         """Test print_suspicious_packages function.
 
@@ -137,6 +1010,47 @@ class TestFunctions(unittest.TestCase):
         output = order_attack_screen(input_package, test_list)
         self.assertEqual(output, expected_output)
 
+        # Check names with several separators of mixed kinds
+        input_package = "google-cloud_storage"
+        test_list = [
+            "storage.google.cloud",
+            "cloud-google-storage",
+            "google-cloud-storage",
+            "google-cloud",
+            "googlecloud-storage",
+        ]
+        expected_output = [
+            "cloud-google-storage",
+            "google-cloud-storage",
+            "storage.google.cloud",
+        ]
+        token_index = build_token_index(test_list)
+        self.assertEqual(order_attack_screen(input_package, test_list), expected_output)
+        output = order_attack_screen(input_package, test_list, token_index)
+        self.assertEqual(output, expected_output)
+        self.assertEqual(order_attack_screen("google", test_list, token_index), [])
+
+    def test_build_token_index(self):
+        """Test build_token_index function."""
+        token_index = build_token_index(["nmap-python", "python_nmap", "nmap"])
+        self.assertEqual(
+            token_index, {("nmap", "python"): ["nmap-python", "python_nmap"]}
+        )
+
+    def test_update_token_index(self):
+        """Test update_token_index function."""
+        token_index = build_token_index(["nmap-python", "python_nmap", "pandas-io"])
+        update_token_index(token_index, ["io_pandas", "nmap.python"], ["pandas-io"])
+        self.assertEqual(
+            token_index,
+            {
+                ("nmap", "python"): ["nmap-python", "python_nmap", "nmap.python"],
+                ("io", "pandas"): ["io_pandas"],
+            },
+        )
+        update_token_index(token_index, [], ["io_pandas"])
+        self.assertNotIn(("io", "pandas"), token_index)
+
     def test_homophone_attack_screen(self):
         # Check that positive match situation functions properly
         input_package = "clumps"
@@ -152,6 +1066,70 @@ class TestFunctions(unittest.TestCase):
         output = homophone_attack_screen(input_package, test_list)
         self.assertEqual(output, expected_output)
 
+    def test_homophone_attack_screen_with_index(self):
+        """Test homophone_attack_screen when using a metaphone index."""
+        test_list = ["apple", "pear", "klumpz", "clumps"]
+        metaphone_index = build_metaphone_index(test_list)
+        output = homophone_attack_screen("clumps", test_list, metaphone_index)
+        self.assertEqual(output, ["klumpz"])
+        output = homophone_attack_screen("python", test_list, metaphone_index)
+        self.assertEqual(output, [])
+
+    def test_get_metaphone_index(self):
+        """Test get_metaphone_index stores and updates the index."""
+        with tempfile.TemporaryDirectory() as folder:
+            metaphone_index = get_metaphone_index(["apple", "klumpz"], folder)
+            self.assertEqual(metaphone_index, {"APL": ["apple"], "KLMPS": ["klumpz"]})
+            self.assertTrue(
+                os.path.exists(os.path.join(folder, "pypi-metaphone-index.json"))
+            )
+            # A new snapshot patches the stored index
+            metaphone_index = get_metaphone_index(["klumpz", "clumps"], folder)
+            self.assertEqual(metaphone_index, {"KLMPS": ["klumpz", "clumps"]})
+            # The same snapshot loads the stored index unchanged
+            metaphone_index = get_metaphone_index(["clumps", "klumpz"], folder)
+            self.assertEqual(metaphone_index, {"KLMPS": ["klumpz", "clumps"]})
+
+    def test_canonical_name(self):
+        """Test canonical_name and build_canonical_index functions."""
+        for package in ["Foo_Bar", "foo-bar", "foo.bar", "FOO__bar", "foo-_.bar"]:
+            self.assertEqual(canonical_name(package), "foo-bar")
+        self.assertEqual(
+            build_canonical_index(["Foo_Bar", "foo-baz", "foo.bar"]),
+            {"foo-bar": ["Foo_Bar", "foo.bar"], "foo-baz": ["foo-baz"]},
+        )
+        canonical_index = build_canonical_index(["Foo_Bar", "foo-baz", "foo.bar"])
+        update_canonical_index(canonical_index, ["Foo.Qux"], ["Foo_Bar", "foo-baz"])
+        self.assertEqual(
+            canonical_index, {"foo-bar": ["foo.bar"], "foo-qux": ["Foo.Qux"]}
+        )
+
+    def test_drop_equivalent_names(self):
+        """Test drop_equivalent_names function."""
+        squatters = ["Foo_Bar", "foo-baz", "foo_baz", "bar-foo", "FOO.BAZ"]
+        self.assertEqual(
+            drop_equivalent_names("foo-bar", squatters), ["foo-baz", "bar-foo"]
+        )
+
+    def test_create_suspicious_package_dict_equivalent_names(self):
+        """Test names of the same project are screened and reported once."""
+        all_packages = ["Foo_Bar", "foo.bar", "foo-baz", "foo_baz", "bar-foo"]
+        expected_output = {"foo-bar": ["foo-baz", "bar-foo"], "fob": []}
+        for workers in [1, 2]:
+            output = create_suspicious_package_dict(
+                all_packages, ["foo-bar", "fob"], 1, workers=workers
+            )
+            self.assertEqual(output, expected_output)
+        # A few top packages compare the canonical names of the squatters
+        # found, and more top packages screen one name of each project
+        output = create_suspicious_package_dict(
+            all_packages,
+            ["foo-bar", "fob"],
+            1,
+            canonical_index=build_canonical_index(all_packages),
+        )
+        self.assertEqual(output, expected_output)
+
     def test_create_suspicious_package_dict(self):
         """Test create_suspicious_package_dict function"""
         # Check if misspelling and confusion attacks are detected
@@ -164,6 +1142,15 @@ class TestFunctions(unittest.TestCase):
         )
         self.assertEqual(output, expected_output)
 
+        # Check if homophone attacks are detected without duplicates
+        ALL_PACKAGES = ["clumps", "klumpz", "clump", "klumps"]
+        TOP_PACKAGE = ["clumps"]
+        output = create_suspicious_package_dict(ALL_PACKAGES, TOP_PACKAGE, 1)
+        expected_output = collections.OrderedDict(
+            {"clumps": ["clump", "klumps", "klumpz"]}
+        )
+        self.assertEqual(output, expected_output)
+
     def test_get_metadata(self):
         """Test metadata scrape functionality on pcap2map.
 
@@ -178,6 +1165,347 @@ class TestFunctions(unittest.TestCase):
             package["info"]["package_url"], "https://pypi.org/project/pcap2map/"
         )
 
+    def test_get_metadata_cache(self):
+        """Test get_metadata caches metadata in memory and on disk."""
+        info = {"author_email": "anon@gmail.com", "author": "John Speed Meyers"}
+        with tempfile.TemporaryDirectory() as folder, patch(
+            "scrapers.download_metadata", return_value=info
+        ) as download:
+            package = get_metadata("pcap2map", cache_folder=folder)
+            self.assertEqual(package, {"info": info})
+            # Served from memory
+            self.assertEqual(get_metadata("pcap2map", cache_folder=folder), package)
+            self.assertEqual(download.call_count, 1)
+            # Served from disk
+            scrapers.METADATA_LRU.clear()
+            self.assertEqual(get_metadata("pcap2map", cache_folder=folder), package)
+            self.assertEqual(download.call_count, 1)
+            # Expired entries are downloaded again
+            get_metadata("pcap2map", cache_ttl=0, cache_folder=folder)
+            self.assertEqual(download.call_count, 2)
+
+        # Blank metadata, e.g. from a PyPI error page, is not cached
+        blank = {field: "" for field in constants.METADATA_FIELDS}
+        with tempfile.TemporaryDirectory() as folder, patch(
+            "scrapers.download_metadata", return_value=blank
+        ) as download:
+            self.assertEqual(
+                get_metadata("flaky", cache_folder=folder), {"info": blank}
+            )
+            get_metadata("flaky", cache_folder=folder)
+            self.assertEqual(download.call_count, 2)
+            self.assertEqual(os.listdir(folder), [])
+
+    def test_prune_metadata_cache(self):
+        """Test prune_metadata_cache evicts the oldest entries."""
+        with tempfile.TemporaryDirectory() as folder:
+            for i, name in enumerate(["old", "middle", "new"]):
+                path = os.path.join(folder, name + ".json")
+                with open(path, "w") as f:
+                    f.write("x" * 100)
+                os.utime(path, (i, i))
+            # Another thread's unfinished entry is left alone
+            with open(os.path.join(folder, "old.json.1.part"), "w") as f:
+                f.write("x" * 100)
+            os.utime(os.path.join(folder, "old.json.1.part"), (0, 0))
+            self.assertEqual(prune_metadata_cache(folder, 300), 300)
+            self.assertEqual(prune_metadata_cache(folder, 250), 200)
+            self.assertEqual(
+                sorted(os.listdir(folder)),
+                ["middle.json", "new.json", "old.json.1.part"],
+            )
+
+    def test_download_metadata(self):
+        """Test download_metadata on missing packages and PyPI errors."""
+
+        def fake_response(status_code, content):
+            response = scrapers.requests.models.Response()
+            response.status_code = status_code
+            response._content = content
+            return response
+
+        session = Mock()
+        session.get.return_value = fake_response(
+            200, b'{"info": {"author": "me", "summary": null}}'
+        )
+        info = scrapers.download_metadata("pkg", session=session)
+        self.assertEqual(info["author"], "me")
+        self.assertEqual(info["author_email"], "")
+        # A deleted or renamed package has blank metadata
+        session.get.return_value = fake_response(404, b'{"message": "Not Found"}')
+        info = scrapers.download_metadata("gone", session=session)
+        self.assertEqual(info, {field: "" for field in constants.METADATA_FIELDS})
+        # Other errors are raised, so get_metadata_concurrently blanks them
+        session.get.return_value = fake_response(503, b"<html>Unavailable</html>")
+        with self.assertRaises(scrapers.requests.exceptions.HTTPError):
+            scrapers.download_metadata("pkg", session=session)
+
+    def test_get_metadata_concurrently(self):
+        """Test get_metadata_concurrently fetches each package once."""
+
+        def fake_get_metadata(name, session=None, timeout=None):
+            self.assertIsNotNone(session)
+            self.assertEqual(timeout, 1)
+            if name == "slow":
+                raise scrapers.requests.exceptions.Timeout()
+            return {"info": {"author": name}}
+
+        with patch("scrapers.get_metadata", side_effect=fake_get_metadata) as fetch:
+            metadata = get_metadata_concurrently(["a", "b", "a", "slow"], 4, 1)
+        self.assertEqual(fetch.call_count, 3)
+        self.assertEqual(metadata["a"], {"info": {"author": "a"}})
+        self.assertEqual(metadata["b"], {"info": {"author": "b"}})
+        self.assertEqual(metadata["slow"]["info"]["author"], "")
+
+    def test_metadata_risk(self):
+        """Test metadata_risk function."""
+        blank = {"info": {field: "" for field in constants.METADATA_FIELDS}}
+        original = {"info": dict(blank["info"], author="me", summary="A tool")}
+        copied = {"info": dict(blank["info"], summary="A tool")}
+        self.assertEqual(metadata_risk(original, copied), "some_risk")
+        self.assertEqual(metadata_risk(original, blank), "no_risk")
+        self.assertEqual(metadata_risk(blank, blank), "no_risk")
+        # Placeholder values that PyPI fills in never match
+        unknown = {"info": dict(blank["info"], author_email="UNKNOWN", author=None)}
+        self.assertEqual(metadata_risk(unknown, unknown), "no_risk")
+
+    def test_assess_suspicious_packages(self):
+        """Test assess_suspicious_packages fetches metadata in one stage."""
+        blank = {field: "" for field in constants.METADATA_FIELDS}
+        metadata = {
+            "evil": {"info": dict(blank, author="me")},
+            "eval": {"info": dict(blank, author="me")},
+            "evel": {"info": dict(blank, author="you")},
+        }
+        with patch("utils.get_metadata_concurrently", return_value=metadata) as fetch:
+            risks = assess_suspicious_packages(
+                {"evil": ["eval", "evel"], "good": []}, 8, 5
+            )
+        fetch.assert_called_once_with(["evil", "eval", "evel"], 8, 5)
+        self.assertEqual(
+            risks, {("evil", "eval"): "some_risk", ("evil", "evel"): "no_risk"}
+        )
+
+    def test_assess_suspicious_packages_fingerprints(self):
+        """Test assess_suspicious_packages only fetches stale fingerprints."""
+        blank = {field: "" for field in constants.METADATA_FIELDS}
+        fingerprints = new_fingerprint_table()
+        update_fingerprint_table(
+            fingerprints,
+            {
+                "evil": {"info": dict(blank, author="me")},
+                "evel": {"info": dict(blank, author="you")},
+            },
+        )
+        update_fingerprint_table(
+            fingerprints, {"eval": {"info": dict(blank, author="old")}}, fetched_at=0
+        )
+        metadata = {"eval": {"info": dict(blank, author="me")}}
+        with patch("utils.get_metadata_concurrently", return_value=metadata) as fetch:
+            risks = assess_suspicious_packages(
+                {"evil": ["eval", "evel"]}, 8, 5, fingerprints
+            )
+        fetch.assert_called_once_with(["eval"], 8, 5)
+        self.assertEqual(
+            risks, {("evil", "eval"): "some_risk", ("evil", "evel"): "no_risk"}
+        )
+
+    def test_assess_suspicious_packages_store(self):
+        """Test assess_suspicious_packages reads recent metadata from the store."""
+        blank = {field: "" for field in constants.METADATA_FIELDS}
+        with tempfile.TemporaryDirectory() as folder:
+            store = open_store(folder)
+            self.addCleanup(store.close)
+            record_metadata(store, {"evil": {"info": dict(blank, author="me")}})
+            record_metadata(store, {"eval": {"info": dict(blank, author="me")}}, 0.0)
+            metadata = {
+                "eval": {"info": dict(blank, author="me")},
+                "evel": {"info": dict(blank, author="you")},
+            }
+            with patch(
+                "utils.get_metadata_concurrently", return_value=metadata
+            ) as fetch:
+                risks = assess_suspicious_packages(
+                    {"evil": ["eval", "evel"]}, 8, 5, store=store
+                )
+            fetch.assert_called_once_with(["eval", "evel"], 8, 5)
+            self.assertEqual(
+                risks, {("evil", "eval"): "some_risk", ("evil", "evel"): "no_risk"}
+            )
+
+            # Offline, stored metadata of any age fills the fingerprint table
+            record_metadata(store, {"eval": {"info": dict(blank, author="me")}}, 0.0)
+            fingerprints = new_fingerprint_table()
+            with patch("utils.get_metadata_concurrently") as fetch:
+                risks = assess_suspicious_packages(
+                    {"evil": ["eval"]}, 8, 5, fingerprints, True, store
+                )
+            fetch.assert_not_called()
+            self.assertEqual(risks, {("evil", "eval"): "some_risk"})
+            self.assertEqual(fresh_packages(fingerprints, ["eval"], 60), set())
+
+    def test_fingerprint_table(self):
+        """Test storing and querying a metadata fingerprint table."""
+        blank = {field: "" for field in constants.METADATA_FIELDS}
+        metadata = {
+            "requests": {"info": dict(blank, author_email="kr@example.com")},
+            "requestz": {"info": dict(blank, author_email="x@example.com")},
+            "reqeusts": {"info": dict(blank, author_email="x@example.com")},
+            "request5": {"info": dict(blank, author_email="x@example.com")},
+            "numpy": {"info": dict(blank, summary="Arrays")},
+            "nunpy": {"info": dict(blank, summary="Arrays")},
+            "missing": {"info": blank},
+        }
+        fingerprints = new_fingerprint_table()
+        self.assertEqual(update_fingerprint_table(fingerprints, metadata), 6)
+
+        with tempfile.TemporaryDirectory() as folder:
+            save_fingerprint_table(fingerprints, folder)
+            fingerprints = load_fingerprint_table(folder)
+        self.assertEqual(len(fingerprints["names"]), 6)
+        self.assertEqual(fingerprint_risk(fingerprints, "numpy", "nunpy"), "some_risk")
+        self.assertEqual(
+            fingerprint_risk(fingerprints, "requests", "requestz"), "no_risk"
+        )
+        self.assertEqual(
+            fingerprint_risk(fingerprints, "requests", "missing"), "no_risk"
+        )
+        self.assertEqual(
+            shared_metadata_packages(fingerprints, "requestz"),
+            {"author_email": ["reqeusts", "request5"]},
+        )
+        self.assertEqual(
+            metadata_clusters(fingerprints), [["reqeusts", "request5", "requestz"]]
+        )
+        self.assertEqual(
+            metadata_clusters(fingerprints, ["requestz", "request5", "numpy"]),
+            [["request5", "requestz"]],
+        )
+
+        # Updated rows replace the old ones
+        update_fingerprint_table(
+            fingerprints, {"nunpy": {"info": dict(blank, summary="Other")}}
+        )
+        self.assertEqual(fingerprint_risk(fingerprints, "numpy", "nunpy"), "no_risk")
+
+    def test_metadata_clusters_placeholders(self):
+        """Test that placeholder author emails do not form a cluster."""
+        blank = {field: "" for field in constants.METADATA_FIELDS}
+        metadata = {
+            name: {"info": dict(blank, author_email="UNKNOWN", summary=name)}
+            for name in ["BioID", "Glask", "Pynuts", "bdd", "boat"]
+        }
+        metadata["nothing"] = {"info": dict(blank, author_email="None")}
+        fingerprints = new_fingerprint_table()
+        self.assertEqual(update_fingerprint_table(fingerprints, metadata), 5)
+        self.assertEqual(metadata_clusters(fingerprints), [])
+        self.assertEqual(fingerprint_risk(fingerprints, "BioID", "boat"), "no_risk")
+
+        # Tables saved before placeholders counted as blank are discarded
+        with tempfile.TemporaryDirectory() as folder:
+            save_fingerprint_table(fingerprints, folder)
+            path = os.path.join(folder, "pypi-metadata-fingerprints.bin")
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                columns = f.read()
+            del header["blank_values"]
+            with open(path, "wb") as f:
+                f.write(json.dumps(header).encode("utf-8") + b"\n" + columns)
+            self.assertEqual(load_fingerprint_table(folder)["names"], [])
+
+    def test_ingest_metadata_dump(self):
+        """Test filling a fingerprint table from JSON Lines and SQLite dumps."""
+        rows = [
+            {"name": "Evil_Pkg", "author": "old", "upload_time": "2020-01-02"},
+            {"name": "evil-pkg", "author": "me", "upload_time": "2020-03-04"},
+            {"name": "evil.pkg", "author": "older", "upload_time": "2019-01-01"},
+            {"name": "blank", "author": ""},
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            jsonl_path = os.path.join(folder, "metadata.jsonl")
+            with open(jsonl_path, "w") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+                # PyPI JSON API responses hold the fields under "info"
+                f.write(json.dumps({"info": {"name": "good-pkg", "author": "me"}}))
+            sqlite_path = os.path.join(folder, "metadata.db")
+            connection = sqlite3.connect(sqlite_path)
+            with connection:
+                connection.execute("CREATE TABLE releases (name, author, upload_time)")
+                connection.executemany(
+                    "INSERT INTO releases VALUES (?, ?, ?)",
+                    [
+                        (row["name"], row["author"], row.get("upload_time"))
+                        for row in rows
+                    ]
+                    + [("good-pkg", "me", None)],
+                )
+            connection.close()
+
+            for path, table in [(jsonl_path, None), (sqlite_path, "releases")]:
+                fingerprints = new_fingerprint_table()
+                if table:
+                    count = ingest_metadata_dump(fingerprints, path, table)
+                else:
+                    count = ingest_metadata_dump(fingerprints, path)
+                self.assertEqual(count, 2)
+                # Rows are found under the simple index spelling of a name
+                with patch(
+                    "utils.get_metadata_concurrently", side_effect=AssertionError
+                ):
+                    self.assertEqual(
+                        compare_metadata("good-pkg", "evil_pkg", fingerprints, True),
+                        "some_risk",
+                    )
+            with self.assertRaises(ValueError):
+                ingest_metadata_dump(fingerprints, sqlite_path, "x; DROP")
+
+    def test_store(self):
+        """Test recording and querying the history of names and findings."""
+        with tempfile.TemporaryDirectory() as folder:
+            store = open_store(folder)
+            record_snapshot(store, ["numpy", "requests"], 100.0)
+            record_snapshot(store, ["numpy", "nunpy", "nunpy"], 200.0)
+            # An older snapshot recorded late moves first_seen back only
+            record_snapshot(store, ["requests"], 50.0)
+            self.assertEqual(name_history(store, "numpy"), (100.0, 200.0))
+            self.assertEqual(name_history(store, "requests"), (50.0, 100.0))
+            self.assertEqual(name_history(store, "absent"), None)
+            self.assertEqual(
+                store.execute(
+                    "SELECT count FROM snapshots WHERE taken_at = 200"
+                ).fetchone()[0],
+                2,
+            )
+
+            record_findings(store, [("numpy", "nunpy")], 200.0)
+            record_findings(store, [("numpy", "nunpy"), ("numpy", "numpi")], 300.0)
+            self.assertEqual(
+                finding_history(store, "nunpy"), [("numpy", "nunpy", 200.0, 300.0)]
+            )
+            self.assertEqual(len(finding_history(store, "numpy")), 2)
+
+            record_metadata(
+                store,
+                {
+                    "numpy": {"info": {"author": "NumPy Developers"}},
+                    "gone": {"info": {"author": ""}},
+                },
+            )
+            record_metadata(store, {"old": {"info": {"author": "me"}}}, 0.0)
+            metadata = stored_metadata(store, ["numpy", "gone"], max_age=60)
+            self.assertEqual(list(metadata), ["numpy"])
+            self.assertEqual(metadata["numpy"]["info"]["author"], "NumPy Developers")
+            self.assertEqual(metadata["numpy"]["info"]["author_email"], "")
+            self.assertGreater(metadata["numpy"]["fetched_at"], 0.0)
+            self.assertEqual(len(stored_metadata(store, ["numpy", "old"])), 2)
+            store.close()
+
+            # The store keeps its contents when opened again
+            store = open_store(folder)
+            self.assertEqual(name_history(store, "nunpy"), (200.0, 200.0))
+            store.close()
+
     def test_compare_metadata(self):
         """Test compare_metadata functionality"""
         # Check that comparing package to itself returns high risk
@@ -202,16 +1530,32 @@ class TestFunctions(unittest.TestCase):
 
     def test_commandline(self):
         """Test command line usage."""
+        # Run in a temporary working copy so generated files stay out of the repo
+        working_copy = tempfile.TemporaryDirectory()
+        self.addCleanup(working_copy.cleanup)
+        for name in ["whitelist.txt", "top_packages_may_2020.json"]:
+            shutil.copy(name, working_copy.name)
+        for name in ["package_lists", "results"]:
+            os.mkdir(os.path.join(working_copy.name, name))
+        main_path = os.path.abspath("main.py")
 
-        # Test single module scan usage for module with no typosquatters
+        # Test single module scan usage for module with only homophone squatters
         output = subprocess.run(
-            ["python", "main.py", "-m", "pcap2map"], capture_output=True
+            ["python", main_path, "-m", "pcap2map"],
+            capture_output=True,
+            cwd=working_copy.name,
         )  # nosec
         expected = "".join(
             [
                 "Checking pcap2map for typosquatting candidates.",
                 os.linesep,
-                "No typosquatting candidates found.",
+                "0: pgpumpy",
+                os.linesep,
+                "1: pkpm-api",
+                os.linesep,
+                "2: pycopy-imp",
+                os.linesep,
+                "3: pycopy-mmap",
                 os.linesep,
             ]
         )
@@ -219,17 +1563,21 @@ class TestFunctions(unittest.TestCase):
 
         # Test single module scan usage for module with typosquatters
         output = subprocess.run(
-            ["python", "main.py", "-m", "urllib3"], capture_output=True
+            ["python", main_path, "-m", "urllib3"],
+            capture_output=True,
+            cwd=working_copy.name,
         )  # nosec
         expected = "".join(
             [
                 "Checking urllib3 for typosquatting candidates.",
                 os.linesep,
-                "0: urllib3c",
+                "0: urllib-3",
                 os.linesep,
                 "1: urllib4",
                 os.linesep,
-                "2: urllib5",
+                "2: ur5lib",
+                os.linesep,
+                "3: urilib",
                 os.linesep,
             ]
         )
@@ -237,18 +1585,30 @@ class TestFunctions(unittest.TestCase):
 
         # Test multiple module scan usage with stored package used
         output = subprocess.run(
-            ["python", "main.py", "-o", "top-mods", "-s"], capture_output=True
+            ["python", main_path, "-o", "top-mods", "-s"],
+            capture_output=True,
+            cwd=working_copy.name,
         )  # nosec
         processed_output = output.stdout.decode("utf-8")
         split_processed_output = processed_output.splitlines()
-        self.assertEqual(len(split_processed_output), 45)
+        # Clusters of squatters sharing an author email follow the report and
+        # depend on the live metadata, so they are checked separately
+        cluster_lines = [
+            line for line in split_processed_output if "share an author email" in line
+        ]
+        self.assertEqual(len(split_processed_output) - len(cluster_lines), 45)
         self.assertEqual(split_processed_output[0], "Number of packages to examine: 43")
+        self.assertEqual(
+            split_processed_output[len(split_processed_output) - len(cluster_lines) :],
+            cluster_lines,
+        )
 
         # Test defend-package usage, i.e. names that are likely candidates based
         # on spelling alone that could be typosquatters
         output = subprocess.run(
-            ["python", "main.py", "-o", "defend-name", "-m", "test"],
+            ["python", main_path, "-o", "defend-name", "-m", "test"],
             capture_output=True,
+            cwd=working_copy.name,
         )  # nosec
         processed_output = output.stdout.decode("utf-8")
         split_processed_output = processed_output.splitlines()
@@ -5,25 +5,97 @@ These are the important misfits. They don't fit in elsewhere but these
 functions need to be in a module somewhere.
 """
 
+import bisect
 import collections
+import concurrent.futures
 import datetime
 import glob
 import json
+import math
 import os
+import random
 import sys
-from time import gmtime, localtime, strftime, time
+from time import gmtime, localtime, sleep, strftime, time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Added in Python 3.8
+    shared_memory = None
 
 from mrs_spellings import MrsWord
 from termcolor import colored
 
 import constants
-from filters import distance_calculations, homophone_attack_screen, order_attack_screen
-from scrapers import get_metadata
+from filters import (
+    distance_calculations,
+    drop_equivalent_names,
+    drop_whitelisted,
+    homophone_attack_screen,
+    is_whitelisted,
+    order_attack_screen,
+)
+from fingerprints import (
+    fingerprint_risk,
+    fresh_packages,
+    metadata_clusters,
+    update_fingerprint_table,
+)
+from indexes import (
+    build_canonical_index,
+    build_metaphone_index,
+    build_name_index,
+    build_token_index,
+    canonical_name,
+    choose_backend,
+    get_metaphone_index,
+    get_name_index,
+    get_qgram_index,
+    update_canonical_index,
+    update_metaphone_index,
+    update_name_index,
+    update_token_index,
+)
+from metrics import count_cache, stage
+from scrapers import (
+    download_package_names,
+    get_all_packages,
+    get_changelog_since_serial,
+    get_last_serial,
+    get_metadata,
+    get_metadata_concurrently,
+)
+from snapshots import (
+    diff_snapshots,
+    iter_snapshot,
+    open_snapshot,
+    snapshot_checksum,
+    snapshot_from_names,
+    write_delta_snapshot,
+    write_snapshot,
+)
+from store import open_store, record_metadata, record_snapshot, stored_metadata
 
+CACHE_FOLDER = constants.CACHE_FOLDER
+KEYBOARD_VARIANT_CACHE_SIZE = constants.KEYBOARD_VARIANT_CACHE_SIZE
 MAX_DISTANCE = constants.MAX_DISTANCE
+METADATA_BLANK_VALUES = constants.METADATA_BLANK_VALUES
+METADATA_CACHE_TTL = constants.METADATA_CACHE_TTL
+METADATA_CLUSTER_MIN_SIZE = constants.METADATA_CLUSTER_MIN_SIZE
+METADATA_FIELDS = constants.METADATA_FIELDS
+METADATA_WORKERS = constants.METADATA_WORKERS
+METADATA_TIMEOUT = constants.METADATA_TIMEOUT
+MIN_TARGETS_FOR_INDEX = constants.MIN_TARGETS_FOR_INDEX
+PYPI_XMLRPC_URL = constants.PYPI_XMLRPC_URL
+RESULTS_CACHE_MAX_CHANGES = constants.RESULTS_CACHE_MAX_CHANGES
+SCREENS = constants.SCREENS
+SHARDS_PER_WORKER = constants.SHARDS_PER_WORKER
+SNAPSHOT_MAX_DELTA_DEPTH = constants.SNAPSHOT_MAX_DELTA_DEPTH
+WATCH_MAX_BACKOFF = constants.WATCH_MAX_BACKOFF
+WATCH_POLL_INTERVAL = constants.WATCH_POLL_INTERVAL
+WATCH_RETRY_DELAY = constants.WATCH_RETRY_DELAY
 
 
-def compare_metadata(pkg1, pkg2):
+def compare_metadata(pkg1, pkg2, fingerprints=None, offline=False):
     """Retrieve and compare metadata of two PyPI packages.
 
     Determine whether the package metadata has no identical fields
@@ -32,32 +104,52 @@ def compare_metadata(pkg1, pkg2):
     sometimes, perhaps often, borrow package metadata of the original
     package in order to trick unsuspecting users.
 
+    With a fingerprint table, the packages are compared by their
+    fingerprints, retrieving only those missing from the table unless
+    offline.
+
     Args:
         pkg1 (str): name of first package to compare
         pkg2 (str): name of second package to compare
+        fingerprints (dict): optional table made by load_fingerprint_table
+        offline (bool): whether to only use the fingerprint table
 
     Returns:
         str: a value of "no_risk" or "some_risk"
     """
+    if fingerprints is not None:
+        risks = assess_suspicious_packages(
+            {pkg1: [pkg2]}, fingerprints=fingerprints, offline=offline
+        )
+        return risks[(pkg1, pkg2)]
+
     # Retrieve metadata for both packages
     pkg1_metadata = get_metadata(pkg1)
     pkg2_metadata = get_metadata(pkg2)
 
+    return metadata_risk(pkg1_metadata, pkg2_metadata)
+
+
+def metadata_risk(pkg1_metadata, pkg2_metadata):
+    """Compare already retrieved metadata of two PyPI packages.
+
+    Args:
+        pkg1_metadata (dict): metadata of first package, as from get_metadata
+        pkg2_metadata (dict): metadata of second package, as from get_metadata
+
+    Returns:
+        str: a value of "no_risk" or "some_risk"
+    """
     # Loop through identified fields to count number of identical fields
     num_identical_fields = 0
     # TODO: Decide if I should use any other fields?
-    fields_to_compare = [
-        "author_email",
-        "author",
-        "package_url",
-        "description",
-        "home_page",
-        "summary",
-    ]
-    for field in fields_to_compare:
+    for field in METADATA_FIELDS:
         # Only increment num_identical_fields if the field is not empty
-        # and the fields are identical
-        blank_field = pkg1_metadata["info"][field] == ""
+        # or a placeholder such as UNKNOWN, and the fields are identical
+        blank_field = (
+            not pkg1_metadata["info"][field]
+            or str(pkg1_metadata["info"][field]).strip() in METADATA_BLANK_VALUES
+        )
         same_metadata = pkg1_metadata["info"][field] == pkg2_metadata["info"][field]
         if (not blank_field) and same_metadata:
             num_identical_fields += 1
@@ -70,40 +162,558 @@ def compare_metadata(pkg1, pkg2):
     return risk_level
 
 
+def assess_suspicious_packages(
+    packages,
+    max_workers=METADATA_WORKERS,
+    timeout=METADATA_TIMEOUT,
+    fingerprints=None,
+    offline=False,
+    store=None,
+):
+    """Compare metadata of every package and its potential typosquatters.
+
+    All metadata needed for the comparisons is retrieved up front and
+    concurrently, with each package downloaded only once no matter how
+    many squatters it has.
+
+    With a fingerprint table, packages with recent fingerprints are not
+    retrieved at all. The rest are retrieved and added to the table, and
+    every pair is compared by its fingerprints. Offline, nothing is
+    retrieved, and packages missing from the table count as having no
+    metadata. With a store, metadata recorded in it within
+    METADATA_CACHE_TTL, or at any time offline, is read from it rather
+    than retrieved, and the retrieved metadata is recorded in it.
+
+    Args:
+        packages (dict): (key) package and (value) potential typosquatters
+        max_workers (int): maximum number of metadata downloads at the same time
+        timeout (float): seconds to wait for each metadata response
+        fingerprints (dict): optional table made by load_fingerprint_table
+        offline (bool): whether to only use the fingerprint table
+        store (sqlite3.Connection): optional store made by open_store
+
+    Returns:
+        dict: (key) package and squatter pair and (value) risk level
+    """
+    # Only packages with potential typosquatters need metadata
+    names = []
+    for pkg in packages:
+        if packages[pkg]:
+            names.append(pkg)
+            names.extend(packages[pkg])
+
+    if fingerprints is not None:
+        fresh = fresh_packages(fingerprints, names, METADATA_CACHE_TTL)
+        names = [name for name in names if name not in fresh]
+    stored = {}
+    if store is not None:
+        stored = stored_metadata(store, names, None if offline else METADATA_CACHE_TTL)
+        names = [name for name in names if name not in stored]
+    if fingerprints is not None and offline:
+        names = []
+    metadata = {}
+    if names:
+        metadata = get_metadata_concurrently(names, max_workers, timeout)
+    if store is not None:
+        record_metadata(store, metadata)
+
+    risks = {}
+    if fingerprints is not None:
+        update_fingerprint_table(fingerprints, metadata)
+        # Stored metadata keeps the time it was retrieved
+        for name, package_metadata in stored.items():
+            update_fingerprint_table(
+                fingerprints, {name: package_metadata}, package_metadata["fetched_at"]
+            )
+        for pkg in packages:
+            for squatter in packages[pkg]:
+                risks[(pkg, squatter)] = fingerprint_risk(fingerprints, pkg, squatter)
+        return risks
+
+    metadata.update(stored)
+    for pkg in packages:
+        for squatter in packages[pkg]:
+            risks[(pkg, squatter)] = metadata_risk(metadata[pkg], metadata[squatter])
+    return risks
+
+
 def create_suspicious_package_dict(
-    all_packages, top_packages, max_distance=MAX_DISTANCE
+    all_packages,
+    top_packages,
+    max_distance=MAX_DISTANCE,
+    name_index=None,
+    metaphone_index=None,
+    token_index=None,
+    workers=1,
+    distance_backend="auto",
+    canonical_index=None,
+    compiled_whitelist=None,
+    screens=SCREENS,
 ):
     """Examine all top packages for typosquatters.
 
     Loop through all top packages and check for instances of
     typosquatting. This includes confusion
 
+    The misspelling check queries a name index over all packages
+    rather than scanning the full list once per top package. An index
+    is built here unless the caller already has one or there are too
+    few top packages for the build to pay for itself. Homophones are
+    likewise looked up in a metaphone index, which costs no more to
+    build than a single scan of all packages. Order attacks are looked
+    up in a token bag index under the same rule as the name index;
+    below it, each top package only splits the names that contain its
+    longest word.
+
+    The distance backend chooses how misspellings are found. "auto"
+    picks an index as described above, "brute-force" compares every
+    package, and any other backend from DISTANCE_BACKENDS is always
+    used to build the name index, however few top packages there are.
+
+    With more than one worker, the top packages are split into shards
+    that are screened in parallel by a pool of processes. Each worker
+    builds its own indexes, so memory use grows with the number of
+    workers, by roughly 0.6 GB per worker for the full PyPI list. On
+    Python 3.7, which lacks shared memory, packages are screened in this
+    process instead.
+
+    Names that PyPI treats as the same project under PEP 503, such as
+    Foo_Bar and foo-bar, are screened once, and are never reported as
+    squatters of each other. The canonical name index this takes is
+    only built for as many top packages as the name index, or for the
+    keyboard screen, which probes it. Whitelisted names are dropped as each top
+    package is screened, so they never reach the metadata comparison.
+
+    Only the screens named in screens are run, in that order, and only
+    the indexes they use are built. The keyboard screen, which probes
+    the keyboard typos of each top package, can stand in for the
+    misspelling screen when a name index is too costly to build.
+
     Args:
         all_packages (list): all package names
         top_packages (list): package names to perform comparison
         max_distance (int): maximum edit distance to check for typosquatting
+        name_index (dict): optional prebuilt index over all_packages
+        metaphone_index (dict): optional prebuilt metaphone index over all_packages
+        token_index (dict): optional prebuilt token bag index over all_packages
+        workers (int): number of processes to screen top packages with
+        distance_backend (str): one of DISTANCE_BACKENDS
+        canonical_index (dict): optional prebuilt canonical name index over all_packages
+        compiled_whitelist (dict): optional whitelist made by compile_whitelist
+        screens (list): screens to run, from SCREEN_CHOICES
 
     Returns:
         dict: top packages (key) and potential typosquatters (value)
     """
+    # Screen one display name of each project, however it is spelled.
+    # For a few top packages, drop_equivalent_names compares the
+    # canonical names of the squatters found instead.
+    if canonical_index is None and (
+        len(top_packages) >= MIN_TARGETS_FOR_INDEX or "keyboard" in screens
+    ):
+        canonical_index = build_canonical_index(all_packages)
+    if canonical_index is not None and len(canonical_index) < len(all_packages):
+        all_packages = [names[0] for names in canonical_index.values()]
+
+    if workers > 1 and len(top_packages) > 1 and shared_memory is not None:
+        return screen_shards_in_parallel(
+            all_packages,
+            list(top_packages),
+            max_distance,
+            workers,
+            distance_backend,
+            compiled_whitelist,
+            screens,
+        )
+
     suspicious_packages = collections.OrderedDict()
 
+    # Build index once so each top package is a query, not a full scan
+    with stage("build_indexes"):
+        if (
+            name_index is None
+            and distance_backend != "brute-force"
+            and "misspelling" in screens
+        ):
+            if distance_backend != "auto" or len(top_packages) >= MIN_TARGETS_FOR_INDEX:
+                name_index = get_name_index(
+                    all_packages, max_distance, distance_backend
+                )
+        if metaphone_index is None and "homophone" in screens:
+            metaphone_index = build_metaphone_index(all_packages)
+        if (
+            token_index is None
+            and "order" in screens
+            and len(top_packages) >= MIN_TARGETS_FOR_INDEX
+        ):
+            token_index = build_token_index(all_packages)
+
     for top_package in top_packages:
-        # Check for misspelling attacks
-        close_packages = distance_calculations(top_package, all_packages, max_distance)
-        # Check for confusion attcks
-        reverse_package = order_attack_screen(top_package, all_packages)
-        # If there actually is a reverse package squatter, add to list
-        if reverse_package:
-            close_packages.extend(reverse_package)
-        # Check for homophone attack
-        homophone_packages = homophone_attack_screen(top_package, all_packages)
+        close_packages = []
+        for screen in screens:
+            with stage(screen + "_screen"):
+                # Check for misspelling attacks
+                if screen == "misspelling":
+                    screened_packages = distance_calculations(
+                        top_package, all_packages, max_distance, name_index
+                    )
+                # Check for confusion attcks
+                elif screen == "order":
+                    screened_packages = order_attack_screen(
+                        top_package, all_packages, token_index
+                    )
+                # Check for homophone attack
+                elif screen == "homophone":
+                    screened_packages = homophone_attack_screen(
+                        top_package, all_packages, metaphone_index
+                    )
+                # Check for keyboard typo attacks
+                else:
+                    screened_packages = keyboard_typo_screen(
+                        top_package, canonical_index
+                    )
+            # Add squatters not already caught by another screen
+            for package in screened_packages:
+                if package not in close_packages:
+                    close_packages.append(package)
 
+        close_packages = drop_equivalent_names(top_package, close_packages)
+        if compiled_whitelist is not None:
+            close_packages = drop_whitelisted(
+                top_package, close_packages, compiled_whitelist
+            )
         suspicious_packages[top_package] = close_packages
 
     return suspicious_packages
 
 
+# Package names and indexes held by each worker process of a parallel scan
+WORKER_STATE = {}
+
+
+def init_shard_worker(
+    shared_memory_name,
+    size,
+    max_distance,
+    distance_backend,
+    compiled_whitelist=None,
+    screens=SCREENS,
+):
+    """Prepare a worker process to screen shards of top packages.
+
+    The package names are decoded from shared memory and the indexes
+    are built once per worker, not once per shard. A q-gram index is
+    mapped from the file written by the parent process instead.
+
+    Args:
+        shared_memory_name (str): name of shared memory holding the package names
+        size (int): number of bytes of package names in shared memory
+        max_distance (int): maximum edit distance to check for typosquatting
+        distance_backend (str): backend of the name index each worker builds
+        compiled_whitelist (dict): optional whitelist made by compile_whitelist
+        screens (list): screens to run, from SCREEN_CHOICES
+    """
+    shared_names = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        all_packages = bytes(shared_names.buf[:size]).decode("utf-8").split("\n")
+    finally:
+        shared_names.close()
+
+    WORKER_STATE["all_packages"] = all_packages if size else []
+    WORKER_STATE["max_distance"] = max_distance
+    WORKER_STATE["distance_backend"] = distance_backend
+    WORKER_STATE["compiled_whitelist"] = compiled_whitelist
+    WORKER_STATE["screens"] = screens
+    WORKER_STATE["name_index"] = None
+    if distance_backend != "brute-force" and "misspelling" in screens:
+        WORKER_STATE["name_index"] = get_name_index(
+            all_packages, max_distance, distance_backend
+        )
+    WORKER_STATE["metaphone_index"] = None
+    if "homophone" in screens:
+        WORKER_STATE["metaphone_index"] = build_metaphone_index(all_packages)
+    WORKER_STATE["token_index"] = None
+    if "order" in screens:
+        WORKER_STATE["token_index"] = build_token_index(all_packages)
+    WORKER_STATE["canonical_index"] = build_canonical_index(all_packages)
+
+
+def screen_shard(shard):
+    """Screen one shard of top packages inside a worker process.
+
+    Args:
+        shard (list): top packages to screen
+
+    Returns:
+        list: (top package, potential typosquatters) pairs in shard order
+    """
+    suspicious_packages = create_suspicious_package_dict(
+        WORKER_STATE["all_packages"],
+        shard,
+        WORKER_STATE["max_distance"],
+        WORKER_STATE["name_index"],
+        WORKER_STATE["metaphone_index"],
+        WORKER_STATE["token_index"],
+        distance_backend=WORKER_STATE["distance_backend"],
+        canonical_index=WORKER_STATE["canonical_index"],
+        compiled_whitelist=WORKER_STATE["compiled_whitelist"],
+        screens=WORKER_STATE["screens"],
+    )
+    return list(suspicious_packages.items())
+
+
+def screen_shards_in_parallel(
+    all_packages,
+    top_packages,
+    max_distance,
+    workers,
+    distance_backend="auto",
+    compiled_whitelist=None,
+    screens=SCREENS,
+):
+    """Examine top packages for typosquatters on several processes.
+
+    The package names are placed in shared memory once rather than
+    being pickled for every shard. Each worker gets several shards to
+    balance the load, and results are merged in the original order.
+    Under the "auto" backend workers use a BK-tree rather than a
+    deletion index, which would take several times more memory in
+    every worker. A q-gram index is written to disk once before the
+    workers start, and every worker maps that same file.
+
+    Args:
+        all_packages (list): all package names
+        top_packages (list): package names to perform comparison
+        max_distance (int): maximum edit distance to check for typosquatting
+        workers (int): number of processes to screen top packages with
+        distance_backend (str): one of DISTANCE_BACKENDS
+        compiled_whitelist (dict): optional whitelist made by compile_whitelist
+        screens (list): screens to run, from SCREEN_CHOICES
+
+    Returns:
+        dict: top packages (key) and potential typosquatters (value)
+    """
+    suspicious_packages = collections.OrderedDict()
+
+    encoded_packages = "\n".join(all_packages).encode("utf-8")
+    size = len(encoded_packages)
+    shared_names = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        shared_names.buf[:size] = encoded_packages
+        del encoded_packages
+
+        # Split top packages into contiguous shards
+        shard_size = math.ceil(len(top_packages) / (workers * SHARDS_PER_WORKER))
+        shards = [
+            top_packages[i : i + shard_size]
+            for i in range(0, len(top_packages), shard_size)
+        ]
+        if distance_backend == "auto":
+            if len(top_packages) / workers < MIN_TARGETS_FOR_INDEX:
+                distance_backend = "brute-force"
+            elif choose_backend(max_distance) == "deletion":
+                distance_backend = "bk-tree"
+            else:
+                distance_backend = "qgram"
+        if distance_backend == "qgram" and "misspelling" in screens:
+            get_qgram_index(all_packages)
+
+        with concurrent.futures.ProcessPoolExecutor(
+            workers,
+            initializer=init_shard_worker,
+            initargs=(
+                shared_names.name,
+                size,
+                max_distance,
+                distance_backend,
+                compiled_whitelist,
+                screens,
+            ),
+        ) as executor:
+            # map returns shard results in the order the shards were given
+            for shard_results in executor.map(screen_shard, shards):
+                suspicious_packages.update(shard_results)
+    finally:
+        shared_names.close()
+        shared_names.unlink()
+
+    return suspicious_packages
+
+
+def patch_cached_results(
+    results,
+    added_packages,
+    removed_packages,
+    max_distance,
+    distance_backend="auto",
+    screens=SCREENS,
+):
+    """Patch stored potential typosquatters with names added and removed.
+
+    Only the added names are screened, against the top packages that
+    have stored results.
+
+    Args:
+        results (dict): top packages (key) and stored potential typosquatters (value)
+        added_packages (list): names added since the results were computed
+        removed_packages (set): names removed since the results were computed
+        max_distance (int): maximum edit distance the results were computed with
+        distance_backend (str): one of DISTANCE_BACKENDS
+        screens (list): screens the results were computed with
+
+    Returns:
+        dict: the patched results
+    """
+    added_squatters = {}
+    if results and added_packages:
+        # Index the added names in memory so stored indexes are left alone
+        name_index = None
+        if distance_backend != "brute-force" and "misspelling" in screens:
+            name_index = build_name_index(
+                added_packages, max_distance, distance_backend
+            )
+        added_squatters = create_suspicious_package_dict(
+            added_packages,
+            list(results),
+            max_distance,
+            name_index,
+            distance_backend=distance_backend,
+            screens=screens,
+        )
+    for top_package in results:
+        squatters = [
+            package
+            for package in results[top_package]
+            if package not in removed_packages
+        ]
+        squatters.extend(added_squatters.get(top_package, []))
+        results[top_package] = drop_equivalent_names(top_package, squatters)
+    return results
+
+
+def create_cached_suspicious_package_dict(
+    all_packages,
+    top_packages,
+    max_distance=MAX_DISTANCE,
+    folder="package_lists",
+    workers=1,
+    distance_backend="auto",
+    compiled_whitelist=None,
+    screens=SCREENS,
+):
+    """Examine top packages for typosquatters, reusing earlier results.
+
+    Results are stored per top package for each edit distance and set
+    of screens, together with the package list they were computed
+    against. On the next run, only the names added to or removed from
+    PyPI since then are screened against the cached top packages, and
+    their cached candidates are patched. The results of every edit
+    distance and set of screens are patched together, so they all keep
+    matching the stored package list. Top packages without cached
+    results are screened in full, and too many changes discard the
+    cache.
+
+    Patched candidates keep their order with new ones appended, so they
+    can be ordered differently from a full scan. The stored results are
+    not whitelisted, so that editing the whitelist needs no rescan.
+
+    Args:
+        all_packages (list): all package names
+        top_packages (list): package names to perform comparison
+        max_distance (int): maximum edit distance to check for typosquatting
+        folder (str): folder in which the results are stored
+        workers (int): number of processes to screen top packages with
+        distance_backend (str): one of DISTANCE_BACKENDS
+        compiled_whitelist (dict): optional whitelist made by compile_whitelist
+        screens (list): screens to run, from SCREEN_CHOICES
+
+    Returns:
+        dict: top packages (key) and potential typosquatters (value)
+    """
+    names_path = os.path.join(folder, "pypi-top-mods-names.snap")
+    results_path = os.path.join(folder, "pypi-top-mods-results.json")
+    key = str(max_distance) + ":" + ",".join(screens)
+    current_snapshot = snapshot_from_names(all_packages)
+
+    # Use cached results computed against the stored package list
+    stored_results = {}
+    if os.path.exists(results_path) and os.path.exists(names_path):
+        with open(results_path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        if stored["names_sha256"] == snapshot_checksum(names_path):
+            stored_results = stored["results"]
+
+    # Find the names that changed since the cached results were computed
+    added_packages = []
+    removed_packages = set()
+    if stored_results:
+        changes = diff_snapshots(open_snapshot(names_path), current_snapshot)
+        for package, change in changes:
+            if change == "added":
+                added_packages.append(package)
+            else:
+                removed_packages.add(package)
+            if len(added_packages) + len(removed_packages) > RESULTS_CACHE_MAX_CHANGES:
+                stored_results = {}
+                break
+
+    # Patch the cached results of every key with the changed names only
+    if added_packages or removed_packages:
+        for results_key, results in stored_results.items():
+            results_distance, results_screens = results_key.split(":", 1)
+            patch_cached_results(
+                results,
+                added_packages,
+                removed_packages,
+                int(results_distance),
+                distance_backend,
+                [screen for screen in results_screens.split(",") if screen],
+            )
+    cached_results = stored_results.get(key, {})
+
+    # Screen top packages without cached results against every name
+    missing_targets = [
+        package for package in top_packages if package not in cached_results
+    ]
+    count_cache("results", True, len(top_packages) - len(missing_targets))
+    count_cache("results", False, len(missing_targets))
+    if missing_targets:
+        metaphone_index = None
+        if "homophone" in screens:
+            metaphone_index = get_metaphone_index(all_packages, folder)
+        cached_results.update(
+            create_suspicious_package_dict(
+                all_packages,
+                missing_targets,
+                max_distance,
+                metaphone_index=metaphone_index,
+                workers=workers,
+                distance_backend=distance_backend,
+                screens=screens,
+            )
+        )
+
+    suspicious_packages = collections.OrderedDict(
+        (package, cached_results[package]) for package in top_packages
+    )
+
+    # Store the results with the package list they now match
+    if added_packages or removed_packages or not stored_results:
+        write_snapshot(all_packages, names_path)
+    stored_results[key] = suspicious_packages
+    stored = {"names_sha256": snapshot_checksum(names_path), "results": stored_results}
+    with open(results_path + ".part", "w", encoding="utf-8") as f:
+        json.dump(stored, f, ensure_ascii=False)
+    os.replace(results_path + ".part", results_path)
+
+    if compiled_whitelist is not None:
+        suspicious_packages = collections.OrderedDict(
+            (package, drop_whitelisted(package, squatters, compiled_whitelist))
+            for package, squatters in suspicious_packages.items()
+        )
+    return suspicious_packages
+
+
 def store_squatting_candidates(squat_candidates):
     """Persist results of squatting candidate search.
 
@@ -140,83 +750,538 @@ def create_potential_squatter_names(module_name):
     return potential_candidates_set
 
 
-def store_recent_scan_results(packages, folder="package_lists"):
+# Keyboard typo variants already generated in this process, keyed by name
+KEYBOARD_VARIANT_CACHE = {}
+
+
+def get_keyboard_variants(module_name):
+    """Return the keyboard typo variants of a name, generating them only once.
+
+    Args:
+        module_name (str): a name for a module
+
+    Returns:
+        list: sorted canonical names of the variants, without the name itself
+    """
+    count_cache("keyboard_variants", module_name in KEYBOARD_VARIANT_CACHE)
+    if module_name not in KEYBOARD_VARIANT_CACHE:
+        # Start over rather than track use, as names are rarely repeated
+        if len(KEYBOARD_VARIANT_CACHE) >= KEYBOARD_VARIANT_CACHE_SIZE:
+            KEYBOARD_VARIANT_CACHE.clear()
+        variants = {
+            canonical_name(variant)
+            for variant in create_potential_squatter_names(module_name)
+        }
+        variants.discard(canonical_name(module_name))
+        KEYBOARD_VARIANT_CACHE[module_name] = sorted(variants)
+    return KEYBOARD_VARIANT_CACHE[module_name]
+
+
+def keyboard_typo_screen(package_of_interest, canonical_index):
+    """Find registered names one keyboard typo away from a package.
+
+    Rather than comparing the package to every name, its keyboard typo
+    variants from create_potential_squatter_names are looked up in the
+    canonical name index, so the cost grows with the number of
+    variants, not the number of packages. Every name found is within
+    an edit distance of 1, so at larger distances the misspelling
+    screen finds them too.
+
+    Args:
+        package_of_interest (str): package name on which to perform comparison
+        canonical_index (dict): canonical name index over all packages
+
+    Returns:
+        list: potential typosquatting packages, in the order of their variants
+    """
+    keyboard_packages = []
+    for variant in get_keyboard_variants(package_of_interest):
+        names = canonical_index.get(variant)
+        if names:
+            keyboard_packages.append(names[0])
+    return keyboard_packages
+
+
+def store_recent_scan_results(packages, folder="package_lists", delta=False):
     """Store results of scanning packages recently added to PyPI.
 
-    Save timestamped version of JSON file to allow analysis of packages
-    recently added to PyPI
+    Save a timestamped snapshot of the package list to allow analysis
+    of packages recently added to PyPI, record it in the snapshot
+    catalog, and record when each name was seen in the store. As a
+    delta, only the changes since the newest stored snapshot are saved,
+    unless reading it back would take too many deltas in a row.
 
     Args:
         packages (list): Packages on PyPI
-        folder (str): Folder in which to store JSON file
+        folder (str): Folder in which to store snapshot file
+        delta (bool): whether to store the changes since the newest snapshot
 
     """
     timestamp = strftime("%Y-%m-%d-%H-%M-%S", gmtime())
-    filename = "pypi-package-list-" + timestamp + ".json"
+    filename = "pypi-package-list-" + timestamp + ".snap"
     # Platform-independent path joining
     path = os.path.join(folder, filename)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(packages, f, ensure_ascii=False, indent=4)
 
+    catalog = load_snapshot_catalog(folder)
+    base_path = ""
+    if delta and catalog:
+        base_path = os.path.join(folder, catalog[-1]["file"])
+    if (
+        os.path.exists(base_path)
+        and open_snapshot(base_path)["depth"] < SNAPSHOT_MAX_DELTA_DEPTH
+    ):
+        write_delta_snapshot(packages, path, base_path)
+    else:
+        write_snapshot(packages, path)
 
-def load_most_recent_packages(folder="package_lists"):
-    """Load the most recent package list from at least 24 hours ago.
+    catalog.append(catalog_entry(path))
+    save_snapshot_catalog(catalog, folder)
+
+    store = open_store(folder)
+    try:
+        record_snapshot(store, packages, snapshot_timestamp(path))
+    finally:
+        store.close()
 
-    Load the JSON file containing PyPI packages with the most recent
-    timestamp that was created at least 24 hours ago.
+
+def snapshot_timestamp(file):
+    """Read the time a package list snapshot was taken from its name.
+
+    Args:
+        file (str): path of a timestamped snapshot file
+
+    Returns:
+        float: unix time at which the snapshot was taken
+    """
+    file_no_ext = os.path.splitext(file)[0]  # Remove extension
+    yr, mon, day, hr, minute, sec = file_no_ext.split("-")[-6:]  # get time
+    dt = datetime.datetime(int(yr), int(mon), int(day), int(hr), int(minute), int(sec))
+    # Avoid bugs by using this conservative approach
+    return (dt - datetime.datetime(1970, 1, 1)) / datetime.timedelta(seconds=1)
+
+
+def list_package_snapshots(folder="package_lists"):
+    """List stored package list snapshots from newest to oldest.
+
+    Args:
+        folder (str): Folder in which to check for snapshot files
+
+    Returns:
+        list: (unix time, path) pairs of binary and JSON snapshots
+    """
+    snapshots = []
+    for extension in ["snap", "json"]:
+        path = os.path.join(folder, "pypi-package-list-*." + extension)
+        for file in glob.glob(path):
+            snapshots.append((snapshot_timestamp(file), file))
+    snapshots.sort(reverse=True)
+    return snapshots
+
+
+def catalog_entry(path):
+    """Describe a snapshot file for the snapshot catalog.
+
+    Args:
+        path (str): path of a timestamped snapshot file
+
+    Returns:
+        dict: file name, timestamp, number of names and checksum
+    """
+    return {
+        "file": os.path.basename(path),
+        "timestamp": snapshot_timestamp(path),
+        "count": open_snapshot(path)["count"],
+        "sha256": snapshot_checksum(path),
+    }
+
+
+def save_snapshot_catalog(catalog, folder="package_lists"):
+    """Save the snapshot catalog, ordered from oldest to newest.
+
+    Args:
+        catalog (list): entries made by catalog_entry
+        folder (str): Folder in which the snapshots are stored
+    """
+    catalog.sort(key=lambda entry: entry["timestamp"])
+    path = os.path.join(folder, "pypi-snapshot-catalog.json")
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump(catalog, f, indent=4)
+    os.replace(path + ".part", path)
+
+
+def load_snapshot_catalog(folder="package_lists"):
+    """Load the catalog of stored package list snapshots.
+
+    The catalog records the time, number of names and checksum of every
+    snapshot, so a baseline can be picked without listing the folder
+    or opening any snapshot. Folders written before the catalog existed
+    are catalogued on first use.
+
+    Args:
+        folder (str): Folder in which the snapshots are stored
+
+    Returns:
+        list: catalog entries ordered from oldest to newest
+    """
+    path = os.path.join(folder, "pypi-snapshot-catalog.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    catalog = [catalog_entry(file) for _, file in list_package_snapshots(folder)]
+    # Only write a catalog into folders that hold snapshots
+    if catalog:
+        save_snapshot_catalog(catalog, folder)
+    return catalog
+
+
+def load_most_recent_snapshot(folder="package_lists"):
+    """Open the most recent package list from at least 24 hours ago.
+
+    The baseline is found by bisecting the snapshot catalog and is
+    checked against its recorded checksum before it is opened. If the
+    file has been removed since, the catalog is rebuilt from the folder.
 
     Args:
         folder (str): Folder in which to check for file
 
     Returns:
-        package_set (set): Packages loaded from JSON file
+        dict: snapshot that the snapshots module can read
 
     """
-    # Identify all json files
-    path = os.path.join(folder, "*.json")
-    json_files = glob.glob(path)
-
-    # Find json file that is at least 24 hours old.
-    # TODO: Is the first one found the newest of the candidates? Need to check.
-    current_time = time()
-    newest_file_older_than_1day = ""
+    catalog = load_snapshot_catalog(folder)
     DAY_IN_SECONDS = 60 * 60 * 24
-    for file in json_files:
-        file_no_ext = os.path.splitext(file)[0]  # Remove extension
-        yr, mon, day, hr, minute, sec = file_no_ext.split("-")[-6:]  # get time
-        # Convert time variables to integers
-        yr = int(yr)
-        mon = int(mon)
-        day = int(day)
-        hr = int(hr)
-        minute = int(minute)
-        sec = int(sec)
-        dt = datetime.datetime(yr, mon, day, hr, minute, sec)  # unix time
-        # Avoid bugs by using this conservative approach
-        file_timestamp = (dt - datetime.datetime(1970, 1, 1)) / datetime.timedelta(
-            seconds=1
-        )
-        if file_timestamp <= (current_time - DAY_IN_SECONDS):
-            newest_file_older_than_1day = file
-            break
+    timestamps = [entry["timestamp"] for entry in catalog]
+    position = bisect.bisect_right(timestamps, time() - DAY_IN_SECONDS) - 1
+    if position < 0:
+        raise FileNotFoundError("No snapshot files older than one day found.")
+
+    entry = catalog[position]
+    path = os.path.join(folder, entry["file"])
+    if not os.path.exists(path):
+        os.remove(os.path.join(folder, "pypi-snapshot-catalog.json"))
+        return load_most_recent_snapshot(folder)
+    if snapshot_checksum(path) != entry["sha256"]:
+        raise ValueError(path + " does not match its checksum in the catalog.")
+    return open_snapshot(path)
+
+
+def load_most_recent_packages(folder="package_lists"):
+    """Load the most recent package list from at least 24 hours ago.
+
+    Args:
+        folder (str): Folder in which to check for file
+
+    Returns:
+        package_set (set): Packages loaded from snapshot file
+
+    """
+    return set(iter_snapshot(load_most_recent_snapshot(folder)))
+
+
+def sync_package_list(
+    folder="package_lists",
+    xmlrpc_url=PYPI_XMLRPC_URL,
+    page="https://pypi.org/simple/",
+    cache_folder=CACHE_FOLDER,
+):
+    """Bring the locally synced PyPI package list up to date.
+
+    The synced list is stored together with the serial of the last PyPI
+    event it reflects. Each sync replays only the project creations,
+    removals and renames that PyPI has recorded since that serial and
+    then updates the stored list in place, rather than downloading the
+    full list of packages again. The first sync downloads the full list.
+
+    Args:
+        folder (str): Folder in which the synced list is stored
+        xmlrpc_url (str): PyPI XML-RPC endpoint serving the changelog
+        page (str): webpage from which to download the first full list
+        cache_folder (str): folder in which to cache the first full list
+
+    Returns:
+        tuple: all package names (set), names added since the last sync
+        (set) and names removed since the last sync (set)
+    """
+    path = os.path.join(folder, "pypi-synced-package-list.json")
+    added_packages = set()
+    removed_packages = set()
 
-    # Check for existence of file and, if it exists, load it
-    if not newest_file_older_than_1day:
-        raise FileNotFoundError("No json files older than one day found.")
+    if not os.path.exists(path):
+        # Note the serial first so changes made during the download are
+        # replayed by the next sync
+        serial = get_last_serial(xmlrpc_url)
+        packages = set(
+            get_all_packages(page, cache_max_age=0, cache_folder=cache_folder)
+        )
     else:
-        with open(newest_file_older_than_1day, "r") as f:
-            package_set = set(json.load(f))
-            return package_set
+        with open(path, "r", encoding="utf-8") as f:
+            synced = json.load(f)
+        serial = synced["serial"]
+        packages = set(synced["packages"])
+
+        # Remember whether each changed name existed before this sync
+        existed_before = {}
+        events = get_changelog_since_serial(serial, xmlrpc_url)
+        for name, _, _, action, event_serial in sorted(events, key=lambda e: e[4]):
+            if action == "create":
+                changes = [(name, True)]
+            elif action == "remove project":
+                changes = [(name, False)]
+            elif action.startswith("rename from "):
+                changes = [(action[len("rename from ") :], False), (name, True)]
+            else:  # Releases and files do not change the list of names
+                changes = []
+            for changed_name, exists in changes:
+                existed_before.setdefault(changed_name, changed_name in packages)
+                if exists:
+                    packages.add(changed_name)
+                else:
+                    packages.discard(changed_name)
+            serial = max(serial, event_serial)
+
+        for name, existed in existed_before.items():
+            if not existed and name in packages:
+                added_packages.add(name)
+            elif existed and name not in packages:
+                removed_packages.add(name)
+
+    # Replace the stored list in one step so an interrupted sync is harmless
+    partial_path = path + ".part"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"serial": serial, "packages": sorted(packages)}, f, ensure_ascii=False
+        )
+    os.replace(partial_path, path)
 
+    return packages, added_packages, removed_packages
 
-def print_suspicious_packages(packages):
+
+def backoff_delay(failures, retry_delay=WATCH_RETRY_DELAY, max_delay=WATCH_MAX_BACKOFF):
+    """Pick how long to wait after consecutive failures.
+
+    The delay doubles with each failure up to max_delay, and a random
+    half of it is added so that many watchers do not retry in step.
+
+    Args:
+        failures (int): number of consecutive failures so far
+        retry_delay (float): seconds to wait after the first failure
+        max_delay (float): longest delay before jitter is applied
+
+    Returns:
+        float: seconds to wait before the next attempt
+    """
+    delay = min(max_delay, retry_delay * 2 ** (failures - 1))
+    return delay / 2 + random.uniform(0, delay / 2)  # nosec
+
+
+def watch_new_packages(
+    max_distance=MAX_DISTANCE,
+    poll_interval=WATCH_POLL_INTERVAL,
+    max_polls=None,
+    metadata_workers=METADATA_WORKERS,
+    metadata_timeout=METADATA_TIMEOUT,
+    distance_backend="auto",
+    compiled_whitelist=None,
+):
+    """Poll PyPI and screen every package added since the previous poll.
+
+    The first poll sets the baseline. Each later poll revalidates the
+    cached package list, merges it with the previous poll's sorted
+    snapshot to find added and removed names, patches the canonical
+    name, metaphone and token bag indexes with them, and screens only
+    the added names. BK-tree and deletion name indexes are patched in
+    the same way. Q-gram and numpy indexes cannot be patched, so with
+    those backends the few added names are compared with every package
+    instead. Only the current snapshot and indexes are kept between
+    polls, so memory use does not grow with the time spent watching.
+    Polls that fail to download the package list are retried after a
+    jittered, exponentially growing delay.
+
+    New packages are the potential typosquatters here, so whitelisted
+    new packages are not screened, and whitelisted pairs are dropped
+    before any metadata is fetched.
+
+    Args:
+        max_distance (int): maximum edit distance to check for typosquatting
+        poll_interval (float): seconds between successful polls
+        max_polls (int): number of polls before stopping, or None to never stop
+        metadata_workers (int): maximum number of metadata downloads at the same time
+        metadata_timeout (float): seconds to wait for each metadata response
+        distance_backend (str): one of DISTANCE_BACKENDS
+        compiled_whitelist (dict): optional whitelist made by compile_whitelist
+
+    Yields:
+        dict: new package, the packages it may be typosquatting on, and
+        the metadata risk of each pair
+    """
+    previous_snapshot = None
+    canonical_index = {}
+    name_index = None
+    metaphone_index = {}
+    token_index = {}
+    backend = choose_backend(max_distance, distance_backend)
+    failures = 0
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        if polls:
+            if failures:
+                sleep(backoff_delay(failures))
+            else:
+                sleep(poll_interval)
+        polls += 1
+
+        try:
+            # Revalidate the cached list so unchanged polls cost a 304
+            package_names = download_package_names(cache_max_age=0)
+        # Download errors from requests are OSErrors
+        except OSError as e:
+            failures += 1
+            print("Poll of PyPI failed: " + str(e), file=sys.stderr)
+            continue
+        failures = 0
+
+        current_snapshot = snapshot_from_names(package_names)
+        if previous_snapshot is None:
+            previous_snapshot = current_snapshot
+            canonical_index = build_canonical_index(package_names)
+            if backend in ("deletion", "bk-tree"):
+                # Index one display name of each project, as scans do
+                name_index = build_name_index(
+                    [names[0] for names in canonical_index.values()],
+                    max_distance,
+                    backend,
+                )
+            metaphone_index = build_metaphone_index(package_names)
+            token_index = build_token_index(package_names)
+            continue
+
+        added_packages = []
+        removed_packages = []
+        for package, change in diff_snapshots(previous_snapshot, current_snapshot):
+            if change == "added":
+                added_packages.append(package)
+            else:
+                removed_packages.append(package)
+        previous_snapshot = current_snapshot
+        if not added_packages and not removed_packages:
+            continue
+        # Find which display names of the changed projects come and go
+        changed = {canonical_name(p) for p in added_packages + removed_packages}
+        before = {c: canonical_index[c][0] for c in changed if c in canonical_index}
+        update_canonical_index(canonical_index, added_packages, removed_packages)
+        after = {c: canonical_index[c][0] for c in changed if c in canonical_index}
+        if name_index is not None:
+            update_name_index(
+                name_index,
+                [name for c, name in after.items() if before.get(c) != name],
+                [name for c, name in before.items() if after.get(c) != name],
+            )
+        update_metaphone_index(metaphone_index, added_packages, removed_packages)
+        update_token_index(token_index, added_packages, removed_packages)
+        if compiled_whitelist is not None:
+            # Whitelisted new packages are known good
+            added_packages = [
+                package
+                for package in added_packages
+                if not is_whitelisted(compiled_whitelist, package)
+            ]
+        if not added_packages:
+            continue
+
+        squat_candidates = create_suspicious_package_dict(
+            package_names,
+            added_packages,
+            max_distance,
+            name_index=name_index,
+            metaphone_index=metaphone_index,
+            token_index=token_index,
+            distance_backend=(
+                distance_backend if name_index is not None else "brute-force"
+            ),
+            canonical_index=canonical_index,
+        )
+        if compiled_whitelist is not None:
+            # Drop whitelisted pairs, whose squatter is the new package
+            for package in squat_candidates:
+                squat_candidates[package] = [
+                    similar_package
+                    for similar_package in squat_candidates[package]
+                    if not is_whitelisted(compiled_whitelist, package, similar_package)
+                ]
+        squat_candidates = collections.OrderedDict(
+            (package, squatters)
+            for package, squatters in squat_candidates.items()
+            if squatters
+        )
+        if not squat_candidates:
+            continue
+        risks = assess_suspicious_packages(
+            squat_candidates, metadata_workers, metadata_timeout
+        )
+        detected = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
+        for package, squatters in squat_candidates.items():
+            yield {
+                "detected": detected,
+                "package": package,
+                "similar_packages": squatters,
+                "risks": [risks[(package, squatter)] for squatter in squatters],
+            }
+
+
+def print_suspicious_packages(
+    packages,
+    max_workers=METADATA_WORKERS,
+    timeout=METADATA_TIMEOUT,
+    fingerprints=None,
+    offline=False,
+    store=None,
+):
     """Pretty print a suspicious package list.
 
     Packages with any identical metadata are printed in red while
     other potential typosquatters are printed in the normal ink color.
+    All metadata comparisons finish before printing starts, so one slow
+    PyPI response cannot stall the report part way through.
+
+    With a fingerprint table, potential typosquatters that share one
+    author email are also listed, as one author registering many
+    similar names is a strong sign of a campaign.
+
+    Args:
+        packages (dict): (key) package and (value) potential typosquatters
+        max_workers (int): maximum number of metadata downloads at the same time
+        timeout (float): seconds to wait for each metadata response
+        fingerprints (dict): optional table made by load_fingerprint_table
+        offline (bool): whether to only use the fingerprint table
+        store (sqlite3.Connection): optional store to record metadata in
+    """
+    with stage("metadata"):
+        risks = assess_suspicious_packages(
+            packages, max_workers, timeout, fingerprints, offline, store
+        )
+
+    with stage("print"):
+        print_suspicious_package_list(packages, risks)
+        if fingerprints is not None:
+            squatters = {squatter for pkg in packages for squatter in packages[pkg]}
+            clusters = metadata_clusters(
+                fingerprints, squatters, min_size=METADATA_CLUSTER_MIN_SIZE
+            )
+            for cluster in clusters:
+                print(
+                    str(len(cluster))
+                    + " potential typosquatters share an author email: "
+                    + ", ".join(cluster)
+                )
+
+
+def print_suspicious_package_list(packages, risks):
+    """Print suspicious packages, in red if their metadata is risky.
 
     Args:
         packages (dict): (key) package and (value) potential typosquatters
+        risks (dict): (key) package and squatter pair and (value) risk level
     """
     print("Number of packages to examine: " + str(len(packages)))
     cnt_potential_squatters = 0
@@ -231,7 +1296,7 @@ def print_suspicious_packages(packages):
             for index, squatter in enumerate(packages[pkg]):
                 # Check if package has at least some identical metadata
                 # Use color printing if so
-                if compare_metadata(pkg, squatter) == "some_risk":
+                if risks[(pkg, squatter)] == "some_risk":
                     print("'", end="")
                     print(colored(squatter, "red"), sep="", end="")
                     # This codes skips printing unnecessary characters